@@ -0,0 +1,240 @@
+"""Import a product database dump into the barcode catalog
+
+    python barcode_import.py products.csv.gz                # postgresql:///pantry
+    python barcode_import.py products.jsonl postgresql:///other_db
+
+Takes CSV (tab or comma separated, header row, like the Open Food Facts
+export) or JSON lines, either one optionally gzipped. Used: code,
+product_name (or name), brands, categories (or categories_tags) and
+shelf_life in days if there is one, otherwise it's guessed from the name and
+categories.
+
+Products are read chunk_size at a time, COPYed into a temp staging table and
+upserted into barcodes on code, one transaction per chunk, so memory stays
+flat however big the dump is. After each chunk the number of products done
+is saved to <dump>.progress; an interrupted import picks up after it. The
+upsert makes redoing a chunk harmless, so a crash between commit and
+progress write costs nothing but time.
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+from sqlalchemy import (MetaData, Table, Column, Integer, String,
+                        create_engine, text)
+
+from bulk_load import CopyStream, insert_rows
+from pantry_functions import normalize_code
+
+DEFAULT_DB = "postgresql:///pantry"
+# Products per staging round trip and transaction
+CHUNK_SIZE = 20000
+
+# Guessed days a product keeps, first word found in its name or categories
+# wins, so the more specific ones go first
+SHELF_LIFE = [("frozen", 180), ("canned", 730), ("chocolate", 365),
+              ("cereal", 180), ("pasta", 730), ("rice", 730), ("flour", 365),
+              ("yogurt", 14), ("yoghurt", 14), ("cheese", 30), ("milk", 7),
+              ("egg", 21), ("bread", 5), ("juice", 10), ("chicken", 3),
+              ("meat", 3), ("fish", 2), ("seafood", 2), ("salad", 5),
+              ("fruit", 7), ("vegetable", 7)]
+
+# Kept out of db.metadata, one per connection and gone when it closes
+staging_metadata = MetaData()
+staging = Table("barcode_staging", staging_metadata,
+                Column("line", Integer),
+                Column("code", String(14)),
+                Column("name", String(200)),
+                Column("brand", String(100)),
+                Column("food_type", String(50)),
+                Column("shelf_life", Integer),
+                prefixes=["TEMPORARY"])
+STAGING_COLUMNS = ["line", "code", "name", "brand", "food_type", "shelf_life"]
+
+# Last one in the chunk wins when a dump lists a code twice (ON CONFLICT
+# can't touch the same row twice in one statement)
+UPSERT = """INSERT INTO barcodes (code, name, brand, food_type, shelf_life)
+            SELECT code, name, brand, food_type, shelf_life
+            FROM barcode_staging
+            WHERE line IN (SELECT max(line) FROM barcode_staging GROUP BY code)
+            ON CONFLICT (code) DO UPDATE SET
+                name = excluded.name, brand = excluded.brand,
+                food_type = excluded.food_type,
+                shelf_life = excluded.shelf_life"""
+
+###############################################################################
+"""Reading"""
+
+def open_dump(path):
+    if path.endswith(".gz"):
+        return gzip.open(path)
+    return open(path)
+
+def read_products(path):
+    """Yields a dict per product in a CSV or JSON lines dump"""
+
+    is_json = path[:-3] if path.endswith(".gz") else path
+    is_json = is_json.endswith((".jsonl", ".json", ".ndjson"))
+
+    with open_dump(path) as f:
+        if is_json:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        # Some fields in the big dumps are longer than csv's default limit
+        csv.field_size_limit(sys.maxsize)
+        header = f.readline()
+        delimiter = "\t" if "\t" in header else ","
+        columns = next(csv.reader([header], delimiter=delimiter))
+        for values in csv.reader(f, delimiter=delimiter):
+            yield dict((column, value.decode("utf8", "replace"))
+                       for column, value in zip(columns, values))
+
+def guess_shelf_life(*texts):
+    text = " ".join(texts).lower()
+    for word, days in SHELF_LIFE:
+        if word in text:
+            return days
+    return None
+
+def to_row(product):
+    """Takes a product dict, returns (code, name, brand, food_type,
+       shelf_life), or None if it has no usable code or name"""
+
+    code = normalize_code(unicode(product.get("code") or ""))
+    name = (product.get("product_name") or product.get("name") or "").strip()
+    if code is None or not name:
+        return None
+
+    brand = (product.get("brands") or "").split(",")[0].strip() or None
+
+    categories = product.get("categories_tags") or product.get("categories")
+    if isinstance(categories, basestring):
+        categories = categories.split(",")
+    # Tags look like "en:plant-based-foods", most specific last
+    categories = [category.split(":")[-1].replace("-", " ").strip()
+                  for category in categories or []]
+    food_type = categories[-1] if categories else None
+
+    try:
+        shelf_life = int(product.get("shelf_life"))
+    except (TypeError, ValueError):
+        shelf_life = guess_shelf_life(name, " ".join(categories))
+
+    return (code, name[:200], brand and brand[:100],
+            food_type and food_type[:50], shelf_life)
+
+###############################################################################
+"""Progress"""
+
+def progress_path(path):
+    return path + ".progress"
+
+def load_progress(path):
+    """Products already imported from the dump at path, 0 if none or the
+       dump has changed since"""
+
+    try:
+        with open(progress_path(path)) as f:
+            progress = json.load(f)
+    except (IOError, ValueError):
+        return 0
+    if progress.get("size") != os.path.getsize(path):
+        return 0
+    return progress["done"]
+
+def save_progress(path, done):
+    tmp = progress_path(path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"size": os.path.getsize(path), "done": done}, f)
+    os.rename(tmp, progress_path(path))
+
+###############################################################################
+"""Loading"""
+
+def stage(conn, rows):
+    """Rows into the staging table, COPY on PostgreSQL"""
+
+    if conn.dialect.name == "postgresql":
+        cursor = conn.connection.cursor()
+        cursor.copy_expert("COPY barcode_staging ({}) FROM STDIN".format(
+                           ", ".join(STAGING_COLUMNS)), CopyStream(rows))
+    elif rows:
+        insert_rows(conn, staging, STAGING_COLUMNS, rows)
+
+def import_products(bind, path, chunk_size=CHUNK_SIZE, resume=True,
+                    verbose=True):
+    """Upsert every product in the dump at path into barcodes. bind is an
+       engine or connection. Returns stats dict."""
+
+    done = load_progress(path) if resume else 0
+    stats = {"resumed_at": done, "read": 0, "imported": 0, "skipped": 0}
+    start = time.time()
+
+    conn = bind.connect()
+    try:
+        staging.create(bind=conn, checkfirst=True)
+        products = islice(read_products(path), done, None)
+        while True:
+            chunk = list(islice(products, chunk_size))
+            if not chunk:
+                break
+
+            rows = []
+            for line, product in enumerate(chunk, done + 1):
+                row = to_row(product)
+                if row is None:
+                    stats["skipped"] += 1
+                else:
+                    rows.append((line,) + row)
+
+            with conn.begin():
+                stage(conn, rows)
+                conn.execute(text(UPSERT))
+                conn.execute(staging.delete())
+
+            done += len(chunk)
+            stats["read"] += len(chunk)
+            stats["imported"] += len(rows)
+            save_progress(path, done)
+            if verbose:
+                print "{:>10} products, {:.0f}/s".format(
+                      done, stats["read"] / (time.time() - start))
+
+        staging.drop(bind=conn, checkfirst=True)
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("ANALYZE barcodes"))
+    finally:
+        conn.close()
+
+    # All done, a rerun starts from the top
+    if os.path.exists(progress_path(path)):
+        os.remove(progress_path(path))
+    stats["seconds"] = time.time() - start
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a product dump "
+                                                 "into the barcode catalog")
+    parser.add_argument("dump")
+    parser.add_argument("db_uri", nargs="?", default=DEFAULT_DB)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore saved progress, start from the top")
+    args = parser.parse_args()
+
+    stats = import_products(create_engine(args.db_uri), args.dump,
+                            args.chunk_size, resume=not args.restart)
+    if stats["resumed_at"]:
+        print "Resumed after {} products".format(stats["resumed_at"])
+    print "{read} read, {imported} imported, {skipped} skipped in " \
+          "{seconds:.1f} s".format(**stats)
@@ -0,0 +1,377 @@
+"""Benchmarks for Remote Pantry
+
+Runs against a scratch database, everything in it gets dropped!
+(must have 'createdb benchdb' already)
+
+    python benchmarks.py restock [db_uri]
+    python benchmarks.py delivery          (no db needed)
+    python benchmarks.py login [db_uri]
+    python benchmarks.py rehash [db_uri]
+    python benchmarks.py tests             (uses the test databases)
+    python benchmarks.py suggest [db_uri]
+    python benchmarks.py startup [db_uri]
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from server import create_app
+from tablesetup import User, Foodstuff, Location, db
+from pantry_functions import refilled, to_refill
+from pantry_cache import LocalLRUBackend
+from bulk_load import insert_rows, FOOD_NAMES
+from migrations import upgrade, schema_migrations
+import pantry_cache
+import suggestions
+from fake_yelp import FakeYelp
+from percentiles import percentile, median
+import delivery_search
+import passwords
+import parallel_tests
+
+BENCH_DB = "postgresql:///benchdb"
+
+
+def timed(func, *args, **kwargs):
+    """Runs func, returns (result, seconds taken, number of SQL statements)"""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        event.remove(Engine, "before_cursor_execute", record)
+    return result, elapsed, len(statements)
+
+def fresh_db(db_uri):
+    """Build the app on db_uri and give it empty tables, made by the
+       migrations like production's, returns the app"""
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": db_uri, "TESTING": True})
+    db.drop_all()
+    schema_migrations.drop(bind=db.engine, checkfirst=True)
+    upgrade(db.engine)
+    return app
+
+def make_bench_user(username="bench", pword="not a real hash"):
+    """Adds a user with one location, returns (user_id, location_id)"""
+
+    user = User(username=username, pword=pword, fname="bench",
+                lname="mark", email="bench@example.com")
+    db.session.add(user)
+    db.session.flush()
+    loc = Location(user_id=user.user_id, location_name="Fridge")
+    db.session.add(loc)
+    db.session.commit()
+    return user.user_id, loc.location_id
+
+###############################################################################
+"""Benchmarks"""
+
+def bench_restock(db_uri=BENCH_DB, sizes=(10, 50, 200, 1000), repeats=5):
+    """Checkout latency of refilled() as the shopping list grows. Every item
+       on the page is refilled, half of them with a new exp typed in."""
+
+    fresh_db(db_uri)
+    user_id, loc_id = make_bench_user()
+
+    print "{:>8} {:>12} {:>10}".format("items", "median ms", "queries")
+    for size in sizes:
+        Foodstuff.query.filter_by(user_id=user_id).delete()
+        db.session.add_all([Foodstuff(user_id=user_id, name="item {}".format(i),
+                                      location_id=loc_id, is_shopping=True,
+                                      exp=(i % 10) or None)
+                            for i in range(size)])
+        db.session.commit()
+
+        pan_id = [str(pantry_id) for pantry_id, in
+                  db.session.query(Foodstuff.pantry_id)
+                            .filter_by(user_id=user_id)]
+        exp = [str(i) if i % 2 else "" for i in range(size)]
+
+        times = []
+        for _ in range(repeats):
+            to_refill(user_id, pan_id)
+            updated, elapsed, queries = timed(refilled, user_id, pan_id,
+                                              exp, pan_id)
+            assert updated == size
+            times.append(elapsed)
+
+        print "{:>8} {:>12.2f} {:>10}".format(size, median(times) * 1000,
+                                             queries)
+
+    db.session.remove()
+
+def bench_delivery(users=60, cells=3, waves=3, delays=(0.05, 0.5, 3)):
+    """Waves of users in a few neighbourhoods hit /callyelp at the same
+       moment, against a local fake yelp with delay seconds of injected
+       latency. Each wave is somewhere new (no cache hits between waves).
+       Shows upstream calls after coalescing, degraded answers and latency;
+       with a slow yelp the breaker should open and later waves fail fast."""
+
+    app = create_app({"TESTING": True})
+    print "{:>8} {:>5} {:>6} {:>9} {:>9} {:>8} {:>8} {:>8}".format(
+          "delay s", "wave", "users", "upstream", "degraded", "p50 ms",
+          "p95 ms", "max ms")
+
+    for delay in delays:
+        yelp = FakeYelp(delay=delay)
+        os.environ["YELP_API_URL"] = yelp.url
+        delivery_search.cache = LocalLRUBackend()
+        delivery_search.breaker = delivery_search.CircuitBreaker()
+        delivery_search.bulkhead = delivery_search.Bulkhead()
+
+        for wave in range(waves):
+            calls_before = yelp.calls
+            latencies, degraded = run_delivery_wave(app, users, cells, wave)
+            print "{:>8} {:>5} {:>6} {:>9} {:>9} {:>8.0f} {:>8.0f} {:>8.0f}".format(
+                  delay, wave + 1, users, yelp.calls - calls_before,
+                  len(degraded), percentile(latencies, 50) * 1000,
+                  percentile(latencies, 95) * 1000, max(latencies) * 1000)
+        yelp.stop()
+
+    del os.environ["YELP_API_URL"]
+
+def run_delivery_wave(app, users, cells, wave):
+    """One burst of users all posting to /callyelp at once, returns
+       (list of latencies, list of users who got a degraded answer)"""
+
+    latencies = []
+    degraded = []
+    start_line = threading.Event()
+
+    def user(i):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+        # a few users per cell, spread out inside it
+        where = {'lat': 37.70 + wave * 0.1 + (i % cells) * 0.01 + (i % 7) * 0.0005,
+                 'lon': -122.40 - (i % 7) * 0.0005}
+        start_line.wait()
+        start = time.time()
+        result = client.post("/callyelp", data=where)
+        latencies.append(time.time() - start)
+        if '"degraded"' in result.data:
+            degraded.append(i)
+
+    threads = [threading.Thread(target=user, args=(i,)) for i in range(users)]
+    for thread in threads:
+        thread.start()
+    start_line.set()
+    for thread in threads:
+        thread.join()
+
+    return latencies, degraded
+
+def bench_login(db_uri=BENCH_DB, login_threads=12, logins_each=4,
+                viewers=3):
+    """Login surge: login_threads users log in over and over while viewers
+       keep loading /pantry. Run with bcrypt inline in the request thread,
+       then with the hashing pool. Shows login throughput and latency, and
+       how much the surge slows down everyone else's page views."""
+
+    app = fresh_db(db_uri)
+    user_id, loc_id = make_bench_user(pword=passwords.hash_password("bench"))
+
+    print "{:>7} {:>9} {:>6} {:>10} {:>10} {:>10} {:>10}".format(
+          "hashing", "logins/s", "busy", "login p50", "login p95",
+          "page p50", "page p95")
+
+    for mode in ("inline", "pool"):
+        if mode == "pool":
+            passwords.start()
+
+        login_times, page_times, busy = [], [], []
+        surge_over = threading.Event()
+
+        def log_in():
+            client = app.test_client()
+            for _ in range(logins_each):
+                start = time.time()
+                result = client.post("/login_handle", follow_redirects=False,
+                                     data={'username': 'bench',
+                                           'password': 'bench'})
+                login_times.append(time.time() - start)
+                if result.location and result.location.endswith("/"):
+                    busy.append(1)
+
+        def view_pages():
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['user_id'] = user_id
+            while not surge_over.is_set():
+                start = time.time()
+                client.get("/pantry")
+                page_times.append(time.time() - start)
+
+        loggers = [threading.Thread(target=log_in) for _ in range(login_threads)]
+        lookers = [threading.Thread(target=view_pages) for _ in range(viewers)]
+        start = time.time()
+        for thread in loggers + lookers:
+            thread.start()
+        for thread in loggers:
+            thread.join()
+        elapsed = time.time() - start
+        surge_over.set()
+        for thread in lookers:
+            thread.join()
+
+        passwords.stop()
+        print "{:>7} {:>9.1f} {:>6} {:>10.0f} {:>10.0f} {:>10.0f} {:>10.0f}".format(
+              mode, len(login_times) / elapsed, len(busy),
+              percentile(login_times, 50) * 1000,
+              percentile(login_times, 95) * 1000,
+              percentile(page_times, 50) * 1000,
+              percentile(page_times, 95) * 1000)
+
+    db.session.remove()
+
+def bench_rehash(db_uri=BENCH_DB, costs=(8, 10, 12), users_per_cost=5,
+                 logins_each=3):
+    """Users whose hashes were made at different costs log in a few times.
+       The first login at a lower cost schedules a rehash to ROUNDS, later
+       ones pay the current cost. Higher costs are kept. Prints login latency and rehash counts
+       per cost level."""
+
+    app = fresh_db(db_uri)
+    for cost in costs:
+        hashed = passwords.bcrypt_hash("bench", cost)
+        for i in range(users_per_cost):
+            make_bench_user("bench{}_{}".format(cost, i), hashed)
+
+    passwords.stats.clear()
+    expected = sum(users_per_cost for cost in costs
+                   if cost < passwords.ROUNDS)
+    client = app.test_client()
+    for _ in range(logins_each):
+        for cost in costs:
+            for i in range(users_per_cost):
+                client.post("/login_handle",
+                            data={'username': "bench{}_{}".format(cost, i),
+                                  'password': 'bench'})
+        # let the background rehashes land before the next round
+        deadline = time.time() + 30
+        while (passwords.stats[passwords.ROUNDS]["rehashes"] < expected and
+               time.time() < deadline):
+            time.sleep(0.05)
+
+    print "current ROUNDS = {}".format(passwords.ROUNDS)
+    for line in passwords.report():
+        print line
+
+    db.session.remove()
+
+
+def bench_tests(workers=(1, 2, 4), repeats=3):
+    """Wall clock time of the whole test suite, at each number of workers"""
+
+    print "{:>8} {:>10} {:>10}".format("workers", "median s", "passed")
+    for count in workers:
+        runs = [parallel_tests.run(count, verbose=False)
+                for _ in range(repeats)]
+        print "{:>8} {:>10.1f} {:>10}".format(
+              count, median([elapsed for passed, elapsed in runs]),
+              str(all(passed for passed, elapsed in runs)))
+
+def bench_suggest(db_uri=BENCH_DB, sizes=(1000, 10000, 50000)):
+    """Type-ahead for a user with a long history: the first keystroke
+       builds the user's name index, every one after is answered from it"""
+
+    fresh_db(db_uri)
+    user_id, loc_id = make_bench_user()
+    # Every prefix of a few words, as they'd be typed
+    typed = [word[:end] for word in ("milk", "chicken", "yoghurt", "crm",
+                                     "peanut butter", "zzz")
+             for end in range(1, len(word) + 1)]
+
+    print "{:>8} {:>8} {:>10} {:>8} {:>8} {:>8}".format(
+          "items", "names", "build ms", "queries", "p50 ms", "p99 ms")
+    done = 0
+    for size in sizes:
+        # Some names come back again and again, most are one-offs
+        rows = ((user_id, "{} {}".format(FOOD_NAMES[i % len(FOOD_NAMES)],
+                                         i % (size // 4)), loc_id)
+                for i in range(done, size))
+        insert_rows(db.session, Foodstuff.__table__,
+                    ["user_id", "name", "location_id"], rows)
+        db.session.commit()
+        done = size
+
+        pantry_cache.configure()
+        index, build, queries = timed(suggestions.user_index, user_id)
+        suggestions.rebuild_popular()
+
+        times = []
+        for _ in range(20):
+            for query in typed:
+                result, elapsed, _ = timed(suggestions.suggest, user_id, query, 8)
+                times.append(elapsed)
+        print "{:>8} {:>8} {:>10.1f} {:>8} {:>8.3f} {:>8.3f}".format(
+              size, len(index), build * 1000, queries,
+              percentile(times, 50) * 1000, percentile(times, 99) * 1000)
+
+    db.session.remove()
+
+# One cold start, in a new interpreter so nothing is imported yet. Prints
+# seconds for import, create_app, warmup and the first request.
+STARTUP_SCRIPT = """
+import sys, time
+start = time.time()
+import server
+imported = time.time()
+app = server.create_app({"SQLALCHEMY_DATABASE_URI": sys.argv[1]})
+built = time.time()
+if sys.argv[2] == "warm":
+    server.warmup(app)
+warm = time.time()
+app.test_client().get("/")
+done = time.time()
+print imported - start, built - imported, warm - built, done - warm
+"""
+
+def bench_startup(db_uri=BENCH_DB, repeats=5):
+    """Worker cold start: import, create_app, warmup and the first request
+       (the homepage), with and without warmup. Medians of repeats
+       runs, each in a new interpreter."""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    print "{:>6} {:>10} {:>12} {:>10} {:>14} {:>10}".format(
+          "mode", "import ms", "create_app ms", "warmup ms",
+          "first req ms", "total ms")
+    for mode in ("cold", "warm"):
+        runs = []
+        for _ in range(repeats):
+            output = subprocess.check_output([sys.executable, "-c",
+                                              STARTUP_SCRIPT, db_uri, mode],
+                                             cwd=here)
+            runs.append([float(seconds) for seconds in output.split()])
+        steps = [median([run[i] for run in runs]) * 1000 for i in range(4)]
+        print "{:>6} {:>10.0f} {:>12.0f} {:>10.0f} {:>14.1f} {:>10.0f}".format(
+              mode, steps[0], steps[1], steps[2], steps[3], sum(steps))
+
+
+BENCHMARKS = {"restock": bench_restock, "delivery": bench_delivery,
+              "login": bench_login, "rehash": bench_rehash,
+              "tests": bench_tests, "suggest": bench_suggest,
+              "startup": bench_startup}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print "usage: python benchmarks.py [{}] [db_uri]".format(
+              "|".join(sorted(BENCHMARKS)))
+        sys.exit(1)
+
+    args = sys.argv[2:3]
+    BENCHMARKS[sys.argv[1]](*args)
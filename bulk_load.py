@@ -0,0 +1,239 @@
+"""Bulk loading and synthetic data for Remote Pantry
+
+Rows are streamed, never held in memory all at once. On PostgreSQL they go
+in through COPY; anything else gets batched multi-row INSERTs.
+
+Make a realistic-size dataset (deterministic for a given --seed and day):
+
+    python bulk_load.py --users 100000 --locations-per-user 10 \\
+                        --foods-per-user 100 postgresql:///loadtest
+
+Every synthetic user's password is "password", hashed once up front.
+Prints rows per second for each table. Tables are created if missing, but
+the synthetic ids start at 1, so load into an empty database.
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import random
+import time
+
+from sqlalchemy import create_engine
+
+from tablesetup import User, Foodstuff, Location, db, expiry
+from migrations import upgrade
+from passwords import hash_password
+
+BATCH_SIZE = 5000
+PASSWORD = "password"
+
+LOCATION_NAMES = ["Fridge", "Freezer", "Cupboard", "Spice Rack", "Pantry",
+                  "Bread Box", "Fruit Bowl", "Wine Rack", "Garage", "Cellar"]
+FOOD_NAMES = ["milk", "eggs", "butter", "cheese", "yogurt", "bread", "rice",
+              "pasta", "flour", "sugar", "salt", "peppercorns", "cumin",
+              "paprika", "oregano", "apples", "bananas", "kiwi", "celery",
+              "carrots", "onions", "garlic", "potatoes", "spinach", "lettuce",
+              "tomatoes", "chicken", "ground beef", "salmon", "tofu",
+              "frozen peas", "ice cream", "coffee", "tea", "olive oil",
+              "soy sauce", "ketchup", "mustard", "jam", "peanut butter",
+              "oats", "cereal", "beans", "lentils", "tortillas", "salsa",
+              "orange juice", "sparkling water", "chocolate", "crackers"]
+
+###############################################################################
+"""Synthetic rows, as tuples in the order of the *_COLUMNS lists"""
+
+USER_COLUMNS = ["user_id", "username", "pword", "fname", "lname",
+                "date_created", "email", "time_zone", "is_active"]
+LOCATION_COLUMNS = ["location_id", "user_id", "location_name"]
+FOOD_COLUMNS = ["pantry_id", "user_id", "name", "is_shopping", "is_pantry",
+                "last_purch", "first_add", "location_id", "exp", "expires_at"]
+
+
+def synthetic_users(count, pword_hash, now, seed=0):
+    """count users, all with the same password hash"""
+
+    rand = random.Random(seed)
+    for user_id in range(1, count + 1):
+        yield (user_id, "user{}".format(user_id), pword_hash, "Synthetic",
+               "User {}".format(user_id),
+               now - timedelta(days=rand.randint(0, 3 * 365)),
+               "user{}@example.com".format(user_id),
+               rand.choice([-10, -8, -8, -8, -7, -6, -5, -5, 0, 1]), True)
+
+def synthetic_locations(users, per_user):
+    """per_user locations for each user, location ids are
+       (user_id - 1) * per_user + 1 .. user_id * per_user"""
+
+    for user_id in range(1, users + 1):
+        for i in range(per_user):
+            name = LOCATION_NAMES[i % len(LOCATION_NAMES)]
+            if i >= len(LOCATION_NAMES):
+                name = "{} {}".format(name, i // len(LOCATION_NAMES) + 1)
+            yield ((user_id - 1) * per_user + i + 1, user_id, name)
+
+def synthetic_foods(users, locations_per_user, per_user, now, seed=0):
+    """per_user foodstuffs for each user. Roughly: 70% in the pantry, 10%
+       on the shopping list (some of those also in the pantry), the rest
+       history. 60% have an exp, mostly short. Bought in the last year,
+       recent purchases more likely."""
+
+    rand = random.Random(seed + 1)
+    pantry_id = 0
+    for user_id in range(1, users + 1):
+        first_loc = (user_id - 1) * locations_per_user + 1
+        for _ in range(per_user):
+            pantry_id += 1
+            status = rand.random()
+            is_pantry = status < 0.7
+            is_shopping = 0.65 < status < 0.8
+
+            days_ago = min(int(rand.expovariate(1 / 30.0)), 365)
+            last_purch = now - timedelta(days=days_ago,
+                                         seconds=rand.randint(0, 86399))
+            first_add = last_purch - timedelta(days=rand.choice([0, 0, 0, 7, 30, 90]))
+
+            exp = None
+            if rand.random() < 0.6:
+                exp = rand.choice([3, 5, 7, 7, 10, 14, 14, 30, 60, 180, 365])
+
+            yield (pantry_id, user_id, rand.choice(FOOD_NAMES), is_shopping,
+                   is_pantry, last_purch, first_add,
+                   first_loc + rand.randrange(locations_per_user), exp,
+                   expiry(last_purch, exp))
+
+###############################################################################
+"""Loaders"""
+
+def copy_value(value):
+    """One value in COPY text format"""
+
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    value = unicode(value)
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+                 .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+class CopyStream(object):
+    """File-like object that COPY reads from, turns rows into text lines only
+       as fast as they're read, so memory use stays flat"""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ""
+        self.count = 0
+
+    def read(self, size=65536):
+        while len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            self.buffer += ("\t".join(copy_value(value) for value in row) +
+                            "\n").encode("utf8")
+            self.count += 1
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    readline = read
+
+
+def copy_rows(engine, table, columns, rows):
+    """Stream rows into table with PostgreSQL COPY, returns row count"""
+
+    conn = engine.raw_connection()
+    try:
+        stream = CopyStream(rows)
+        cursor = conn.cursor()
+        cursor.copy_expert("COPY {} ({}) FROM STDIN".format(
+                           table.name, ", ".join(columns)), stream)
+        conn.commit()
+        return stream.count
+    finally:
+        conn.close()
+
+def insert_rows(bind, table, columns, rows, batch_size=BATCH_SIZE):
+    """Batched multi-row INSERTs, returns row count. Works on any database.
+       bind is an engine (each batch commits) or a session (you commit)."""
+
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(dict(zip(columns, row)))
+        if len(batch) >= batch_size:
+            bind.execute(table.insert().values(batch))
+            count += len(batch)
+            batch = []
+    if batch:
+        bind.execute(table.insert().values(batch))
+        count += len(batch)
+    return count
+
+def load_rows(engine, table, columns, rows):
+    """COPY on PostgreSQL, batched INSERTs elsewhere"""
+
+    if engine.dialect.name == "postgresql":
+        return copy_rows(engine, table, columns, rows)
+    return insert_rows(engine, table, columns, rows)
+
+def reset_sequences(engine):
+    """Rows came in with explicit ids, move serial sequences past them"""
+
+    if engine.dialect.name != "postgresql":
+        return
+    for table, column in [("users", "user_id"), ("locations", "location_id"),
+                          ("foodstuffs", "pantry_id")]:
+        engine.execute("SELECT setval(pg_get_serial_sequence('{0}', '{1}'), "
+                       "COALESCE(MAX({1}), 0) + 1, false) FROM {0}"
+                       .format(table, column))
+
+def load_synthetic(engine, users, locations_per_user, foods_per_user, seed=0,
+                   now=None, verbose=True):
+    """Generate and load the whole dataset, returns {table: (rows, secs)}"""
+
+    if now is None:
+        # Midnight today, so the same seed gives the same data all day
+        now = datetime.utcnow().replace(hour=0, minute=0, second=0,
+                                        microsecond=0)
+    # One hash for everyone, bcrypt per user would take days
+    pword_hash = hash_password(PASSWORD)
+
+    # Same schema as production gets it: the migrations, not create_all()
+    upgrade(engine)
+
+    results = {}
+    for table, columns, rows in [
+            (User.__table__, USER_COLUMNS,
+             synthetic_users(users, pword_hash, now, seed)),
+            (Location.__table__, LOCATION_COLUMNS,
+             synthetic_locations(users, locations_per_user)),
+            (Foodstuff.__table__, FOOD_COLUMNS,
+             synthetic_foods(users, locations_per_user, foods_per_user, now,
+                             seed))]:
+        start = time.time()
+        count = load_rows(engine, table, columns, rows)
+        elapsed = time.time() - start
+        results[table.name] = (count, elapsed)
+        if verbose:
+            print "{:>12} {:>10} rows {:>8.1f} s {:>10.0f} rows/s".format(
+                  table.name, count, elapsed, count / max(elapsed, 1e-6))
+
+    reset_sequences(engine)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load synthetic pantry data")
+    parser.add_argument("db_uri", nargs="?", default="postgresql:///pantry")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--locations-per-user", type=int, default=10)
+    parser.add_argument("--foods-per-user", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_synthetic(create_engine(args.db_uri), args.users,
+                   args.locations_per_user, args.foods_per_user, args.seed)
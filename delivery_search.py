@@ -0,0 +1,268 @@
+"""Yelp delivery search for the take-out page (/callyelp)
+
+All calls go through one pooled requests.Session (keep-alive, no TLS
+handshake per click) with strict connect/read timeouts. Results are cached
+by geo cell: lat/lon rounded to CELL_PRECISION decimal places (~1.1 km at 2),
+and Yelp is asked about the middle of the cell, so everyone nearby shares
+one cached answer. The cache holds the already slimmed yelpList.
+
+Under load: identical lookups already in flight are coalesced (one upstream
+call answers every waiter), at most MAX_CONCURRENT upstream calls run at once
+(a bulkhead, so a slow Yelp can't tie up every worker), and a circuit breaker
+stops calling Yelp for a while after repeated failures or slow calls, so
+requests fail fast with a degraded (empty) answer instead of queueing.
+
+YELP_API_URL can point somewhere else, e.g. a local stub server for tests.
+"""
+
+import os
+import threading
+import time
+
+from pantry_cache import LocalLRUBackend
+
+YELP_URL = "https://api.yelp.com/v3/transactions/delivery/search"
+# seconds to connect, seconds to wait for the response
+TIMEOUT = (2, 5)
+POOL_SIZE = 10
+CELL_PRECISION = 2
+CACHE_TTL = 10 * 60
+CACHE_SIZE = 1024
+# Bulkhead: upstream calls at once, seconds to wait for a free slot
+MAX_CONCURRENT = 4
+MAX_WAIT = 1
+# Breaker: open after this many failures in a row (calls slower than
+# SLOW_CALL seconds count as failures), try again after RESET_AFTER seconds
+FAILURE_THRESHOLD = 5
+SLOW_CALL = 2
+RESET_AFTER = 30
+
+
+class DeliverySearchError(Exception):
+    """Yelp couldn't be reached, timed out or sent back garbage"""
+
+
+class DeliverySearchBusy(DeliverySearchError):
+    """Too many upstream calls already running, didn't wait any longer"""
+
+
+class CircuitOpen(DeliverySearchError):
+    """Yelp has been failing, not calling it for now"""
+
+###############################################################################
+"""Load protection"""
+
+class SingleFlight(object):
+    """Runs func once per key at a time, concurrent callers with the same key
+       wait for that run and all get its result (or its exception)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"done": threading.Event()}
+
+        if not leader:
+            call["done"].wait()
+        else:
+            try:
+                call["result"] = func()
+            except Exception as e:
+                call["error"] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call["done"].set()
+
+        if "error" in call:
+            raise call["error"]
+        return call["result"]
+
+
+class Bulkhead(object):
+    """Counting semaphore whose acquire gives up after max_wait seconds"""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_wait=MAX_WAIT):
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self.active = 0
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        deadline = time.time() + self.max_wait
+        with self.cond:
+            while self.active >= self.max_concurrent:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DeliverySearchBusy("too many searches in flight")
+                self.cond.wait(remaining)
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+
+class CircuitBreaker(object):
+    """Closed: calls go through. After failure_threshold failures in a row it
+       opens: no calls at all for reset_after seconds. Then one trial call is
+       let through (half open), success closes it, failure opens it again."""
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD,
+                 reset_after=RESET_AFTER, slow_call=SLOW_CALL):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.slow_call = slow_call
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at < self.reset_after:
+            return "open"
+        return "half open"
+
+    def allow(self):
+        """Returns True if a call may go ahead"""
+
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def cancel(self):
+        """The call allow() said yes to didn't happen after all"""
+
+        with self.lock:
+            self.trial_running = False
+
+    def record(self, ok, elapsed=0):
+        """Report how a call went"""
+
+        with self.lock:
+            self.trial_running = False
+            if ok and elapsed < self.slow_call:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if (self.failures >= self.failure_threshold or
+                        self.opened_at is not None):
+                    self.opened_at = time.time()
+
+
+cache = LocalLRUBackend(CACHE_SIZE)
+in_flight = SingleFlight()
+bulkhead = Bulkhead()
+breaker = CircuitBreaker()
+http = None
+
+def get_http():
+    """The shared, pooled session, made on first use"""
+
+    global http
+    if http is None:
+        # Only the take-out page needs requests, don't import it up front
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        http = requests.Session()
+        # No retries, a slow upstream shouldn't hold the worker even longer
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE,
+                              max_retries=0)
+        http.mount("http://", adapter)
+        http.mount("https://", adapter)
+    return http
+
+def geo_cell(lat, lon, precision=CELL_PRECISION):
+    """Takes lat and lon, returns (lat, lon) of the cell they fall in"""
+
+    return round(lat, precision), round(lon, precision)
+
+def slim(response_dict):
+    """Yelp response to the flat list the page wants:
+       [name, url, rating, category, name, url, ...]"""
+
+    pass_lst = []
+    for resto in response_dict['businesses']:
+        pass_lst.append(resto['name'])
+        pass_lst.append(resto['url'])
+        pass_lst.append(resto['rating'])
+        pass_lst.append(resto['categories'][0]['title'])
+    return pass_lst
+
+def fetch(cell):
+    """Ask Yelp about a geo cell, returns slimmed list. Raises
+       DeliverySearchError if that doesn't work out, whatever the reason
+       (the breaker has to hear about every failure)."""
+
+    url = os.environ.get("YELP_API_URL", YELP_URL)
+    payload = {'latitude': cell[0], 'longitude': cell[1]}
+    headers = {'Authorization': 'Bearer %s' % os.environ.get('YELP_KEY', '')}
+
+    try:
+        req = get_http().get(url, params=payload, headers=headers,
+                             timeout=TIMEOUT)
+        req.raise_for_status()
+        return slim(req.json())
+    except Exception as e:
+        # Network, HTTP status, or a payload that isn't shaped like we
+        # expect ("categories": null is a TypeError in slim)
+        raise DeliverySearchError(str(e))
+
+def guarded_fetch(cell, key):
+    """fetch, inside the bulkhead, reporting to the breaker, then cached"""
+
+    # Someone may have filled the cache while we were queued up
+    yelp_list = cache.get(key)
+    if yelp_list is not None:
+        return yelp_list
+
+    if not breaker.allow():
+        raise CircuitOpen("yelp is failing, not calling it for now")
+
+    try:
+        with bulkhead:
+            start = time.time()
+            yelp_list = fetch(cell)
+    except DeliverySearchBusy:
+        # Never got to call yelp, that says nothing about how it's doing
+        breaker.cancel()
+        raise
+    except DeliverySearchError:
+        breaker.record(False)
+        raise
+    breaker.record(True, time.time() - start)
+
+    cache.set(key, yelp_list, CACHE_TTL)
+    return yelp_list
+
+def search(lat, lon):
+    """Takes lat and lon, returns slimmed list of delivery restaurants near
+       there, from the cache if someone in the same cell asked recently.
+       Raises DeliverySearchError (or the Busy/CircuitOpen kinds) if there's
+       no answer to give."""
+
+    cell = geo_cell(lat, lon)
+    key = "yelp:{}:{}".format(*cell)
+
+    yelp_list = cache.get(key)
+    if yelp_list is None:
+        # Concurrent lookups of the same cell share one upstream call
+        yelp_list = in_flight.do(key, lambda: guarded_fetch(cell, key))
+    return yelp_list
@@ -0,0 +1,370 @@
+"""Daily expiry digests: one email per user listing what's about to expire
+
+    python digest.py                        # postgresql:///pantry, SMTP on localhost:25
+    python digest.py --smtp mail.example.com:587 --workers 8
+    python digest.py --sink                 # deliver to a local SMTP sink instead
+    python digest.py --dry-run              # render only
+
+Everyone's expiring items come out of one query (a range scan on
+ix_foodstuffs_expires) ordered by user, read from a server-side cursor
+chunk_size rows at a time and grouped into one digest per user. Digests are
+rendered and sent batch_size at a time across a process pool, so memory stays
+the same whatever the number of users.
+
+After each batch the last user id done (and any that failed) is written to
+the checkpoint file. Running again the same day picks up after it, failed
+users included, instead of mailing everyone twice.
+"""
+
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from itertools import groupby
+import argparse
+import asyncore
+import email
+import json
+import logging
+import math
+import multiprocessing
+import os
+import smtpd
+import smtplib
+import threading
+import time
+
+from jinja2 import Environment, FileSystemLoader, StrictUndefined
+from sqlalchemy import create_engine, select, and_
+
+from tablesetup import User, Foodstuff, Location
+
+DEFAULT_DB = "postgresql:///pantry"
+DEFAULT_CHECKPOINT = "digest.checkpoint.json"
+FROM_ADDR = os.environ.get("PANTRY_MAIL_FROM", "pantry@localhost")
+# Items expiring within this many hours make it into the digest
+WINDOW_HOURS = 48
+# Rows per fetch from the server-side cursor
+CHUNK_SIZE = 2000
+# Digests handed to the pool at a time, and checkpointed after
+BATCH_SIZE = 500
+# Items listed per digest, past this they're counted only
+MAX_ITEMS = 50
+
+log = logging.getLogger("pantry.digest")
+templates = Environment(loader=FileSystemLoader(
+                            os.path.join(os.path.dirname(__file__), "templates")),
+                        undefined=StrictUndefined)
+
+###############################################################################
+"""Reading: one streaming query, grouped by user"""
+
+def expiring_rows(conn, now, hours=WINDOW_HOURS, after_user=0, retry=(),
+                  chunk_size=CHUNK_SIZE):
+    """Yields a row per in-pantry item expiring in the next hours, for active
+       users with an id past after_user (or in retry), ordered by user then
+       expiry. Server-side cursor, chunk_size rows per round trip."""
+
+    users = User.__table__
+    foods = Foodstuff.__table__
+    locations = Location.__table__
+
+    user_filter = users.c.user_id > after_user
+    if retry:
+        user_filter = user_filter | users.c.user_id.in_(list(retry))
+
+    query = select([users.c.user_id, users.c.fname, users.c.email,
+                    users.c.time_zone, foods.c.name, locations.c.location_name,
+                    foods.c.expires_at])\
+            .select_from(foods.join(users, users.c.user_id == foods.c.user_id)
+                              .outerjoin(locations, locations.c.location_id ==
+                                                    foods.c.location_id))\
+            .where(and_(foods.c.is_pantry == True,
+                        foods.c.expires_at >= now,
+                        foods.c.expires_at < now + timedelta(hours=hours),
+                        users.c.is_active == True,
+                        user_filter))\
+            .order_by(users.c.user_id, foods.c.expires_at, foods.c.pantry_id)
+
+    result = conn.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+def user_digests(rows, max_items=MAX_ITEMS):
+    """Groups rows (in user order) into one dict per user"""
+
+    for user_id, user_rows in groupby(rows, lambda row: row.user_id):
+        digest = None
+        for row in user_rows:
+            if digest is None:
+                digest = {"user_id": user_id, "fname": row.fname,
+                          "email": row.email, "time_zone": row.time_zone,
+                          "items": [], "count": 0}
+            digest["count"] += 1
+            if len(digest["items"]) < max_items:
+                digest["items"].append((row.name, row.location_name,
+                                        row.expires_at))
+        yield digest
+
+def batches(iterable, size):
+    """Lists of up to size things at a time"""
+
+    batch = []
+    for thing in iterable:
+        batch.append(thing)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+###############################################################################
+"""Rendering and sending, in the pool's workers"""
+
+def when(expires_at, time_zone, now):
+    """Same days left as the Eat Me page, in words"""
+
+    seconds = (expires_at + timedelta(hours=time_zone) - now).total_seconds()
+    days_left = int(math.floor(seconds / 86400))
+    if days_left <= 0:
+        return "today"
+    if days_left == 1:
+        return "tomorrow"
+    return "in {} days".format(days_left)
+
+def render(digest, now):
+    """Takes a digest, returns the email for it"""
+
+    items = [(name, location, when(expires_at, digest["time_zone"], now))
+             for name, location, expires_at in digest["items"]]
+    body = templates.get_template("digest.txt").render(
+           fname=digest["fname"], count=digest["count"], items=items,
+           more=digest["count"] - len(items))
+
+    msg = MIMEText(body.encode("utf-8"), "plain", "utf-8")
+    msg["Subject"] = "{} item{} in your pantry expiring soon".format(
+                     digest["count"], "s" if digest["count"] != 1 else "")
+    msg["From"] = FROM_ADDR
+    msg["To"] = digest["email"]
+    return msg
+
+# Set in each worker process by init_worker
+worker_sender = None
+worker_now = None
+
+def init_worker(sender, now):
+    global worker_sender, worker_now
+    worker_sender = sender
+    worker_now = now
+
+def deliver(digest):
+    """Render and send one digest, returns (user_id, error or None). Errors
+       are handed back rather than raised so one bad address doesn't stop
+       the batch."""
+
+    try:
+        worker_sender.send(render(digest, worker_now))
+        return digest["user_id"], None
+    except Exception as e:
+        return digest["user_id"], "{}: {}".format(type(e).__name__, e)
+
+
+class NullSender(object):
+    """Sends nothing, for --dry-run"""
+
+    def send(self, msg):
+        pass
+
+    def close(self):
+        pass
+
+
+class SmtpSender(object):
+    """Sends over SMTP. Each process opens its own connection on first use
+       and keeps it for the rest of its messages."""
+
+    def __init__(self, host="localhost", port=25):
+        self.host = host
+        self.port = port
+        self.smtp = None
+
+    def __getstate__(self):
+        # Connections don't cross processes, workers make their own
+        return {"host": self.host, "port": self.port, "smtp": None}
+
+    def send(self, msg):
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.host, self.port)
+        try:
+            self.smtp.sendmail(msg["From"], [msg["To"]], msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            # Server hung up on an idle connection, once more on a new one
+            self.smtp = smtplib.SMTP(self.host, self.port)
+            self.smtp.sendmail(msg["From"], [msg["To"]], msg.as_string())
+
+    def close(self):
+        if self.smtp is not None:
+            self.smtp.quit()
+            self.smtp = None
+
+
+class SmtpSink(smtpd.SMTPServer):
+    """Local SMTP server that keeps whatever it's sent, for testing:
+
+        sink = SmtpSink()
+        run(engine, SmtpSender(*sink.address))
+        sink.messages     # email.message.Message objects
+    """
+
+    def __init__(self, host="localhost", port=0):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.address = self.socket.getsockname()
+        self.messages = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={"timeout": 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        with self.lock:
+            self.messages.append(email.message_from_string(data))
+
+    def stop(self):
+        self.close()
+
+###############################################################################
+"""Checkpoints"""
+
+def load_checkpoint(path, run_id):
+    """Returns (last user id done, set of failed user ids) for this run,
+       (0, empty set) if there's no checkpoint or it's from another run"""
+
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (IOError, ValueError):
+        return 0, set()
+    if checkpoint.get("run") != run_id:
+        return 0, set()
+    return checkpoint["last_user_id"], set(checkpoint["failed"])
+
+def save_checkpoint(path, run_id, last_user_id, failed):
+    """Written to a temp file and renamed, so a crash mid-write can't
+       leave a half checkpoint"""
+
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"run": run_id, "last_user_id": last_user_id,
+                   "failed": sorted(failed)}, f)
+    os.rename(tmp, path)
+
+###############################################################################
+"""Runner"""
+
+def run(bind, sender, workers=None, hours=WINDOW_HOURS, now=None,
+        checkpoint=None, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE):
+    """Send every user with items expiring in the next hours their digest.
+       bind is an engine or connection, workers defaults to one per CPU
+       (0: everything in this process). Returns stats dict."""
+
+    now = now or datetime.utcnow()
+    run_id = now.strftime("%Y-%m-%d")
+    last_user_id, failed = 0, set()
+    if checkpoint:
+        last_user_id, failed = load_checkpoint(checkpoint, run_id)
+    retry = set(failed)
+
+    stats = {"digests": 0, "items": 0, "sent": 0, "failed": 0, "batches": 0}
+    pool = None
+    if workers == 0:
+        init_worker(sender, now)
+    else:
+        pool = multiprocessing.Pool(workers or multiprocessing.cpu_count(),
+                                    init_worker, (sender, now))
+
+    start = time.time()
+    conn = bind.connect()
+    try:
+        rows = expiring_rows(conn, now, hours, last_user_id, retry, chunk_size)
+        for batch in batches(user_digests(rows), batch_size):
+            if pool is None:
+                results = map(deliver, batch)
+            else:
+                results = pool.map(deliver, batch)
+
+            for user_id, error in results:
+                if error:
+                    log.warning("digest for user %s failed: %s", user_id, error)
+                    failed.add(user_id)
+                    stats["failed"] += 1
+                else:
+                    failed.discard(user_id)
+                    stats["sent"] += 1
+            stats["digests"] += len(batch)
+            stats["items"] += sum(digest["count"] for digest in batch)
+            stats["batches"] += 1
+
+            last_user_id = max(last_user_id, batch[-1]["user_id"])
+            if checkpoint:
+                save_checkpoint(checkpoint, run_id, last_user_id, failed)
+    finally:
+        conn.close()
+        if pool is None:
+            sender.close()
+        else:
+            pool.close()
+            pool.join()
+
+    stats["seconds"] = time.time() - start
+    return stats
+
+def report(stats):
+    """Prints a run's throughput"""
+
+    seconds = stats["seconds"] or 1e-9
+    print "{digests} digests ({sent} sent, {failed} failed), {items} items, " \
+          "{batches} batches in {seconds:.1f} s".format(**stats)
+    print "{:.0f} digests/s, {:.0f} items/s".format(stats["digests"] / seconds,
+                                                    stats["items"] / seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send expiry digests")
+    parser.add_argument("db_uri", nargs="?", default=DEFAULT_DB)
+    parser.add_argument("--hours", type=int, default=WINDOW_HOURS)
+    parser.add_argument("--workers", type=int,
+                        help="processes to render and send with (0: none)")
+    parser.add_argument("--smtp", default="localhost:25", help="host:port")
+    parser.add_argument("--sink", action="store_true",
+                        help="send to a local SMTP sink instead")
+    parser.add_argument("--dry-run", action="store_true", help="render only")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    sink = None
+    if args.dry_run:
+        sender = NullSender()
+    elif args.sink:
+        sink = SmtpSink()
+        sender = SmtpSender(*sink.address)
+    else:
+        host, port = args.smtp.rsplit(":", 1)
+        sender = SmtpSender(host, int(port))
+
+    stats = run(create_engine(args.db_uri), sender, workers=args.workers,
+                hours=args.hours, checkpoint=args.checkpoint,
+                batch_size=args.batch_size, chunk_size=args.chunk_size)
+    report(stats)
+    if sink is not None:
+        # Give the sink a moment for the last connections' messages
+        time.sleep(0.5)
+        print "sink got {} messages".format(len(sink.messages))
@@ -0,0 +1,92 @@
+"""Local stand-in for the Yelp delivery search, for tests and benchmarks
+
+    server = FakeYelp(delay=0.1)     # starts on a free port, in a thread
+    os.environ["YELP_API_URL"] = server.url
+    ...
+    server.calls                     # how many searches it answered
+    server.payload = {...}           # answer with this instead
+    server.stop()
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import threading
+import time
+import urlparse
+
+
+def fake_businesses(lat, lon):
+    """A couple of restaurants named after where you asked"""
+
+    return {"businesses": [
+        {"name": "Noodles at {},{}".format(lat, lon),
+         "url": "http://example.com/noodles", "rating": 4.5,
+         "categories": [{"title": "Noodles"}]},
+        {"name": "Tacos at {},{}".format(lat, lon),
+         "url": "http://example.com/tacos", "rating": 4.0,
+         "categories": [{"title": "Mexican"}]},
+    ]}
+
+
+class FakeYelpHandler(BaseHTTPRequestHandler):
+    """Answers any GET like the delivery search, after server.delay seconds"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.calls += 1
+        time.sleep(server.delay)
+
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        payload = server.payload
+        if payload is None:
+            payload = fake_businesses(query.get("latitude", ["?"])[0],
+                                      query.get("longitude", ["?"])[0])
+        body = json.dumps(payload)
+        try:
+            self.send_response(server.status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except IOError:
+            # Client gave up waiting (timeout), that's fine
+            pass
+
+    def log_message(self, format, *args):
+        """Keep test output quiet"""
+
+
+class FakeYelp(ThreadingMixIn, HTTPServer):
+    """Threaded stub server, started on construction"""
+
+    daemon_threads = True
+
+    def __init__(self, delay=0, status=200, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeYelpHandler)
+        self.delay = delay
+        self.status = status
+        self.payload = None
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.url = "http://127.0.0.1:{}/v3/transactions/delivery/search".format(
+                   self.server_address[1])
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        """Clients hanging up early (timeouts) are expected, don't print"""
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    # Run by hand: python fake_yelp.py, then YELP_API_URL=<printed url>
+    server = FakeYelp(port=5050)
+    print "Fake Yelp at", server.url
+    server.thread.join()
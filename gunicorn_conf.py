@@ -0,0 +1,88 @@
+"""gunicorn settings for Remote Pantry
+
+    export PANTRY_SECRET_KEY=... PANTRY_CACHE_URL=redis://...
+    gunicorn -c gunicorn_conf.py wsgi:app
+
+Tuned from the environment:
+
+    PANTRY_BIND       address to listen on (127.0.0.1:8000)
+    PANTRY_CACHE_URL  redis://host:6379/0, the cache every worker shares
+                      (needs the redis package, in requirements.txt)
+    PANTRY_WORKERS    processes: 2 per CPU + 1 with PANTRY_CACHE_URL,
+                      otherwise 1. More than one needs the shared cache,
+                      create_app() refuses to start without it.
+    PANTRY_THREADS    threads per process (4)
+    PANTRY_TIMEOUT    seconds before a stuck worker is restarted (30)
+    PANTRY_METRICS_TOKEN  bearer token for /metrics from elsewhere, without
+                      it only local unproxied requests see it
+
+Processes are what make use of the CPUs, threads are for waiting on the db
+and bcrypt without holding up the process. Every process has its own db
+pool, and a process never needs more connections than it has threads, so
+unless they're set PANTRY_DB_POOL_SIZE defaults to the threads and
+PANTRY_DB_MAX_OVERFLOW to 0. The master refuses to start if workers times
+(pool size + overflow) is more than the server's max_connections: 33
+workers of 4 is 132 connections, over postgres' default of 100, so on big
+machines set PANTRY_WORKERS or use pgbouncer (PANTRY_DB_PGBOUNCER=1).
+python loadtest.py --workers N measures what's really needed.
+
+The app is imported once in the master and forked, so workers start with it
+already in memory (shared until written to). Nothing in it connects at
+import; each worker starts its bcrypt processes and warms up (db
+connections, templates) in post_worker_init, before it's given requests.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("PANTRY_BIND", "127.0.0.1:8000")
+# Without a shared cache only one worker can run, see pantry_cache
+if os.environ.get("PANTRY_CACHE_URL"):
+    default_workers = multiprocessing.cpu_count() * 2 + 1
+else:
+    default_workers = 1
+workers = int(os.environ.get("PANTRY_WORKERS", default_workers))
+threads = int(os.environ.get("PANTRY_THREADS", 4))
+# create_app() checks it: more than one worker needs PANTRY_CACHE_URL
+os.environ["PANTRY_WORKERS"] = str(workers)
+# Read by connect_to_db() when the app is loaded
+os.environ.setdefault("PANTRY_DB_POOL_SIZE", str(threads))
+os.environ.setdefault("PANTRY_DB_MAX_OVERFLOW", "0")
+worker_class = "gthread"
+timeout = int(os.environ.get("PANTRY_TIMEOUT", 30))
+preload_app = True
+# Restart workers now and then, so a slow leak can't build up
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def on_starting(server):
+    """In the master, app already loaded: will the workers' pools fit?"""
+
+    from tablesetup import check_max_connections
+
+    check_max_connections(server.app.wsgi(), workers)
+
+def post_fork(server, worker):
+    """The worker inherited the master's startup times, it starts now"""
+
+    import request_metrics
+
+    request_metrics.forked()
+
+def post_worker_init(worker):
+    """In each worker, after the fork and before its first request"""
+
+    from server import warmup
+    import passwords
+
+    # Workers already cover the CPUs, one hashing process each is plenty
+    passwords.start(processes=1)
+    seconds = warmup(worker.wsgi, threads)
+    worker.log.info("worker %s warmed up in %.0f ms", worker.pid,
+                    seconds * 1000)
+
+def worker_exit(server, worker):
+    import passwords
+
+    passwords.stop()
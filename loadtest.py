@@ -0,0 +1,367 @@
+"""HTTP load test for Remote Pantry
+
+Starts the app on a free local port (in this process, threaded), logs in
+synthetic users from bulk_load and has each one click around: pantry,
+shopping list, eat me, history, and the forms that change things. Prints
+requests/sec and p50/p95/p99 latency per route and saves them as JSON.
+
+    python loadtest.py                                  # scratch SQLite db
+    python loadtest.py postgresql:///loadtest --concurrency 20 --duration 60
+    python loadtest.py compare before.json after.json
+    python loadtest.py postgresql:///loadtest --workers 4 --pool-size 3
+
+With the local server, the connection pool is watched too and a pool size
+per worker is suggested for --workers worker processes (see
+tablesetup.POOL_SETTINGS), checked against the server's max_connections.
+
+If the database has no users yet it's filled with bulk_load first (same
+--users/--locations-per-user/--foods-per-user), so use an empty or a
+bulk_load'ed one. --url points at an already running server instead (its
+database has to have been filled the same way). No network needed.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+
+import requests
+
+from percentiles import percentile
+import bulk_load
+
+DEFAULT_DB = "sqlite:////tmp/pantry_loadtest.db"
+
+# route: how often it's picked, relative to the others
+TRAFFIC_MIX = [("GET /pantry", 30), ("GET /shop", 15), ("GET /eatme", 15),
+               ("GET /history", 10), ("POST /update", 10),
+               ("POST /restock", 10), ("POST /api/batch", 10)]
+
+
+class VirtualUser(object):
+    """One logged in synthetic user, with their own cookies and timings"""
+
+    def __init__(self, base_url, user_id, foods_per_user, rand):
+        self.base_url = base_url
+        self.user_id = user_id
+        self.rand = rand
+        # bulk_load gives each user a run of foods_per_user pantry ids
+        first = (user_id - 1) * foods_per_user + 1
+        self.pantry_ids = range(first, first + foods_per_user)
+        self.http = requests.Session()
+        # route: [seconds, ...], route: {status: count}
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def login(self):
+        response = self.http.post(self.base_url + "/login_handle",
+                                  data={"username": "user{}".format(self.user_id),
+                                        "password": bulk_load.PASSWORD},
+                                  allow_redirects=False)
+        if response.headers.get("Location", "").rstrip("/").endswith("/pantry"):
+            return True
+        return False
+
+    def some_ids(self, most=3):
+        return [str(pantry_id) for pantry_id in
+                self.rand.sample(self.pantry_ids,
+                                 min(most, len(self.pantry_ids)))]
+
+    def form_for(self, route):
+        """POST data for one of the form routes, JSON body for /api/batch"""
+
+        if route == "POST /update":
+            return {"empty": self.some_ids(2), "refill": self.some_ids(2)}
+        if route == "POST /restock":
+            ids = self.some_ids()
+            return {"hidden_id": ids, "refill": ids[:2],
+                    "exp": [str(self.rand.choice([3, 7, 14])) for _ in ids]}
+        # /api/batch, one item edit as the edit modal sends it
+        return {"ops": [{"op": "edit", "id": int(self.some_ids(1)[0]),
+                         "exp": self.rand.choice([3, 7, 14, 30])}],
+                "parts": ["pantry"]}
+
+    def request(self, route):
+        """Make one request, record how long it took and its status"""
+
+        method, path = route.split(" ")
+        start = time.time()
+        try:
+            if method == "GET":
+                response = self.http.get(self.base_url + path,
+                                         allow_redirects=False)
+            elif path.startswith("/api/"):
+                response = self.http.post(self.base_url + path,
+                                          json=self.form_for(route))
+            else:
+                # Redirect targets get measured as their own route
+                response = self.http.post(self.base_url + path,
+                                          data=self.form_for(route),
+                                          allow_redirects=False)
+            status = response.status_code
+        except requests.RequestException:
+            status = "error"
+        self.latencies[route].append(time.time() - start)
+        self.statuses[route][status] += 1
+
+    def run(self, routes, weights, stop_at):
+        while time.time() < stop_at:
+            self.request(weighted_choice(self.rand, routes, weights))
+
+
+def weighted_choice(rand, choices, weights):
+    """random.choices isn't in Python 2"""
+
+    point = rand.uniform(0, sum(weights))
+    for choice, weight in zip(choices, weights):
+        point -= weight
+        if point <= 0:
+            return choice
+    return choices[-1]
+
+###############################################################################
+"""Running"""
+
+def start_local_server(db_uri, users, locations_per_user, foods_per_user,
+                       seed, **pool):
+    """Connect the app to db_uri (migrate it, fill it if it's empty), serve
+       it from a background thread. pool: lowercase POOL_SETTINGS.
+       Returns (base url, server)."""
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    from server import create_app
+    from tablesetup import User, db
+    from migrations import upgrade
+
+    config = dict((key.upper(), value) for key, value in pool.items())
+    config["SQLALCHEMY_DATABASE_URI"] = db_uri
+    app = create_app(config)
+    # A session left over from before would still be on the old engine
+    db.session.remove()
+    upgrade(db.engine)
+    if not User.query.first():
+        print "Filling {} with synthetic data".format(db_uri)
+        bulk_load.load_synthetic(db.engine, users, locations_per_user,
+                                 foods_per_user, seed)
+    db.session.remove()
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            """One line per request would swamp the report"""
+
+    server = make_server("127.0.0.1", 0, app, threaded=True,
+                         request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return "http://127.0.0.1:{}".format(server.server_port), server
+
+def run_load(base_url, users, concurrency, duration, foods_per_user, seed=0,
+             mix=TRAFFIC_MIX):
+    """concurrency virtual users (picked from the first users synthetic
+       ones) send mixed traffic for duration seconds. Returns results dict."""
+
+    rand = random.Random(seed)
+    user_ids = rand.sample(range(1, users + 1), min(concurrency, users))
+    virtual_users = [VirtualUser(base_url, user_id, foods_per_user,
+                                 random.Random(seed + user_id))
+                     for user_id in user_ids]
+    logged_in = [user for user in virtual_users if user.login()]
+    if not logged_in:
+        raise RuntimeError("none of the synthetic users could log in")
+
+    routes = [route for route, weight in mix]
+    weights = [weight for route, weight in mix]
+    started = datetime.utcnow()
+    stop_at = time.time() + duration
+    threads = [threading.Thread(target=user.run, args=(routes, weights, stop_at))
+               for user in logged_in]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    for user in logged_in:
+        for route, times in user.latencies.items():
+            latencies[route].extend(times)
+        for route, counts in user.statuses.items():
+            for status, count in counts.items():
+                statuses[route][status] += count
+
+    return {"started": started.isoformat(), "url": base_url,
+            "concurrency": len(logged_in), "duration": elapsed,
+            "routes": summarize(latencies, statuses, elapsed),
+            "total": summarize({"all": sum(latencies.values(), [])},
+                               {"all": total_statuses(statuses)},
+                               elapsed)["all"]}
+
+def total_statuses(statuses):
+    total = defaultdict(int)
+    for counts in statuses.values():
+        for status, count in counts.items():
+            total[status] += count
+    return total
+
+def summarize(latencies, statuses, elapsed):
+    """route: {requests, rps, errors, p50/p95/p99/mean ms, statuses}"""
+
+    summary = {}
+    for route, times in latencies.items():
+        # redirects are what the form routes and login_required send back
+        errors = sum(count for status, count in statuses[route].items()
+                     if status == "error" or status >= 400)
+        summary[route] = {
+            "requests": len(times), "rps": len(times) / elapsed,
+            "errors": errors,
+            "p50_ms": percentile(times, 50) * 1000,
+            "p95_ms": percentile(times, 95) * 1000,
+            "p99_ms": percentile(times, 99) * 1000,
+            "mean_ms": sum(times) / len(times) * 1000,
+            "statuses": dict((str(status), count)
+                             for status, count in statuses[route].items())}
+    return summary
+
+def report(results):
+    """Lines of the per-route table"""
+
+    lines = ["{:<26} {:>8} {:>8} {:>7} {:>9} {:>9} {:>9}".format(
+             "route", "requests", "req/s", "errors", "p50 ms", "p95 ms",
+             "p99 ms")]
+    rows = sorted(results["routes"].items()) + [("total", results["total"])]
+    for route, stats in rows:
+        lines.append("{:<26} {:>8} {:>8.1f} {:>7} {:>9.1f} {:>9.1f} {:>9.1f}"
+                     .format(route, stats["requests"], stats["rps"],
+                             stats["errors"], stats["p50_ms"],
+                             stats["p95_ms"], stats["p99_ms"]))
+    return lines
+
+def pool_advice(stats, seconds, workers, pool_size, max_overflow,
+                max_connections=None):
+    """Lines suggesting per worker pool settings from a run's pool_stats.
+       The run had one process take all the load, workers share it out.
+       Little's law: connections in use on average = time they were held
+       for / run time."""
+
+    if not stats["checkouts"]:
+        return ["No pool checkouts (SQLite or pgbouncer mode), no advice"]
+
+    average = stats["hold_seconds"] / seconds
+    wait_ms = stats["wait_seconds"] / stats["checkouts"] * 1000
+    lines = ["Pool: {} checkouts, {:.1f} in use on average, {} at most, "
+             "{:.2f} ms average wait, {} timeouts".format(
+             stats["checkouts"], average, stats["max_in_use"], wait_ms,
+             stats["timeouts"])]
+
+    if stats["timeouts"] or (stats["max_in_use"] >= pool_size + max_overflow
+                             and wait_ms > 1):
+        lines.append("Starved: every connection was in use and requests "
+                     "waited, these numbers are a floor, rerun bigger")
+
+    # Room for the busy moments over the average, overflow up to the peak
+    size = max(1, int(math.ceil(average * 1.5 / workers)))
+    overflow = max(0, int(math.ceil(stats["max_in_use"] * 1.25 / workers)) - size)
+    lines.append("Suggested per worker ({} workers): DB_POOL_SIZE={} "
+                 "DB_MAX_OVERFLOW={}".format(workers, size, overflow))
+
+    most = workers * (size + overflow)
+    if max_connections is not None:
+        # Leave a tenth for migrations, psql, batch jobs
+        room = int(max_connections * 0.9)
+        if most > room:
+            lines.append("{} workers could open {} connections, more than the "
+                         "{} max_connections leaves room for: use pgbouncer "
+                         "(DB_PGBOUNCER)".format(workers, most, max_connections))
+        else:
+            lines.append("At most {} connections of {} max_connections".format(
+                         most, max_connections))
+    return lines
+
+def compare(before, after):
+    """Lines comparing two saved runs, route by route"""
+
+    lines = ["{:<26} {:>17} {:>21}".format("route", "req/s", "p95 ms")]
+    for route in sorted(set(before["routes"]) | set(after["routes"])):
+        old = before["routes"].get(route)
+        new = after["routes"].get(route)
+        if old is None or new is None:
+            lines.append("{:<26} only in {}".format(
+                         route, "after" if old is None else "before"))
+            continue
+        lines.append("{:<26} {:>7.1f} -> {:>7.1f} {:>9.1f} -> {:>9.1f}".format(
+                     route, old["rps"], new["rps"], old["p95_ms"],
+                     new["p95_ms"]))
+    return lines
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["compare"]:
+        if len(sys.argv) != 4:
+            print "usage: python loadtest.py compare before.json after.json"
+            sys.exit(1)
+        for line in compare(json.load(open(sys.argv[2])),
+                            json.load(open(sys.argv[3]))):
+            print line
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Load test Remote Pantry")
+    parser.add_argument("db_uri", nargs="?", default=DEFAULT_DB)
+    parser.add_argument("--url", help="test this running server instead")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--locations-per-user", type=int, default=10)
+    parser.add_argument("--foods-per-user", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="loadtest.json")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes to suggest pool sizes for")
+    parser.add_argument("--pool-size", type=int)
+    parser.add_argument("--max-overflow", type=int)
+    args = parser.parse_args()
+
+    pool = {}
+    if args.pool_size is not None:
+        pool["db_pool_size"] = args.pool_size
+    if args.max_overflow is not None:
+        pool["db_max_overflow"] = args.max_overflow
+
+    base_url = args.url
+    if base_url is None:
+        base_url, server = start_local_server(
+            args.db_uri, args.users, args.locations_per_user,
+            args.foods_per_user, args.seed, **pool)
+        from tablesetup import db, pool_stats, reset_pool_stats
+        app = server.app
+        reset_pool_stats()
+
+    print "{} users for {:.0f} s against {}".format(args.concurrency,
+                                                   args.duration, base_url)
+    results = run_load(base_url, args.users, args.concurrency, args.duration,
+                       args.foods_per_user, args.seed)
+    results["db"] = None if args.url else args.db_uri
+
+    for line in report(results):
+        print line
+    if args.url is None:
+        results["pool"] = dict(pool_stats)
+        max_connections = None
+        if db.engine.dialect.name == "postgresql":
+            max_connections = int(db.engine.execute(
+                              "SHOW max_connections").scalar())
+        for line in pool_advice(results["pool"], args.duration, args.workers,
+                                app.config["DB_POOL_SIZE"],
+                                app.config["DB_MAX_OVERFLOW"], max_connections):
+            print line
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print "Saved to", args.output
@@ -0,0 +1,194 @@
+"""Versioned schema migrations for Remote Pantry
+
+Each migration is a version number, a description and a list of steps. A step
+is a function that takes a connection. Applied versions are recorded in the
+schema_migrations table, so running this file again only applies what's new:
+
+    python migrations.py                    # upgrade postgresql:///pantry
+    python migrations.py postgresql:///other_db
+
+On PostgreSQL, steps run outside of a transaction so indexes can be built with
+CREATE INDEX CONCURRENTLY, which doesn't block inserts/updates on a live db.
+"""
+
+from datetime import datetime
+import sys
+
+from sqlalchemy import (MetaData, Table, Column, Integer, String, DateTime,
+                        create_engine, inspect, text)
+
+from tablesetup import db, Foodstuff, expires_after
+
+# Kept out of db.metadata so the models (and db.drop_all) don't own it
+version_metadata = MetaData()
+schema_migrations = Table("schema_migrations", version_metadata,
+                          Column("version", Integer, primary_key=True),
+                          Column("name", String(200), nullable=False),
+                          Column("applied_at", DateTime, nullable=False,
+                                 default=datetime.utcnow))
+
+###############################################################################
+"""Step builders"""
+
+def create_tables(conn):
+    """Create any model tables that don't exist yet (fresh database)"""
+
+    db.metadata.create_all(bind=conn, checkfirst=True)
+
+def create_index(name, table, columns, where=None, unique=False):
+    """Returns a step that builds an index if it isn't already there. On
+       PostgreSQL the build is CONCURRENTLY, and a leftover invalid index from
+       an interrupted build is dropped first so it gets rebuilt."""
+
+    def step(conn):
+        postgres = conn.dialect.name == "postgresql"
+        if postgres:
+            drop_invalid_index(conn, name)
+
+        sql = "CREATE {}INDEX {}IF NOT EXISTS {} ON {} ({})".format(
+               "UNIQUE " if unique else "",
+               "CONCURRENTLY " if postgres else "", name, table,
+               ", ".join(columns))
+        if where:
+            sql += " WHERE " + where
+        conn.execute(text(sql))
+
+    step.__doc__ = "index {} on {}".format(name, table)
+    return step
+
+def add_column(table, name, type_):
+    """Returns a step that adds a nullable column if it isn't there yet.
+       No default, so PostgreSQL doesn't rewrite the table."""
+
+    def step(conn):
+        if name in [column["name"] for column in inspect(conn).get_columns(table)]:
+            return
+        conn.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                          table, name, type_.compile(dialect=conn.dialect))))
+
+    step.__doc__ = "column {} on {}".format(name, table)
+    return step
+
+def drop_index(name):
+    """Returns a step that drops an index if it's there"""
+
+    def step(conn):
+        postgres = conn.dialect.name == "postgresql"
+        conn.execute(text("DROP INDEX {}IF EXISTS {}".format(
+                          "CONCURRENTLY " if postgres else "", name)))
+
+    step.__doc__ = "drop index {}".format(name)
+    return step
+
+def backfill_expires_at(conn, batch_size=10000):
+    """Fill in expires_at for rows that have an exp, batch_size pantry ids
+       per UPDATE so no one statement holds row locks on the whole table.
+       Rows already filled in are skipped, so an interrupted run resumes."""
+
+    foods = Foodstuff.__table__
+    last_id = conn.execute(db.select([db.func.max(foods.c.pantry_id)])).scalar()
+    for start in range(0, (last_id or 0) + 1, batch_size):
+        conn.execute(foods.update()
+                          .where(foods.c.pantry_id > start)
+                          .where(foods.c.pantry_id <= start + batch_size)
+                          .where(foods.c.exp != None)
+                          .where(foods.c.expires_at == None)
+                          .values(expires_at=expires_after(foods.c.last_purch,
+                                                           foods.c.exp)))
+
+def drop_invalid_index(conn, name):
+    """A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind,
+       which IF NOT EXISTS would happily skip. Drop it so it's rebuilt."""
+
+    invalid = conn.execute(text("""SELECT 1 FROM pg_index
+                                   JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+                                   WHERE pg_class.relname = :name
+                                   AND NOT pg_index.indisvalid"""),
+                           name=name).first()
+    if invalid:
+        conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS " + name))
+
+###############################################################################
+"""Migrations, in order. Never edit one that has shipped, add a new one."""
+
+MIGRATIONS = [
+    (1, "initial tables", [create_tables]),
+
+    (2, "indexes for pantry, shopping list, eat me, history and locations", [
+        create_index("ix_foodstuffs_pantry", "foodstuffs",
+                     ["user_id", "is_pantry", "location_id", "name"]),
+        create_index("ix_foodstuffs_shopping", "foodstuffs",
+                     ["user_id", "location_id"], where="is_shopping"),
+        create_index("ix_foodstuffs_exp", "foodstuffs", ["user_id", "exp"],
+                     where="is_pantry AND exp IS NOT NULL"),
+        create_index("ix_foodstuffs_history", "foodstuffs",
+                     ["user_id", "last_purch", "pantry_id"],
+                     where="NOT is_pantry AND NOT is_shopping"),
+        create_index("ix_locations_user_name", "locations",
+                     ["user_id", "location_name"]),
+    ]),
+
+    (3, "stored expires_at, backfilled, indexed for expiry range scans", [
+        add_column("foodstuffs", "expires_at", DateTime()),
+        backfill_expires_at,
+        create_index("ix_foodstuffs_user_expires", "foodstuffs",
+                     ["user_id", "expires_at"],
+                     where="is_pantry AND expires_at IS NOT NULL"),
+        create_index("ix_foodstuffs_expires", "foodstuffs", ["expires_at"],
+                     where="is_pantry AND expires_at IS NOT NULL"),
+        # eatme_generator goes by ix_foodstuffs_user_expires now
+        drop_index("ix_foodstuffs_exp"),
+    ]),
+
+    (4, "barcode catalog: code, name, brand and shelf life", [
+        add_column("barcodes", "code", String(14)),
+        add_column("barcodes", "name", String(200)),
+        add_column("barcodes", "brand", String(100)),
+        add_column("barcodes", "shelf_life", Integer()),
+        create_index("ix_barcodes_code", "barcodes", ["code"], unique=True),
+    ]),
+]
+
+###############################################################################
+"""Runner"""
+
+def applied_versions(conn):
+    """Returns set of migration versions already applied to this database"""
+
+    schema_migrations.create(bind=conn, checkfirst=True)
+    rows = conn.execute(schema_migrations.select()).fetchall()
+    return set(row.version for row in rows)
+
+def upgrade(engine, target=None, verbose=False):
+    """Apply every migration newer than the database, up to target (default:
+       all of them). Returns list of versions applied."""
+
+    conn = engine.connect()
+    if engine.dialect.name == "postgresql":
+        # CONCURRENTLY can't run inside a transaction block
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+
+    done = []
+    try:
+        applied = applied_versions(conn)
+        for version, name, steps in MIGRATIONS:
+            if version in applied or (target is not None and version > target):
+                continue
+            if verbose:
+                print "Applying {}: {}".format(version, name)
+            for step in steps:
+                step(conn)
+            # Only recorded once every step worked, so a failed migration is
+            # retried from the top next run (steps are safe to repeat)
+            conn.execute(schema_migrations.insert(), version=version, name=name)
+            done.append(version)
+    finally:
+        conn.close()
+
+    return done
+
+
+if __name__ == "__main__":
+    db_uri = sys.argv[1] if len(sys.argv) > 1 else "postgresql:///pantry"
+    applied = upgrade(create_engine(db_uri), verbose=True)
+    print "Applied {} migration(s).".format(len(applied))
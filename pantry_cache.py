@@ -0,0 +1,244 @@
+"""Per-user read cache for pantry, shopping list, eat me and locations
+
+Every cache key includes a per-user version token. Routes that change a
+user's foodstuffs or locations call bump_version(user_id), which makes all of
+that user's cached entries unreachable at once (they age out of the LRU).
+The version is always read before the database is, so a result computed
+while a write is happening gets stored under the old version, never served.
+
+Cached values are plain rows (namedtuples/lists), not ORM objects, so they
+can outlive the db session and be pickled into a shared backend.
+
+Backends: LocalLRUBackend (default, per process, bounded) or RedisBackend
+(shared, so several workers see each other's invalidations). Pick one with
+configure(), e.g. from the PANTRY_CACHE_URL environment variable. The LRU
+is only right for a single process: a write bumps the version in the worker
+that handled it, the others would keep serving the old pages.
+create_app() won't start more than one worker (PANTRY_WORKERS) on it.
+
+The same version token makes the pages' ETags (page_etag), so a browser
+reload of an unchanged page gets a 304 without touching the db. That's
+only right if every worker has the same tokens, which the check in
+create_app() makes sure of: one worker, or a shared backend.
+"""
+
+from collections import OrderedDict, namedtuple
+import hashlib
+import os
+import pickle
+import threading
+import time
+import uuid
+
+from pantry_functions import (make_pantry, get_shop_lst, eatme_generator,
+                              get_locs, find_barcode, normalize_code)
+
+DEFAULT_SIZE = 1024
+# Goes into every ETag, change it on deploy if templates changed and the
+# cache (so the versions) outlives the old code, e.g. in Redis
+RELEASE = os.environ.get("PANTRY_RELEASE", "")
+# days_left on the eat me page moves with the clock, don't keep it long
+EATME_TTL = 60
+# The catalog only changes on import, a day old is fine
+BARCODE_TTL = 24 * 60 * 60
+# Codes we don't know, not for long: the next import may add them
+BARCODE_MISS_TTL = 60
+
+LocRow = namedtuple("LocRow", "location_id location_name")
+ShopRow = namedtuple("ShopRow", "pantry_id name exp location_id")
+BarcodeRow = namedtuple("BarcodeRow", "barcode_id code name brand shelf_life")
+
+###############################################################################
+"""Backends"""
+
+class NullBackend(object):
+    """Caching turned off, every lookup misses"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+
+class LocalLRUBackend(object):
+    """In-process cache, evicts least recently used entries past maxsize"""
+
+    def __init__(self, maxsize=DEFAULT_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                return None
+            # Re-insert so it's now the most recently used
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisBackend(object):
+    """Shared cache for multiple workers, needs the redis package"""
+
+    def __init__(self, url, default_ttl=24 * 60 * 60):
+        # Optional dependency, only needed if you ask for it
+        import redis
+
+        self.client = redis.StrictRedis.from_url(url)
+        # Bounded by expiry here (plus Redis' own maxmemory-policy)
+        self.default_ttl = default_ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                        ex=ttl or self.default_ttl)
+
+
+backend = LocalLRUBackend()
+
+def configure(url=None, maxsize=DEFAULT_SIZE):
+    """Choose the backend: redis:// url for a shared cache, otherwise
+       in-process LRU of maxsize entries (0 turns caching off)"""
+
+    global backend
+    if url and url.startswith("redis"):
+        backend = RedisBackend(url)
+    elif maxsize:
+        backend = LocalLRUBackend(maxsize)
+    else:
+        backend = NullBackend()
+    return backend
+
+def is_shared():
+    """True if every worker sees the same versions: Redis, or no caching at
+       all (nothing to disagree about)"""
+
+    return not isinstance(backend, LocalLRUBackend)
+
+###############################################################################
+"""Versions"""
+
+def version_key(user_id):
+    return "pantry:v:{}".format(user_id)
+
+def get_version(user_id):
+    """User's current version token, makes one up if there isn't one (new
+       user, or it was evicted, either way nothing cached can match it)"""
+
+    version = backend.get(version_key(user_id))
+    if version is None:
+        version = bump_version(user_id)
+    return version
+
+def bump_version(user_id):
+    """Call after changing a user's foodstuffs or locations"""
+
+    version = uuid.uuid4().hex
+    backend.set(version_key(user_id), version)
+    return version
+
+def page_etag(user_id, page, period=None):
+    """ETag for a page made from user's data, e.g. page="/history?before=x".
+       Changes with every write (new version), and every period seconds
+       if given, for pages that move with the clock."""
+
+    parts = [RELEASE, user_id, get_version(user_id), page]
+    if period:
+        parts.append(int(time.time() // period))
+    return hashlib.sha1(":".join(str(part) for part in parts)).hexdigest()
+
+def cached(user_id, name, compute, args=(), ttl=None):
+    """Returns value for (user, version, name, args) from the cache, or
+       calls compute() and caches what it returns"""
+
+    # Version first, before we look at the db
+    key = "pantry:{}:{}:{}:{}".format(user_id, get_version(user_id), name,
+                                      ":".join(str(arg) for arg in args))
+    value = backend.get(key)
+    if value is None:
+        value = compute()
+        backend.set(key, value, ttl)
+    return value
+
+###############################################################################
+"""Cached versions of pantry_functions readers"""
+
+def to_loc_row(loc):
+    return LocRow(loc.location_id, loc.location_name)
+
+def cached_pantry(user_id):
+    """make_pantry, keys are LocRows instead of Location objects"""
+
+    def compute():
+        pantry = make_pantry(user_id)
+        return OrderedDict((to_loc_row(loc), items)
+                           for loc, items in pantry.items())
+
+    return cached(user_id, "pantry", compute)
+
+def cached_shop_lst(user_id):
+    """get_shop_lst, as ShopRows"""
+
+    def compute():
+        return [ShopRow(food.pantry_id, food.name, food.exp, food.location_id)
+                for food in get_shop_lst(user_id)]
+
+    return cached(user_id, "shop", compute)
+
+def cached_eatme(user_id, within_days=None, limit=None):
+    """eatme_generator, kept for EATME_TTL seconds at most"""
+
+    def compute():
+        return eatme_generator(user_id, within_days, limit)
+
+    return cached(user_id, "eatme", compute, (within_days, limit), EATME_TTL)
+
+def cached_locs(user_id):
+    """get_locs, as LocRows"""
+
+    def compute():
+        return [to_loc_row(loc) for loc in get_locs(user_id)]
+
+    return cached(user_id, "locs", compute)
+
+def cached_barcode(code):
+    """find_barcode as a BarcodeRow, None if we don't know it. Shared by
+       all users, so not versioned. Codes we don't know are cached too (as
+       False, for BARCODE_MISS_TTL) so rescanning them doesn't go back to
+       the db every time."""
+
+    code = normalize_code(code)
+    if code is None:
+        return None
+    key = "pantry:barcode:{}".format(code)
+    row = backend.get(key)
+    if row is None:
+        barcode = find_barcode(code)
+        if barcode is None:
+            backend.set(key, False, BARCODE_MISS_TTL)
+            return None
+        row = BarcodeRow(barcode.barcode_id, barcode.code, barcode.name,
+                         barcode.brand, barcode.shelf_life)
+        backend.set(key, row, BARCODE_TTL)
+    return row or None
@@ -1,14 +1,25 @@
 """functions for pantry server.py"""
 
 from datetime import datetime, timedelta
-import bcrypt
 
-from jinja2 import StrictUndefined # can I cut this?
-from flask import (Flask, render_template, redirect, request, flash, session, g)
-from flask_debugtoolbar import DebugToolbarExtension
-from tablesetup import User, Foodstuff, Location, Barcode, connect_to_db, db
+from flask import (Flask, render_template, redirect, request, flash, session, g,
+                   has_request_context, current_app)
+from tablesetup import (User, Foodstuff, Location, Barcode, connect_to_db, db,
+                        expires_after)
+from replicas import read_only
+from passwords import (hash_password, check_password, HashingBusy,
+                       needs_rehash, count_rehash, cost_of)
 from collections import OrderedDict
 from functools import wraps
+from sqlalchemy import event
+import threading
+
+# History is shown this many items at a time
+HISTORY_PAGE_SIZE = 50
+CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+# Time zones go from UTC-12 to UTC+14
+MIN_TZ_HOURS = -12
+MAX_TZ_HOURS = 14
 
 def login_required(f):
     """View decorator, wrap any functions where user must be logged in to view page.
@@ -19,9 +30,43 @@ def login_required(f):
         if session.get("user_id") is None:
             flash("Please log in or register.", 'danger')
             return redirect("/")
+        # User obj itself is only loaded if something asks, see current_user()
+        g.user_id = session["user_id"]
         return f(*args, **kwargs)
     return decorated_function
 
+@event.listens_for(User, "load")
+def count_user_load(user, context):
+    """Per-request counter of User rows fetched, lets us check that a route
+       loads the user at most once. Counted where the ORM builds or
+       refreshes a User from a row, so it sees every way of getting one
+       (queries, get(), reloading attributes expired by a commit)."""
+
+    if has_request_context():
+        g.user_loads = g.get("user_loads", 0) + 1
+
+@event.listens_for(User, "refresh")
+def count_user_refresh(user, context, attrs):
+    count_user_load(user, context)
+
+def current_user():
+    """Logged in user's User obj (None if not logged in). Loaded from
+       session["user_id"] the first time it's asked for in a request, then
+       kept on flask.g for the rest of the request."""
+
+    if "current_user" not in g:
+        user_id = g.get("user_id") or session.get("user_id")
+        user = None
+        if user_id is not None:
+            user = User.query.get(user_id)
+        g.current_user = user
+    return g.current_user
+
+def set_current_user(user):
+    """Already have the User obj (just logged in/registered), keep it for
+       the rest of the request instead of loading it again"""
+
+    g.current_user = user
 
 def get_user_by_uname(username):
     """Takes username, returns user obj from database"""
@@ -31,18 +76,47 @@ def get_user_by_uname(username):
 
 def is_pword(user, pword_input):
     """Checks input pword against stored pword. Takes user obj and pword to 
-    check, returns bool"""
+    check, returns bool. Runs in the hashing pool, may raise HashingBusy"""
     
-    pword_in_table = user.pword.encode('utf8')
-    valid_password = (bcrypt.hashpw(pword_input.encode('utf8'),
-                      pword_in_table.encode('utf8')) == pword_in_table)
-    return valid_password
+    return check_password(pword_input, user.pword)
+
+def rehash_if_needed(user, pword_input):
+    """Call after a successful login. If the stored hash wasn't made with the
+       current work factor, hash the password again in a background thread
+       (so the login isn't any slower) and save it. Returns the thread, or
+       None if there was nothing to do."""
+
+    old_hash = user.pword
+    if not needs_rehash(old_hash):
+        return None
+
+    app = current_app._get_current_object()
+    user_id = user.user_id
+
+    def rehash():
+        try:
+            new_hash = hash_password(pword_input)
+        except HashingBusy:
+            # Pool is swamped, it'll happen on a later login
+            return
+        with app.app_context():
+            # Only if the password hasn't been changed in the meantime
+            updated = User.query.filter_by(user_id=user_id, pword=old_hash)\
+                                .update({"pword": new_hash})
+            db.session.commit()
+        if updated:
+            count_rehash(cost_of(new_hash))
+
+    thread = threading.Thread(target=rehash)
+    thread.daemon = True
+    thread.start()
+    return thread
 
 def hash_it(pword):
-    """Takes a string, returns hashed string, uses bcrypt"""
+    """Takes a string, returns hashed string, uses bcrypt in the hashing
+    pool, may raise HashingBusy"""
 
-    hashed_pword = bcrypt.hashpw(pword.encode('utf8'), bcrypt.gensalt(10))
-    return hashed_pword
+    return hash_password(pword)
 
 def basic_locs(user_id):
     """Takes user id, creates 4 locations for this user in their pantry"""
@@ -61,74 +135,137 @@ def basic_locs(user_id):
 
     db.session.commit()
 
+@read_only
 def get_locs(user_id):
     """Takes user id, returns list of user's location objects"""
 
     locs = Location.query.filter_by(user_id=user_id).order_by(Location.location_name).all()
     return locs
 
-def eatme_generator(user_id):
-    """Takes user id, returns list of all items with expiry, sorted"""
+def days_left_sql(now):
+    """SQL expression for days until a foodstuff expires, same math as the
+       old Python version: (expires_at + user's tz hours) - now, rounded down
+       to whole days. Needs users joined in for time_zone."""
+
+    if db.engine.dialect.name == "sqlite":
+        # No intervals in SQLite (loadtest runs on it), count in julian days
+        days = (db.func.julianday(Foodstuff.expires_at) +
+                User.time_zone / 24.0 -
+                db.func.julianday(db.bindparam('now', now, type_=db.DateTime)))
+        whole = db.cast(days, db.Integer)
+        # CAST truncates toward zero, floor has to go down for negatives
+        return whole - db.case([(days < whole, 1)], else_=0)
+
+    hour = db.literal_column("interval '1 hour'", type_=db.Interval)
+    seconds_left = db.extract('epoch', Foodstuff.expires_at +
+                              User.time_zone * hour -
+                              db.bindparam('now', now, type_=db.DateTime))
+    return db.cast(db.func.floor(seconds_left / 86400), db.Integer)
+
+@read_only
+def eatme_generator(user_id, within_days=None, limit=None):
+    """Takes user id, returns list of [pantry_id, name, location_name,
+       days_left] for all in-pantry items with an exp, soonest first.
+       One query: locations and the user's time zone are joined in and
+       days_left is worked out by the database, walking ix_foodstuffs_user_expires
+       in expires_at order.
+       Optional: only items expiring within_days from now, at most limit rows"""
+
+    now = datetime.utcnow()
+    days_left = days_left_sql(now)
+
+    query = db.session.query(Foodstuff.pantry_id, Foodstuff.name,
+                             Location.location_name,
+                             days_left.label("days_left"))\
+              .join(User, User.user_id == Foodstuff.user_id)\
+              .outerjoin(Location, Location.location_id == Foodstuff.location_id)\
+              .filter(Foodstuff.user_id == user_id,
+                      Foodstuff.expires_at != None,
+                      Foodstuff.is_pantry == True)\
+              .order_by(Foodstuff.expires_at, Foodstuff.pantry_id)
+
+    if within_days is not None:
+        # Range on the index first, then the exact cut in the user's own
+        # time zone. days_left <= within_days means expires_at < now +
+        # within_days + 1 days - tz hours, which is latest furthest west.
+        latest = now + timedelta(days=within_days + 1, hours=-MIN_TZ_HOURS)
+        query = query.filter(Foodstuff.expires_at < latest,
+                             days_left <= within_days)
+    if limit is not None:
+        query = query.limit(limit)
 
-    # Grab all user's foodstuffs with an exp
-    with_exp = Foodstuff.query.filter(Foodstuff.user_id == user_id,
-                                      Foodstuff.exp != None,
-                                      Foodstuff.is_pantry == True).all()
     # Master list of lists, to be passed to template
-    eat_me = []
-    for foodstuff in with_exp:
-        # Inner list that will be appended to master list
-        temp = []
-        temp.append(foodstuff.pantry_id)
-        temp.append(foodstuff.name)
-        temp.append(foodstuff.location.location_name)
-
-        # DateTime math to display days until item expires
-        last_purch = foodstuff.last_purch
-        exp = foodstuff.exp + 1
-        # time zone fix: subtract user's tz hours from db value (in GMT)
-        tz = get_tz(user_id)
-        exp_date = last_purch + timedelta(days=exp, hours=tz)
-        time_left = (exp_date - datetime.utcnow()).days
-        temp.append(time_left)
-
-        eat_me.append(temp)
-        # sort by time_left
-        eat_me.sort(key=lambda x: x[3])
-
-    return eat_me
-
-def history_generator(user_id):
-    """Takes user id, returns list of all items previously in pantry, sorted"""
-
-    # Grab all user's foodstuffs with pantry:false
-    not_pantry = Foodstuff.query.filter_by(user_id=user_id, is_shopping=False, is_pantry=False).all()
-    # Foodstuff.query.filter(Foodstuff.user_id == user_id,
-    #                                     Foodstuff.is_pantry == False,
-    #                                     Foodstuff.is_shopping == False).all()
+    return [list(row) for row in query]
+
+def expiring_within(hours, now=None):
+    """Everyone's in-pantry items that expire in the next hours, soonest
+       first, as a query of Foodstuffs (add filters/limit as needed).
+       A range scan on ix_foodstuffs_expires, however big the table gets."""
+
+    now = now or datetime.utcnow()
+    return Foodstuff.query.filter(Foodstuff.is_pantry == True,
+                                  Foodstuff.expires_at >= now,
+                                  Foodstuff.expires_at < now + timedelta(hours=hours))\
+                          .order_by(Foodstuff.expires_at, Foodstuff.pantry_id)
+
+def encode_cursor(last_purch, pantry_id):
+    """History page cursor: last row's (last_purch, pantry_id) as a string"""
+
+    return "{}_{}".format(last_purch.strftime(CURSOR_FORMAT), pantry_id)
+
+def decode_cursor(cursor):
+    """Takes cursor string, returns (last_purch, pantry_id), or None if the
+       cursor is missing or mangled (then we just start from the top)"""
+
+    try:
+        last_purch, pantry_id = cursor.split("_")
+        return datetime.strptime(last_purch, CURSOR_FORMAT), int(pantry_id)
+    except (AttributeError, ValueError):
+        return None
+
+@read_only
+def history_generator(user_id, cursor=None, per_page=HISTORY_PAGE_SIZE):
+    """Takes user id, returns (page, next_cursor). page is a list of
+       [pantry_id, name, last purchased date] for items previously in pantry,
+       newest first, starting after cursor. next_cursor is None on last page.
+
+       Keyset pagination: ordered by (last_purch, pantry_id) DESC in the db
+       and the cursor is the last row we showed, so every page costs the
+       same however long the history is."""
+
+    # Grab user's foodstuffs with pantry:false and shopping:false, plus the
+    # user's time zone so dates show in their local time
+    query = db.session.query(Foodstuff.pantry_id, Foodstuff.name,
+                             Foodstuff.last_purch, User.time_zone)\
+              .join(User, User.user_id == Foodstuff.user_id)\
+              .filter(Foodstuff.user_id == user_id,
+                      Foodstuff.is_pantry == False,
+                      Foodstuff.is_shopping == False)\
+              .order_by(Foodstuff.last_purch.desc(), Foodstuff.pantry_id.desc())
+
+    after = decode_cursor(cursor)
+    if after:
+        query = query.filter(db.tuple_(Foodstuff.last_purch,
+                                       Foodstuff.pantry_id) < after)
+
+    # One extra row tells us if there's another page
+    rows = query.limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1].last_purch, rows[-1].pantry_id)
 
     # Master list of lists, to be passed to template
     history = []
-    for foodstuff in not_pantry:
-        # Inner list that will be appended to master list
-        temp = []
-        temp.append(foodstuff.pantry_id)
-        temp.append(foodstuff.name)
-
-        last_purch = foodstuff.last_purch
-        # Lazy time zone fix: subtract 8 hours (hardcoded to PST)
-        # Convert to display format, lazy fix for time zone problem (hardcoded to PST)
-        ugly = (last_purch) + timedelta(hours=-8)
-        pretty = ugly.strftime('%b %d, %Y')
-        temp.append(pretty)
-
-        history.append(temp)
-        # sort by time_left
-        history.sort(key=lambda x: x[2])
-        history.reverse()
-
-    return history
+    for pantry_id, name, last_purch, tz in rows:
+        # db value is GMT, shift to user's time zone for display
+        pretty = (last_purch + timedelta(hours=tz)).strftime('%b %d, %Y')
+        history.append([pantry_id, name, pretty])
 
+    return history, next_cursor
+
+@read_only
 def get_shop_lst(user_id):
     """Takes user id, generates list of foodstuff objects that have been 
        placed on the shopping list"""
@@ -137,99 +274,209 @@ def get_shop_lst(user_id):
                         is_shopping=True).order_by(Foodstuff.location_id).all()
     return shopping_list
 
-def refilled(refills, exp, pan_id):
-    """Remove from shopping list, change pantry status, update last_purch
-       keep exp if any, or update exp"""
+def to_int(value):
+    """Form value as an int, None if it isn't one (blank, a tampered form)"""
 
-    """Exp is optional, use what's in db if we have a value, else leave blank
-       make a dictionary of id:exp values. caution: hidden value entry in this 
-       dict is for all items on page, not just items user has toggled to refill.
-       Therefore, go by refills list, use this dict to fill in exp"""
-    exp_updates = {}
-    for expi, pantry_id in zip(exp, pan_id):
-        if not expi:
-            foodie_obj = Foodstuff.query.filter_by(pantry_id=pantry_id).one()
-            orig_expi = foodie_obj.exp
-            expi = orig_expi
-        exp_updates[pantry_id] = expi
-    
-    for item in refills:
-        to_update = Foodstuff.query.get(item)
-        to_update.is_pantry = True
-        to_update.is_shopping = False
-        to_update.last_purch = datetime.utcnow()
-        to_update.exp = exp_updates[item]
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
-    db.session.commit()
+def to_ids(pantry_ids):
+    """Form values come in as strings, returns set of int pantry ids.
+       Values that aren't numbers are skipped, same as ids that aren't the
+       user's."""
 
-def out_of_stock(empties):
-    """Update item's is_pantry value"""
-    
-    for item in empties:
-        to_update = Foodstuff.query.get(item)
-        to_update.is_pantry = False
-    db.session.commit()
+    return set(pantry_id for pantry_id in map(to_int, pantry_ids)
+               if pantry_id is not None)
 
-def add_to_pan(empties):
-    """Update item's is_pantry value"""
+def set_status(user_id, pantry_ids, commit=True, **values):
+    """Bulk status change: one UPDATE for every listed item that belongs to
+       this user, e.g. set_status(1, ['3', '4'], is_pantry=False).
+       Ids that aren't the user's are left alone. Returns number of rows
+       updated, so callers can tell if some ids didn't make it.
+       commit=False leaves the transaction open for the caller to commit."""
 
-    for item in empties:
-        to_update = Foodstuff.query.get(item)
-        to_update.is_pantry = True
-    db.session.commit()    
+    ids = to_ids(pantry_ids)
+    if not ids:
+        return 0
 
-def to_refill(refills):
-    """Update item's is_shopping value"""
-    
-    for item in refills:
-        to_update = Foodstuff.query.get(item)
-        to_update.is_shopping = True
-    db.session.commit()
+    if "last_purch" in values or "exp" in values:
+        # Same UPDATE keeps expires_at in step, from the new values where
+        # there are any and the row's own otherwise
+        values["expires_at"] = expires_after(
+            values.get("last_purch", Foodstuff.last_purch),
+            values.get("exp", Foodstuff.exp))
 
-def remove_from_shop(removals):
-    """Update item's is_shopping value"""
-    
-    for item in removals:
-        to_update = Foodstuff.query.get(item)
-        to_update.is_shopping = False
-    db.session.commit()
+    updated = Foodstuff.query.filter(Foodstuff.user_id == user_id,
+                                     Foodstuff.pantry_id.in_(ids))\
+                             .update(values, synchronize_session=False)
+    if commit:
+        db.session.commit()
+    return updated
+
+def out_of_stock(user_id, empties, commit=True):
+    """Update items' is_pantry value, returns number of rows updated"""
+
+    return set_status(user_id, empties, commit, is_pantry=False)
+
+def add_to_pan(user_id, empties, commit=True):
+    """Update items' is_pantry value, returns number of rows updated"""
+
+    return set_status(user_id, empties, commit, is_pantry=True)
+
+def to_refill(user_id, refills, commit=True):
+    """Update items' is_shopping value, returns number of rows updated"""
+
+    return set_status(user_id, refills, commit, is_shopping=True)
+
+def remove_from_shop(user_id, removals, commit=True):
+    """Update items' is_shopping value, returns number of rows updated"""
 
+    return set_status(user_id, removals, commit, is_shopping=False)
+
+def refilled(user_id, refills, exp, pan_id, commit=True):
+    """Remove from shopping list, change pantry status, update last_purch
+       keep exp if any, or update exp. Returns number of rows updated."""
+
+    """Exp is optional, use what's in db if we have a value, else leave blank
+       caution: exp and hidden id entries are for all items on page, not just
+       items user has toggled to refill. Therefore, go by refills list, and
+       only keep the new exps typed in for those items. Everything happens in
+       one UPDATE: exp is a CASE on pantry_id, falling back to the exp already
+       in the row, so we never have to read the old values first."""
+    ids = to_ids(refills)
+
+    new_exps = {}
+    for expi, pantry_id in zip(map(to_int, exp), map(to_int, pan_id)):
+        if expi is not None and pantry_id in ids:
+            new_exps[pantry_id] = expi
+
+    values = {"is_pantry": True, "is_shopping": False,
+              "last_purch": datetime.utcnow()}
+    if new_exps:
+        values["exp"] = db.case(new_exps, value=Foodstuff.pantry_id,
+                                else_=Foodstuff.exp)
+
+    return set_status(user_id, ids, commit, **values)
+
+def edit_values(fields):
+    """Takes an item edit as the JSON API sends it (name, location, exp,
+       description, last_purch "YYYY-MM-DD", pantry, shop), returns column
+       values for set_status. Missing or blank fields are left out."""
+
+    values = {}
+    for field, column in [("name", "name"), ("description", "description")]:
+        if fields.get(field):
+            values[column] = fields[field]
+    if fields.get("location"):
+        values["location_id"] = int(fields["location"])
+    if fields.get("exp") not in (None, ""):
+        values["exp"] = int(fields["exp"])
+    if fields.get("last_purch"):
+        # Noon, same as the edit form, so the day shows right in any tz
+        values["last_purch"] = datetime.strptime(fields["last_purch"],
+                                                 "%Y-%m-%d").replace(hour=12)
+    for field, column in [("pantry", "is_pantry"), ("shop", "is_shopping")]:
+        if fields.get(field) is not None:
+            values[column] = bool(fields[field])
+    return values
+
+def add_foodstuffs(user_id, items, commit=True):
+    """Takes list of dicts with name, location, exp (optional), pantry and
+       shop, adds them all with one commit, returns their new pantry ids.
+       commit=False only flushes, the caller commits."""
+
+    new_items = []
+    for item in items:
+        exp = item.get("exp")
+        new_items.append(Foodstuff(user_id=user_id, name=item["name"],
+                                   location_id=int(item["location"]),
+                                   exp=int(exp) if exp not in (None, "") else None,
+                                   is_pantry=bool(item.get("pantry", True)),
+                                   is_shopping=bool(item.get("shop", False)),
+                                   barcode_id=item.get("barcode_id")))
+    db.session.add_all(new_items)
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+    return [item.pantry_id for item in new_items]
+
+def normalize_code(code):
+    """Scanners and product dumps write the same barcode different ways
+       (UPC-A is EAN-13 without its leading 0, GTIN-14 pads one more).
+       Returns the EAN-13 or EAN-8 digits, None if it isn't a barcode."""
+
+    code = (code or "").strip()
+    if not code.isdigit():
+        return None
+    if len(code) == 14 and code.startswith("0"):
+        code = code[1:]
+    elif len(code) == 12:
+        code = "0" + code
+    if len(code) not in (8, 13):
+        return None
+    return code
+
+def find_barcode(code):
+    """Takes a scanned code, returns its Barcode or None (one index lookup
+       on ix_barcodes_code)"""
+
+    code = normalize_code(code)
+    if code is None:
+        return None
+    return Barcode.query.filter_by(code=code).first()
+
+def name_counts(user_id):
+    """Every name the user has ever had, with how many foodstuffs had it,
+       as [(name, count), ...]. One GROUP BY over the user's foodstuffs."""
+
+    return db.session.query(Foodstuff.name, db.func.count())\
+                     .filter(Foodstuff.user_id == user_id)\
+                     .group_by(Foodstuff.name).all()
+
+def popular_names(limit):
+    """The limit names the most users have, [(name, users), ...]"""
+
+    users = db.func.count(db.distinct(Foodstuff.user_id))
+    return db.session.query(db.func.min(Foodstuff.name), users)\
+                     .group_by(db.func.lower(Foodstuff.name))\
+                     .order_by(users.desc()).limit(limit).all()
+
+@read_only
 def make_pantry(user_id):
-    """Iterate through list of location objects, pulling all foodstuffs that
-       match location id, append to pantry dictionary of
-       location_name:[list of matching foodstuffs]"""
-    
-    user_locs = get_locs(user_id)
-    pantry = OrderedDict()
+    """Build the pantry with one query: user's locations outer joined to their
+       in-pantry foodstuffs, ordered by location then item name. Rows are
+       grouped into pantry dictionary of location obj:[[name, pantry_id], ...]
+       Locations with no items still get an (empty) entry, so the keys of the
+       returned dict double as the user's location list."""
+
+    rows = db.session.query(Location, Foodstuff.name, Foodstuff.pantry_id)\
+             .outerjoin(Foodstuff, db.and_(
+                        Foodstuff.location_id == Location.location_id,
+                        Foodstuff.user_id == user_id,
+                        Foodstuff.is_pantry == True))\
+             .filter(Location.user_id == user_id)\
+             .order_by(Location.location_name, Location.location_id,
+                       Foodstuff.name).all()
 
-    for loc in user_locs:
-        # Make master list that we can add to, this will become the value
-        items = []
-        # Make a list of all foods objects in this location
-        item_list = Foodstuff.query.filter_by(location_id=loc.location_id,
-                    user_id=user_id, is_pantry=True).order_by(Foodstuff.name).all()
-
-        """Make a list of a food object's name and id, append this list to the
-        master list"""
-        for each in item_list:
-            temp = []
-            temp.append(each.name)
-            temp.append(each.pantry_id)
-            items.append(temp)
-
-        """Master list is now a list of lists, the internal lists have only the 
-        foodstuff info our page needs, this master list becomes the value in 
-        the pantry dictionary, where key is name of location."""
-        pantry[loc] = items
+    pantry = OrderedDict()
+    for loc, name, pantry_id in rows:
+        # Every location becomes a key, even if the outer join found no food
+        items = pantry.setdefault(loc, [])
+        if pantry_id is not None:
+            items.append([name, pantry_id])
     return pantry
 
 def make_new_user(uname, pword, fname, lname, email, time_zone):
-    """Instantiate a User, add to db"""
+    """Instantiate a User, add to db, returns the new user obj"""
 
     new_user = User(username=uname, pword=pword, fname=fname,
                         lname=lname, email=email, time_zone=time_zone)
     db.session.add(new_user)
     db.session.commit()
+    return new_user
 
 def better_than_boolean(str):
     """AJAX won't give me booleans so I'll make them myself"""
@@ -242,9 +489,12 @@ def better_than_boolean(str):
         return str
 
 def get_tz(user_id):
-    """Get user's time zone from db"""
+    """Get user's time zone, from the request's current user if it's them,
+       otherwise from db"""
 
-    user_obj = User.query.filter_by(user_id=user_id).one()
+    user_obj = current_user() if has_request_context() else None
+    if user_obj is None or user_obj.user_id != user_id:
+        user_obj = User.query.filter_by(user_id=user_id).one()
     tz = user_obj.time_zone
 
     return tz
@@ -1,37 +1,183 @@
 from unittest import TestCase
+from datetime import datetime, timedelta
+import json
+import flask
 # import doctest
-from server import app, get_user_by_uname
-from tablesetup import connect_to_db, db, Foodstuff, User, Location
+from sqlalchemy import event, create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session
+from server import create_app, warmup, get_user_by_uname
+from tablesetup import (connect_to_db, db, Foodstuff, User, Location, Barcode,
+                        expiry, PantryPool, POOL_SETTINGS, setting_from_env)
+import tablesetup
 from seed import load_users, load_locations, load_items
+from migrations import (MIGRATIONS, upgrade, schema_migrations,
+                        applied_versions)
+import pantry_cache
+import delivery_search
+import passwords
+import pantry_functions
+import bulk_load
+import loadtest
+import digest
+import barcode_import
+import suggestions
+import replicas
+import request_metrics
+import logging
+from fake_yelp import FakeYelp
+import os
+import subprocess
+import sys
+import threading
+import time
+import smtplib
+from sqlalchemy import inspect
 from pantry_functions import (login_required, get_user_by_uname, is_pword,
                               hash_it, basic_locs, get_locs, eatme_generator,
                               get_shop_lst, refilled, out_of_stock, to_refill,
-                              make_pantry, make_new_user)
-
-class UnitTests(TestCase):
-    """Test the remote pantry functions from pantry_functions"""
+                              make_pantry, make_new_user, set_status,
+                              add_to_pan, remove_from_shop, history_generator,
+                              rehash_if_needed, expiring_within)
+
+
+# One database per parallel worker: TEST_WORKER=gw1 (parallel_tests.py) or
+# pytest-xdist's PYTEST_XDIST_WORKER uses testdb_gw1, plain runs use testdb
+WORKER = os.environ.get("TEST_WORKER") or os.environ.get("PYTEST_XDIST_WORKER")
+TEST_DB = "postgresql:///testdb" + ("_" + WORKER if WORKER else "")
+# Migration and bulk load tests need DDL and real commits, they get their own
+SCRATCH_DB = TEST_DB + "_scratch"
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": TEST_DB})
+
+# bcrypt cost 10 hashes of the fake users' passwords, so loading them is free
+FAKE_HASHES = {
+    "secret1": "$2b$10$HI07dXFUwiYcvZFRHt9X3uGyjL.foJEnbk48FFKCTsl5oZHXAEfty",
+    "secret2": "$2b$10$f4q41vc.yZkrJFEVaYloNONOwoyowp13Q1zFNhY7tGLDYJebDx0VG",
+    "secret3": "$2b$10$rBxwOd0/cAxDQkKj.BaNsudMcOVpIhJ52jzO4igxQcH8A.jKvqU2a",
+}
+
+
+def create_database(db_uri):
+    """CREATE DATABASE for db_uri if it isn't there yet"""
+
+    url = make_url(db_uri)
+    name = url.database
+    url.database = "postgres"
+    engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    try:
+        if not engine.execute("SELECT 1 FROM pg_database WHERE datname = %s",
+                              name).first():
+            engine.execute('CREATE DATABASE "{}"'.format(name))
+    finally:
+        engine.dispose()
+
+def use_db(db_uri):
+    """Point the app at db_uri (if it isn't already), with a fresh session"""
+
+    if app.config.get('SQLALCHEMY_DATABASE_URI') != db_uri:
+        connect_to_db(app, db_uri)
+    # A session from before would still be on the old engine
+    db.session.remove()
+
+def setUpModule():
+    """Schema and fake data once for the whole run, every DbTestCase test
+       rolls back to this state"""
+
+    create_database(TEST_DB)
+    create_database(SCRATCH_DB)
+    use_db(TEST_DB)
+    # Whatever an interrupted run left behind
+    db.drop_all()
+    db.create_all()
+    load_users("fake_data/u.fake_users", FAKE_HASHES)
+    load_locations("fake_data/u.fake_locations")
+    load_items("fake_data/u.fake_foods")
+    db.session.remove()
+
+def tearDownModule():
+    use_db(TEST_DB)
+    db.drop_all()
+
+def restart_savepoint(session, transaction):
+    """The code under test committed (or rolled back), which only ended the
+       savepoint, start a new one for it to use next"""
+
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+SAVEPOINTS = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+def uncount_savepoint(conn, cursor, statement, parameters, context,
+                      executemany):
+    """Takes a fixture savepoint back out of request_metrics' count (this
+       listener goes after request_metrics' own)"""
+
+    if (statement.startswith(SAVEPOINTS) and flask.has_request_context() and
+            "sql_count" in flask.g):
+        flask.g.sql_count -= 1
+        if flask.g.sql_statements and flask.g.sql_statements[-1][1] == statement:
+            flask.g.sql_statements.pop()
+
+
+class DbTestCase(TestCase):
+    """Tests against testdb's fake data. Everything a test does happens in
+       one transaction that gets rolled back afterwards; db.session commits
+       only release a savepoint inside it."""
 
     def setUp(self):
-        """Runs before each test, gives testdb with fake_data"""
-        
-        # Connect to test database (must have 'createdb testdb' already!)
-        connect_to_db(app, "postgresql:///testdb")
+        use_db(TEST_DB)
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
 
-        # Create tables and add fake_data
-        db.create_all()
-        user_file = "fake_data/u.fake_users"
-        loc_file = "fake_data/u.fake_locations"
-        food_file = "fake_data/u.fake_foods"
-        load_users(user_file)
-        load_locations(loc_file)
-        load_items(food_file)
+        factory = db.create_session({'bind': self.connection, 'binds': {}})
+        event.listen(factory, "after_transaction_end", restart_savepoint)
 
-    def tearDown(self):
-        """Runs after each test, deletes test database"""
+        def make_session():
+            session = factory()
+            session.begin_nested()
+            return session
+
+        # Sessions made after a request tears down its own get a savepoint too
+        self.real_session = db.session
+        db.session = scoped_session(make_session,
+                                    scopefunc=threading.current_thread)
+
+        # The savepoints above aren't the code's queries, keep them out of
+        # the request's query count
+        event.listen(Engine, "after_cursor_execute", uncount_savepoint)
 
+    def tearDown(self):
+        event.remove(Engine, "after_cursor_execute", uncount_savepoint)
         db.session.remove()
-        db.session.close()
-        db.drop_all()
+        db.session = self.real_session
+        self.transaction.rollback()
+        self.connection.close()
+
+
+def count_queries(func, *args, **kwargs):
+    """Runs func, returns (result, number of SQL statements it sent to the db)"""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        # The test's own savepoints aren't the code's queries
+        if not statement.startswith(SAVEPOINTS):
+            statements.append(statement)
+
+    # Listen on every engine, the test session can outlive db.engine
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+    return result, len(statements)
+
+class UnitTests(DbTestCase):
+    """Test the remote pantry functions from pantry_functions"""
 
     def test_get_user_by_uname(self):
         """Takes username, returns user obj from database, this test returns
@@ -80,6 +226,28 @@ class UnitTests(TestCase):
         # true positive (no false negatives)
         assert len(Location.query.filter_by(user_id=test_id).all()) == 4
 
+    def test_rehash_if_needed(self):
+        """Login with an old work factor redoes the hash in the background"""
+
+        user = User.query.get(1)
+        assert passwords.cost_of(user.pword) == 10
+
+        rounds, passwords.ROUNDS = passwords.ROUNDS, 11
+        try:
+            with app.test_request_context():
+                thread = rehash_if_needed(user, "secret1")
+                thread.join()
+                # now current, nothing to do
+                db.session.expire_all()
+                user = User.query.get(1)
+                assert passwords.cost_of(user.pword) == 11
+                assert rehash_if_needed(user, "secret1") is None
+        finally:
+            passwords.ROUNDS = rounds
+
+        assert is_pword(user, "secret1") is True
+        assert passwords.stats[11]["rehashes"] >= 1
+
     def test_get_locs(self):
         """Takes user id, returns list of user's location objects"""
 
@@ -88,6 +256,132 @@ class UnitTests(TestCase):
 
         assert query == function
 
+    def test_make_pantry(self):
+        """Pantry is grouped by location, items sorted by name, empty
+           locations still present"""
+
+        pantry = make_pantry(1)
+
+        # keys are the same locations get_locs returns, in the same order
+        assert list(pantry) == get_locs(1)
+        fridge = Location.query.filter_by(user_id=1, location_name='Fridge').one()
+        assert [name for name, pantry_id in pantry[fridge]] == sorted(
+                [name for name, pantry_id in pantry[fridge]])
+        assert ['milk', 1] in pantry[fridge]
+
+        # items out of the pantry drop out, their location stays
+        Foodstuff.query.filter_by(user_id=1).update({'is_pantry': False})
+        db.session.commit()
+        pantry = make_pantry(1)
+        assert list(pantry) == get_locs(1)
+        assert all(items == [] for items in pantry.values())
+
+    def test_make_pantry_query_count(self):
+        """make_pantry should cost one query no matter how many locations
+           or foodstuffs a user has (regression test for the old N+1)"""
+
+        pantry, queries = count_queries(make_pantry, 1)
+        assert queries == 1
+
+        # more locations and items, still one query
+        for i in range(10):
+            loc = Location(user_id=1, location_name="Extra {}".format(i))
+            db.session.add(loc)
+            db.session.flush()
+            db.session.add(Foodstuff(user_id=1, name="thing {}".format(i),
+                                     location_id=loc.location_id))
+        db.session.commit()
+
+        pantry, queries = count_queries(make_pantry, 1)
+        assert queries == 1
+        assert len(pantry) == len(get_locs(1))
+
+    def test_set_status(self):
+        """Bulk status update only touches the user's own items, one query"""
+
+        # 1 and 2 are user 1's, 4 belongs to user 2
+        updated, queries = count_queries(set_status, 1, ['1', '2', '4'],
+                                         is_pantry=False)
+        assert updated == 2
+        # one UPDATE, no per-item SELECTs
+        assert queries == 1
+
+        assert Foodstuff.query.get(1).is_pantry is False
+        assert Foodstuff.query.get(2).is_pantry is False
+        assert Foodstuff.query.get(4).is_pantry is True
+
+        # nothing to do, no query
+        assert count_queries(set_status, 1, [], is_pantry=False) == (0, 0)
+
+    def test_status_helpers(self):
+        """out_of_stock, add_to_pan, to_refill, remove_from_shop flip flags"""
+
+        assert out_of_stock(1, ['3']) == 1
+        assert Foodstuff.query.get(3).is_pantry is False
+        assert add_to_pan(1, ['3']) == 1
+        assert Foodstuff.query.get(3).is_pantry is True
+
+        assert to_refill(1, ['3', '3']) == 1
+        assert Foodstuff.query.get(3).is_shopping is True
+        assert remove_from_shop(1, ['3']) == 1
+        assert Foodstuff.query.get(3).is_shopping is False
+
+        # someone else's item
+        assert to_refill(2, ['3']) == 0
+        assert Foodstuff.query.get(3).is_shopping is False
+
+    def test_eatme_generator(self):
+        """Items with an exp, soonest to expire first, days left worked out
+           in the user's time zone (fake users are -8), in one query"""
+
+        now = datetime.utcnow()
+        milk, eggs, peppercorns = [Foodstuff.query.get(i) for i in (1, 2, 3)]
+        # expires now - 1 day + 6 days - 8 hours = 4 days 16 hours from now
+        milk.last_purch, milk.exp = now - timedelta(days=1), 5
+        # 1 day 16 hours from now
+        eggs.last_purch, eggs.exp = now, 1
+        # long gone: -8 days and change
+        peppercorns.last_purch, peppercorns.exp = now - timedelta(days=10), 1
+        db.session.commit()
+
+        eat_me, queries = count_queries(eatme_generator, 1)
+        assert queries == 1
+        assert eat_me == [[3, 'peppercorns', 'Shelf', -9],
+                          [2, 'eggs', 'Fridge', 1],
+                          [1, 'milk', 'Fridge', 4]]
+
+        # only what's expiring in the next 2 days, at most 1 item
+        assert [row[0] for row in eatme_generator(1, within_days=2)] == [3, 2]
+        assert [row[0] for row in eatme_generator(1, limit=1)] == [3]
+
+        # out of the pantry, off the list
+        out_of_stock(1, ['3'])
+        assert [row[0] for row in eatme_generator(1)] == [2, 1]
+
+    def test_history_generator(self):
+        """History pages go newest first, by cursor, in user's time zone"""
+
+        # every one of user 1's items bought on a different day
+        out_of_stock(1, ['1', '2', '3'])
+        for pantry_id, days_ago in [(1, 3), (2, 1), (3, 2)]:
+            food = Foodstuff.query.get(pantry_id)
+            food.last_purch = datetime(2018, 3, 10, 4) - timedelta(days=days_ago)
+        db.session.commit()
+
+        page, cursor = history_generator(1, per_page=2)
+        # 4am GMT is the evening before in -8
+        assert page == [[2, 'eggs', 'Mar 08, 2018'],
+                        [3, 'peppercorns', 'Mar 07, 2018']]
+        assert cursor is not None
+
+        page, cursor = history_generator(1, cursor, per_page=2)
+        assert page == [[1, 'milk', 'Mar 06, 2018']]
+        assert cursor is None
+
+        # junk cursor starts from the top
+        page, cursor = history_generator(1, 'junk', per_page=2)
+        assert page[0][0] == 2
+
     def test_refilled(self):
         """Processes form from @store page: removes item from shopping list,
            change pantry status to true,
@@ -108,7 +402,7 @@ class UnitTests(TestCase):
         assert peppercorns.is_shopping != False
 
 
-        refilled([3], [''], [3])
+        refilled(1, [3], [''], [3])
 
         assert peppercorns.is_pantry == True
         assert peppercorns.is_shopping == False
@@ -118,7 +412,7 @@ class UnitTests(TestCase):
 
         assert peppercorns.exp == 10
 
-        refilled([3], [''], [3])
+        refilled(1, [3], [''], [3])
 
         assert peppercorns.exp == 10
 
@@ -127,7 +421,7 @@ class UnitTests(TestCase):
 
         assert peppercorns.exp != 5
 
-        refilled([3], ['5'], [3])
+        refilled(1, [3], ['5'], [3])
 
         assert peppercorns.exp == 5
 
@@ -138,14 +432,531 @@ class UnitTests(TestCase):
         celery.exp = 3
 
         # refill all of them excpet celery, change exp of milk and eggs only
-        refilled([3, 1, 2], ['', '20', '30', '40'], [3, 1, 2, 8])
+        refilled(1, [3, 1, 2], ['', '20', '30', '40'], [3, 1, 2, 8])
 
         assert peppercorns.exp == 10
         assert milk.exp == 20
         assert eggs.exp == 30
         assert celery.exp != 40
 
-class FlaskIntegrationTests(TestCase):
+    def test_refilled_query_count(self):
+        """Restocking is one UPDATE however long the shopping list is, and
+           doesn't touch other users' items"""
+
+        to_refill(1, ['1', '2', '3'])
+        Foodstuff.query.get(2).exp = 7
+        db.session.commit()
+
+        # whole page: blank exp for eggs (keeps 7), new exp for milk,
+        # user 2's milk (4) snuck into the refills
+        updated, queries = count_queries(refilled, 1, ['1', '2', '4'],
+                                         ['12', '', ''], ['1', '2', '3'])
+        assert updated == 2
+        assert queries == 1
+
+        milk, eggs, peppercorns = [Foodstuff.query.get(i) for i in (1, 2, 3)]
+        assert (milk.exp, milk.is_shopping, milk.is_pantry) == (12, False, True)
+        assert (eggs.exp, eggs.is_shopping, eggs.is_pantry) == (7, False, True)
+        # on the page but not refilled, still on the shopping list
+        assert peppercorns.is_shopping is True
+
+    def test_expires_at_in_sync(self):
+        """expires_at follows last_purch and exp on ORM edits, adds and the
+           bulk UPDATEs, and is left alone by ones that don't touch them"""
+
+        milk = Foodstuff.query.get(1)
+        milk.exp = 5
+        db.session.commit()
+        assert milk.expires_at == expiry(milk.last_purch, 5)
+
+        milk.exp = None
+        db.session.commit()
+        assert milk.expires_at is None
+
+        new_item = Foodstuff(user_id=1, name='jam', location_id=1, exp='30')
+        db.session.add(new_item)
+        db.session.commit()
+        assert new_item.expires_at == new_item.last_purch + timedelta(days=31)
+
+        # refilled with a new exp, and with the exp already in the row
+        to_refill(1, ['1', '2'])
+        Foodstuff.query.get(2).exp = 7
+        db.session.commit()
+        refilled(1, ['1', '2'], ['12', ''], ['1', '2'])
+        for pantry_id, exp in [(1, 12), (2, 7)]:
+            item = Foodstuff.query.get(pantry_id)
+            assert abs(item.expires_at - expiry(item.last_purch, exp)) < timedelta(seconds=1)
+
+        purch = datetime(2018, 3, 1, 12)
+        set_status(1, ['2'], last_purch=purch)
+        assert Foodstuff.query.get(2).expires_at == datetime(2018, 3, 9, 12)
+        set_status(1, ['2'], is_pantry=False)
+        assert Foodstuff.query.get(2).expires_at == datetime(2018, 3, 9, 12)
+
+    def test_expiring_within(self):
+        """Everyone's in-pantry items expiring in the next so many hours"""
+
+        now = datetime.utcnow()
+        # bought 3 days ago, 2 day exp: expires in the next 24 hours
+        set_status(1, ['1'], last_purch=now - timedelta(days=3, hours=-1), exp=2)
+        # user 2's, expires in 47 hours
+        set_status(2, ['4'], last_purch=now - timedelta(hours=25), exp=2)
+        # already expired, and out of the pantry
+        set_status(1, ['2'], last_purch=now - timedelta(days=5), exp=1)
+        set_status(1, ['3'], last_purch=now, exp=0, is_pantry=False)
+
+        assert [item.pantry_id for item in expiring_within(24, now)] == [1]
+        assert [item.pantry_id for item in expiring_within(48, now)] == [1, 4]
+
+class PoolTests(TestCase):
+    """Test the connection pool settings and counters"""
+
+    def test_settings(self):
+        """Pool settings go to create_engine, pgbouncer mode has no pool of
+           its own, SQLite is left to Flask-SQLAlchemy"""
+
+        test_app = flask.Flask("pooltest")
+        test_app.config['SQLALCHEMY_NATIVE_UNICODE'] = None
+        for key, variable, default in POOL_SETTINGS:
+            test_app.config[key] = default
+        test_app.config['DB_POOL_SIZE'] = 3
+
+        options = {}
+        db.apply_driver_hacks(test_app, make_url("postgresql:///x"), options)
+        assert options['poolclass'] is PantryPool
+        assert (options['pool_size'], options['pre_ping']) == (3, True)
+
+        test_app.config['DB_PGBOUNCER'] = True
+        options = {}
+        db.apply_driver_hacks(test_app, make_url("postgresql:///x"), options)
+        assert options['poolclass'].__name__ == 'NullPool'
+        assert 'pool_size' not in options
+
+        options = {}
+        db.apply_driver_hacks(test_app, make_url("sqlite:////tmp/x.db"), options)
+        assert options.get('poolclass') is not PantryPool
+
+    def test_setting_from_env(self):
+        os.environ['PANTRY_TEST_SETTING'] = 'yes'
+        try:
+            assert setting_from_env('PANTRY_TEST_SETTING', False) is True
+            os.environ['PANTRY_TEST_SETTING'] = '12'
+            assert setting_from_env('PANTRY_TEST_SETTING', 5) == 12
+        finally:
+            del os.environ['PANTRY_TEST_SETTING']
+        assert setting_from_env('PANTRY_TEST_SETTING', 5) == 5
+
+    def test_pool_stats(self):
+        """Checkouts, time held, waits and timeouts are counted"""
+
+        engine = create_engine(TEST_DB, poolclass=PantryPool, pool_size=1,
+                               max_overflow=0, pool_timeout=0.2)
+        tablesetup.reset_pool_stats()
+        try:
+            conn = engine.connect()
+            with self.assertRaises(Exception):
+                engine.connect()
+            conn.close()
+        finally:
+            engine.dispose()
+
+        stats = tablesetup.pool_stats
+        assert (stats['checkouts'], stats['timeouts'], stats['in_use']) == (1, 1, 0)
+        assert stats['max_wait_seconds'] >= 0.2
+        assert stats['hold_seconds'] >= 0.2
+
+    def test_pool_stats_after_dispose(self):
+        """The pool engine.dispose() makes counts each checkout once"""
+
+        engine = create_engine(TEST_DB, poolclass=PantryPool, pool_size=1)
+        try:
+            engine.connect().close()
+            engine.dispose()
+            tablesetup.reset_pool_stats()
+            engine.connect().close()
+        finally:
+            engine.dispose()
+
+        stats = tablesetup.pool_stats
+        assert (stats['checkouts'], stats['in_use']) == (1, 0)
+
+    def test_pre_ping(self):
+        """A connection the server dropped is replaced on checkout"""
+
+        engine = create_engine(TEST_DB, poolclass=PantryPool, pool_size=1)
+        try:
+            conn = engine.connect()
+            pid = conn.scalar("SELECT pg_backend_pid()")
+            conn.close()
+            create_engine(TEST_DB, poolclass=PantryPool).execute(
+                "SELECT pg_terminate_backend(%s)", pid)
+            time.sleep(0.1)
+
+            conn = engine.connect()
+            assert conn.scalar("SELECT 1") == 1
+            assert conn.scalar("SELECT pg_backend_pid()") != pid
+            conn.close()
+        finally:
+            engine.dispose()
+
+
+class AppFactoryTests(TestCase):
+    """Test create_app, warmup and the wsgi entry point"""
+
+    def run_python(self, code, secret_key=None):
+        """Runs code in a new interpreter, returns its output"""
+
+        env = dict(os.environ)
+        env.pop('PANTRY_SECRET_KEY', None)
+        if secret_key:
+            env['PANTRY_SECRET_KEY'] = secret_key
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output([sys.executable, "-c", code], cwd=here,
+                                       env=env, stderr=subprocess.STDOUT)
+
+    def test_create_app(self):
+        """Every call makes a separate app, config beats the defaults"""
+
+        other = create_app({'SQLALCHEMY_DATABASE_URI': TEST_DB,
+                            'SECRET_KEY': 'other', 'DB_POOL_SIZE': 2})
+        try:
+            assert other is not app
+            assert other.secret_key == 'other'
+            assert other.config['DB_POOL_SIZE'] == 2
+            assert 'pantry.pantry_display' in other.view_functions
+            assert 'metrics' in other.view_functions
+        finally:
+            db.app = app
+
+    def test_workers_need_shared_cache(self):
+        """Several workers with per process caches would serve each other
+           stale pages, create_app refuses"""
+
+        with self.assertRaises(RuntimeError):
+            create_app({'SQLALCHEMY_DATABASE_URI': TEST_DB,
+                        'PANTRY_WORKERS': 3})
+        assert db.app is app
+
+    def test_lazy_imports(self):
+        """Importing the server leaves out what only some setups use"""
+
+        output = self.run_python("import sys, server; print sorted(m for m in "
+                                 "('flask_debugtoolbar', 'requests') "
+                                 "if m in sys.modules)")
+        assert output.strip() == "[]"
+
+    def test_warmup(self):
+        """Warmup fills the pool and compiles the templates"""
+
+        seconds = warmup(app)
+        assert seconds > 0
+        assert db.engine.pool.checkedin() >= app.config['DB_POOL_SIZE']
+        cached = set(key[1] for key in app.jinja_env.cache.keys())
+        assert set(['pantry.html', 'homepage.html']) <= cached
+        assert request_metrics.startup['warmup'] == seconds
+
+    def test_max_connections(self):
+        """Workers' pools that could go over max_connections are refused"""
+
+        test_app = flask.Flask("connectiontest")
+        test_app.config.update(SQLALCHEMY_DATABASE_URI=TEST_DB,
+                               DB_PGBOUNCER=False, DB_POOL_SIZE=4,
+                               DB_MAX_OVERFLOW=0)
+        tablesetup.check_max_connections(test_app, 2)
+        with self.assertRaises(RuntimeError):
+            tablesetup.check_max_connections(test_app, 100000)
+        # pgbouncer shares the connections
+        test_app.config['DB_PGBOUNCER'] = True
+        tablesetup.check_max_connections(test_app, 100000)
+
+    def test_startup_metrics(self):
+        """Startup steps and the first request's time are on /metrics"""
+
+        client = app.test_client()
+        client.get('/')
+        assert 'first_request' in request_metrics.startup
+        result = client.get('/metrics')
+        self.assertIn('pantry_startup_seconds{step="create_app"}', result.data)
+        self.assertIn('pantry_startup_seconds{step="first_request"}',
+                      result.data)
+
+    def test_forked(self):
+        """A forked worker's first request counts from the fork"""
+
+        started_at = request_metrics.started_at
+        request_metrics.started_at = time.time() - 1000
+        request_metrics.startup['first_request'] = 1000
+        try:
+            request_metrics.forked()
+            assert 'first_request' not in request_metrics.startup
+            app.test_client().get('/')
+            assert request_metrics.startup['first_request'] < 100
+        finally:
+            request_metrics.started_at = started_at
+
+    def test_wsgi(self):
+        """The entry point wants a real secret key, and times its import"""
+
+        code = ("import wsgi, request_metrics; print wsgi.app.secret_key, "
+                "sorted(request_metrics.startup)")
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            self.run_python(code)
+        self.assertIn("PANTRY_SECRET_KEY", raised.exception.output)
+
+        output = self.run_python(code, secret_key="s3kr1t")
+        assert output.strip() == "s3kr1t ['create_app', 'import']"
+
+
+class PasswordTests(TestCase):
+    """Tests for the hashing pool, no db needed"""
+
+    def tearDown(self):
+        passwords.stop()
+
+    def test_inline(self):
+        """Without a pool, hashing happens right here"""
+
+        hashed = passwords.hash_password("secret1")
+        assert passwords.check_password("secret1", hashed) is True
+        assert passwords.check_password("secret", hashed) is False
+
+    def test_pool(self):
+        """Same answers from the pool"""
+
+        passwords.start(processes=2)
+        hashed = passwords.hash_password(u"s\xe9cret1")
+        assert hashed.startswith("$2b$10$")
+        assert passwords.check_password(u"s\xe9cret1", hashed) is True
+        assert passwords.check_password("secret", hashed) is False
+
+    def test_cost_of(self):
+        """Reads the work factor out of a hash"""
+
+        assert passwords.cost_of("$2b$12$abcdefghijklmnopqrstuv") == 12
+        assert passwords.needs_rehash("$2b$04$abcdefghijklmnopqrstuv")
+        assert not passwords.needs_rehash("$2b$14$abcdefghijklmnopqrstuv")
+        assert not passwords.needs_rehash(passwords.hash_password("x"))
+
+    def test_calibrate(self):
+        """Picks the most rounds that fit, stops once over the target"""
+
+        rounds, timings = passwords.calibrate(0, min_rounds=4, max_rounds=6,
+                                              samples=1)
+        assert rounds == 4
+        assert timings.keys() == [4]
+
+        rounds, timings = passwords.calibrate(10000, min_rounds=4,
+                                              max_rounds=5, samples=1)
+        assert rounds == 5
+
+    def test_check_stats(self):
+        """Checks are counted per cost level"""
+
+        hashed = passwords.bcrypt_hash("x", 4)
+        before = passwords.stats[4]["checks"]
+        passwords.check_password("x", hashed)
+        assert passwords.stats[4]["checks"] == before + 1
+        assert "cost" in passwords.report()[0]
+
+    def test_backpressure(self):
+        """No room in the queue, HashingBusy right away"""
+
+        passwords.start(processes=1, max_queue=0)
+        self.assertRaises(passwords.HashingBusy, passwords.hash_password, "x")
+
+    def test_slot_held_until_done(self):
+        """A job we stopped waiting for keeps its slot until it finishes,
+           errors in the pool come back as themselves"""
+
+        passwords.start(processes=1, max_queue=1)
+        wait, passwords.WAIT = passwords.WAIT, 0.01
+        try:
+            self.assertRaises(passwords.HashingBusy, passwords.run,
+                              passwords.bcrypt_hash, "x", 12)
+            with self.assertRaises(passwords.HashingBusy) as busy:
+                passwords.run(passwords.bcrypt_hash, "x", 4)
+            self.assertIn("full", str(busy.exception))
+        finally:
+            passwords.WAIT = wait
+
+        # Freed once the slow hash is done
+        for _ in range(100):
+            if passwords.slots.acquire(False):
+                passwords.slots.release()
+                break
+            time.sleep(0.05)
+        assert passwords.run(passwords.bcrypt_hash, "x", 4).startswith("$2b$04$")
+        self.assertRaises(ValueError, passwords.run, passwords.bcrypt_check,
+                          "x", "not a hash")
+
+
+class MigrationTests(TestCase):
+    """Test the versioned schema migrations"""
+
+    def setUp(self):
+        """Runs before each test, gives an empty scratch db"""
+
+        use_db(SCRATCH_DB)
+        db.drop_all()
+        schema_migrations.drop(bind=db.engine, checkfirst=True)
+
+    def tearDown(self):
+        """Runs after each test, deletes test database"""
+
+        schema_migrations.drop(bind=db.engine, checkfirst=True)
+        db.session.remove()
+        db.drop_all()
+
+    def test_upgrade(self):
+        """Migrations create the tables and indexes, and record versions"""
+
+        applied = upgrade(db.engine)
+        assert applied == [version for version, name, steps in MIGRATIONS]
+
+        index_names = [ix['name'] for ix in inspect(db.engine).get_indexes('foodstuffs')]
+        assert 'ix_foodstuffs_pantry' in index_names
+        assert 'ix_foodstuffs_history' in index_names
+
+    def test_upgrade_twice(self):
+        """Running migrations again applies nothing"""
+
+        upgrade(db.engine)
+        assert upgrade(db.engine) == []
+
+    def test_upgrade_existing_tables(self):
+        """A db made by db.create_all() (no version table) upgrades cleanly,
+           indexes that already exist are skipped"""
+
+        db.create_all()
+        applied = upgrade(db.engine)
+        assert len(applied) == len(MIGRATIONS)
+
+    def test_backfill_expires_at(self):
+        """A db from before expires_at gets the column, filled in for rows
+           with an exp, and the expiry indexes in place of the old one"""
+
+        upgrade(db.engine, target=2)
+        db.engine.execute("ALTER TABLE foodstuffs DROP COLUMN expires_at")
+        db.engine.execute("INSERT INTO users (user_id, username, pword, fname, "
+                          "lname, date_created, email, time_zone, is_active) "
+                          "VALUES (1, 'u', 'x', 'f', 'l', now(), 'e', -8, true)")
+        db.engine.execute("INSERT INTO foodstuffs (user_id, name, is_shopping, "
+                          "is_pantry, last_purch, first_add, exp) VALUES "
+                          "(1, 'milk', false, true, '2018-03-01 12:00', now(), 5), "
+                          "(1, 'salt', false, true, '2018-03-01 12:00', now(), NULL)")
+
+        assert upgrade(db.engine, target=3) == [3]
+        rows = db.engine.execute("SELECT name, expires_at FROM foodstuffs "
+                                 "ORDER BY name").fetchall()
+        assert rows == [('milk', datetime(2018, 3, 7, 12)), ('salt', None)]
+
+        index_names = [ix['name'] for ix in inspect(db.engine).get_indexes('foodstuffs')]
+        assert 'ix_foodstuffs_expires' in index_names
+        assert 'ix_foodstuffs_user_expires' in index_names
+        assert 'ix_foodstuffs_exp' not in index_names
+
+
+class BulkLoadTests(TestCase):
+    """Test the synthetic data generator and bulk loader"""
+
+    def setUp(self):
+        """Runs before each test, gives an empty scratch db"""
+
+        use_db(SCRATCH_DB)
+        db.drop_all()
+        schema_migrations.drop(bind=db.engine, checkfirst=True)
+
+    def tearDown(self):
+        """Runs after each test, deletes test database"""
+
+        db.session.remove()
+        db.drop_all()
+        schema_migrations.drop(bind=db.engine, checkfirst=True)
+
+    def test_generator_deterministic(self):
+        """Same seed, same rows"""
+
+        now = datetime(2018, 3, 1)
+        first = list(bulk_load.synthetic_foods(3, 2, 10, now, seed=7))
+        second = list(bulk_load.synthetic_foods(3, 2, 10, now, seed=7))
+        assert first == second
+        assert len(first) == 30
+        # Every item is in one of its own user's locations
+        for food in first:
+            assert (food[1] - 1) * 2 < food[7] <= food[1] * 2
+
+    def test_load_synthetic(self):
+        """Schema from the migrations, COPY loads every row, sequences carry
+           on after them"""
+
+        results = bulk_load.load_synthetic(db.engine, 5, 3, 20, verbose=False)
+        with db.engine.connect() as conn:
+            assert applied_versions(conn) == set(
+                version for version, name, steps in MIGRATIONS)
+        assert results['foodstuffs'][0] == 100
+        assert Foodstuff.query.count() == 100
+        assert Location.query.filter_by(user_id=5).count() == 3
+
+        user = User(username="after", pword="x", fname="a", lname="b",
+                    email="c")
+        db.session.add(user)
+        db.session.commit()
+        assert user.user_id == 6
+
+    def test_insert_rows(self):
+        """The non-COPY path batches, and gets every row in"""
+
+        db.create_all()
+        rows = bulk_load.synthetic_users(12, "hash", datetime.now())
+        count = bulk_load.insert_rows(db.engine, User.__table__,
+                                      bulk_load.USER_COLUMNS, rows,
+                                      batch_size=5)
+        assert count == 12
+        assert User.query.count() == 12
+
+
+class LoadTestTests(TestCase):
+    """Test the HTTP load test harness, on SQLite like it runs by default"""
+
+    db_file = "/tmp/pantry_loadtest_test{}.db".format(WORKER or "")
+
+    def setUp(self):
+        if os.path.exists(self.db_file):
+            os.remove(self.db_file)
+        pantry_cache.configure(maxsize=0)
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+        db.session.remove()
+        os.remove(self.db_file)
+        pantry_cache.configure()
+
+    def test_short_run(self):
+        """Every route gets traffic, nothing errors, eat me works on SQLite"""
+
+        base_url, self.server = loadtest.start_local_server(
+            "sqlite:///" + self.db_file, 5, 3, 20, 0)
+        results = loadtest.run_load(base_url, 5, 3, 2, 20)
+
+        assert results["concurrency"] == 3
+        assert results["total"]["errors"] == 0
+        assert (sorted(results["routes"]) ==
+                sorted(route for route, weight in loadtest.TRAFFIC_MIX))
+        assert results["routes"]["GET /pantry"]["p99_ms"] > 0
+
+        # same as Python would work out
+        with app.app_context():
+            for pantry_id, name, loc, days_left in eatme_generator(1):
+                food = Foodstuff.query.get(pantry_id)
+                user = User.query.get(1)
+                expires = (food.last_purch + timedelta(days=food.exp + 1) +
+                           timedelta(hours=user.time_zone))
+                assert days_left == (expires - datetime.utcnow()).days
+
+
+class FlaskIntegrationTests(DbTestCase):
     """Integration tests for Remote Pantry
         Don't forget to start all function names with test!"""
 
@@ -160,29 +971,17 @@ class FlaskIntegrationTests(TestCase):
         # Fake a user_id in the session so we can get access to pages where this is required
         with self.client.session_transaction() as sess:
             sess['user_id'] = 1
-        
-        # Connect to test database (must have 'createdb testdb' already!)
-        connect_to_db(app, "postgresql:///testdb")
-
-        # Create tables and add fake_data
-        db.create_all()
-        user_file = "fake_data/u.fake_users"
-        loc_file = "fake_data/u.fake_locations"
-        food_file = "fake_data/u.fake_foods"
-        load_users(user_file)
-        load_locations(loc_file)
-        load_items(food_file)
-
-    def tearDown(self):
-        """Runs after each test, deletes test database"""
-
-        db.session.remove()
-        db.session.close()
-        db.drop_all()
+        # Tests here change the db directly, behind the cache's back
+        pantry_cache.configure(maxsize=0)
+        DbTestCase.setUp(self)
 
     def test_homepage(self):
         """Does the homepage display, is Flask working?"""
 
+        # Logged out, so the login form shows
+        with self.client.session_transaction() as sess:
+            del sess['user_id']
+
         result = self.client.get("/")
         self.assertIn("<h1>Hello, world!</h1>", result.data)
         self.assertIn("Login", result.data)
@@ -220,19 +1019,19 @@ class FlaskIntegrationTests(TestCase):
 
         reg_info = {'username': "test4", 'password': "secret123",
                     'fname': 'test', 'lname': 'number 4',
-                    'email': 'testeyemailio@gmail.com'}
+                    'email': 'testeyemailio@gmail.com', 'time_zone': '-8'}
 
         result = self.client.post("/register_handle", data=reg_info,
                                   follow_redirects=True)
         self.assertIn("Successfully registered", result.data)
-        self.assertIn("<h3>Add a new item to the pantry:</h3>", result.data)
+        self.assertIn("Add a New Item", result.data)
 
     def test_default_locations_register(self):
         """Test that a new user gets 4 default locations created upon registration"""
 
         reg_info = {'username': "test4", 'password': "secret123",
                     'fname': 'test', 'lname': 'number 4',
-                    'email': 'testeyemailio@gmail.com'}
+                    'email': 'testeyemailio@gmail.com', 'time_zone': '-8'}
 
         result = self.client.post("/register_handle", data=reg_info,
                                   follow_redirects=True)
@@ -246,7 +1045,7 @@ class FlaskIntegrationTests(TestCase):
 
         reg_info = {'username': "test1", 'password': "secret123",
                     'fname': 'test', 'lname': 'number 4',
-                    'email': 'testeyemailio@gmail.com'}
+                    'email': 'testeyemailio@gmail.com', 'time_zone': '-8'}
 
         result = self.client.post("/register_handle", data=reg_info,
                                   follow_redirects=True)
@@ -268,7 +1067,7 @@ class FlaskIntegrationTests(TestCase):
         result = self.client.post("/add_item", data=food_info,
                                   follow_redirects=True)
         self.assertIn("Successfully added", result.data)
-        self.assertIn("<h3>Add a new item to the pantry:</h3>", result.data)
+        self.assertIn("Add a New Item", result.data)
         # assert user in db.session
                     
 
@@ -283,7 +1082,7 @@ class FlaskIntegrationTests(TestCase):
         result = self.client.post("/add_item", data=food_info,
                                   follow_redirects=True)
         self.assertIn("Successfully added", result.data)
-        self.assertIn("<h3>Add a new item to the pantry:</h3>", result.data)
+        self.assertIn("Add a New Item", result.data)
 
     def test_add_foodstuff(self):
         """Test sqlalchemy db function: add and query"""
@@ -317,19 +1116,246 @@ class FlaskIntegrationTests(TestCase):
     def test_edit_page_display(self):
         """Test that edit page renders"""
 
-        item_info = {'pantry_id': 3}
-
-        result = self.client.get("/edit/3", data=item_info, follow_redirects=True)
+        result = self.client.get("/editpantryitem?pantry_id=3")
         self.assertIn("peppercorns", result.data)
 
     def test_loc_name_update(self):
-        """Test that location name can be updated, checks redirect"""
+        """Test that location name can be updated, new name comes back"""
+
+        loc = {'new_name': "Frigidaire", 'loc_id': 1}
+
+        result = self.client.post("/updatelocationformhandle", data=loc)
+        assert json.loads(result.data)['newName'] == "Frigidaire"
+        assert Location.query.get(1).location_name == "Frigidaire"
 
-        loc = {'new_name': "Frigidaire", 'location_id': 1}
+    def test_update_other_users_items(self):
+        """Ids that aren't the logged in user's are rejected, with a flash"""
 
-        result = self.client.post("/update_loc/1", data=loc,
+        result = self.client.post("/update", data={'empty': ['1', '4']},
                                   follow_redirects=True)
-        self.assertIn("<th>Out of Stock</th>", result.data)
+        self.assertIn("Some items could not be updated.", result.data)
+        assert Foodstuff.query.get(1).is_pantry is False
+        assert Foodstuff.query.get(4).is_pantry is True
+
+    def test_update_bad_ids(self):
+        """Values that aren't ids are skipped, not a 500, and the same id
+           written two ways is one item"""
+
+        result = self.client.post("/update",
+                                  data={'empty': ['1', '01', 'milk']},
+                                  follow_redirects=True)
+        assert result.status_code == 200
+        self.assertNotIn("Some items could not be updated.", result.data)
+        assert Foodstuff.query.get(1).is_pantry is False
+
+        # junk hidden ids and exps on the shopping page
+        result = self.client.post("/restock", data={
+                                  'refill': ['3'], 'exp': ['soon', '9'],
+                                  'hidden_id': ['x', '3']},
+                                  follow_redirects=True)
+        assert result.status_code == 200
+        assert Foodstuff.query.get(3).exp == 9
+
+    def test_history_page(self):
+        """History page lists the user's old items, API gives next cursor"""
+
+        self.client.post("/update", data={'empty': ['1', '2']})
+
+        result = self.client.get("/history")
+        self.assertIn("milk", result.data)
+        self.assertIn("eggs", result.data)
+
+        result = json.loads(self.client.get("/api/history").data)
+        assert set(item['itemName'] for item in result['items']) == set(['milk', 'eggs'])
+        assert result['next'] is None
+
+    def test_register_dupe_no_hash(self):
+        """Taken username is turned away before the password is hashed"""
+
+        def no_hashing(pword):
+            raise AssertionError("hashed a password for a duplicate user")
+
+        reg_info = {'username': "test1", 'password': "secret123",
+                    'fname': 'test', 'lname': 'number 4',
+                    'email': 'testeyemailio@gmail.com', 'time_zone': '-8'}
+
+        hash_password, pantry_functions.hash_password = (
+            pantry_functions.hash_password, no_hashing)
+        try:
+            result = self.client.post("/register_handle", data=reg_info,
+                                      follow_redirects=True)
+        finally:
+            pantry_functions.hash_password = hash_password
+        self.assertIn("There is already an account linked to this username.",
+                      result.data)
+
+    def test_login_busy(self):
+        """Full hashing queue turns logins away with a message"""
+
+        passwords.start(processes=1, max_queue=0)
+        try:
+            result = self.client.post("/login_handle",
+                                      data={'username': "test1",
+                                            'password': "secret1"},
+                                      follow_redirects=True)
+        finally:
+            passwords.stop()
+        self.assertIn("please try again", result.data)
+
+    def test_user_loaded_once(self):
+        """Every route loads the User row at most once per request"""
+
+        gets = ["/", "/pantry", "/shop", "/eatme", "/history", "/api/history",
+                "/editpantryitem?pantry_id=3"]
+        posts = [("/update", {'empty': '3'}),
+                 ("/login_handle", {'username': 'test1', 'password': 'secret1'}),
+                 ("/register_handle", {'username': "test4", 'password': "secret123",
+                                       'fname': 'test', 'lname': 'number 4',
+                                       'email': 'testeyemailio@gmail.com',
+                                       'time_zone': '-5'})]
+
+        # Keep the request context around after each request to look at g
+        with self.client as client:
+            for url in gets:
+                client.get(url)
+                assert flask.g.get("user_loads", 0) <= 1, url
+            client.post("/api/batch", content_type='application/json',
+                        data=json.dumps({'ops': [{'op': 'edit', 'id': 3,
+                                                  'name': 'pepper'}],
+                                         'parts': ['eatme']}))
+            assert flask.g.get("user_loads", 0) <= 1, "/api/batch"
+            for url, data in posts:
+                client.post(url, data=data)
+                assert flask.g.get("user_loads", 0) <= 1, url
+            # the new user, reloaded after its commit, counts too
+            assert flask.g.user_loads == 1
+
+    def test_metrics(self):
+        """Query count, latency and status per route show up on /metrics"""
+
+        request_metrics.reset()
+        self.client.get("/pantry")
+        self.client.get("/editpantryitem?pantry_id=3")
+        self.client.get("/editpantryitem?pantry_id=4")
+
+        result = self.client.get("/metrics")
+        assert result.mimetype == "text/plain"
+        # make_pantry is one query, nothing else needed the db
+        self.assertIn('pantry_request_queries_bucket{route="/pantry",le="1"} 1',
+                      result.data)
+        self.assertIn('pantry_request_seconds_count{route="/pantry"} 1',
+                      result.data)
+        # query string isn't part of the route
+        self.assertIn('pantry_responses_total{route="/editpantryitem",'
+                      'method="GET",status="200"} 2', result.data)
+        self.assertIn('pantry_password_checks_total', result.data)
+        self.assertIn('pantry_db_pool_checkouts_total', result.data)
+        self.assertIn('pantry_db_pool_size 5', result.data)
+
+    def test_metrics_access(self):
+        """Only local, unproxied requests see /metrics, or with a token
+           anyone who has it"""
+
+        forwarded = {'X-Forwarded-For': '203.0.113.9'}
+        assert self.client.get("/metrics").status_code == 200
+        assert self.client.get("/metrics", headers=forwarded).status_code == 404
+        assert self.client.get("/metrics", environ_base={
+               'REMOTE_ADDR': '203.0.113.9'}).status_code == 404
+
+        app.config['METRICS_TOKEN'] = 'hush'
+        try:
+            assert self.client.get("/metrics").status_code == 404
+            result = self.client.get("/metrics", headers=dict(
+                     forwarded, Authorization='Bearer hush'))
+            assert result.status_code == 200
+        finally:
+            app.config['METRICS_TOKEN'] = request_metrics.METRICS_TOKEN
+
+    def test_slow_request_logged(self):
+        """Requests over the threshold are logged with their statements"""
+
+        messages = []
+
+        class Collect(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+
+        handler = Collect()
+        request_metrics.log.addHandler(handler)
+        app.config['SLOW_REQUEST_MS'] = 0
+        try:
+            self.client.get("/pantry")
+        finally:
+            app.config['SLOW_REQUEST_MS'] = request_metrics.SLOW_REQUEST_MS
+            request_metrics.log.removeHandler(handler)
+
+        assert len(messages) == 1
+        self.assertIn("SLOW GET /pantry", messages[0])
+        self.assertIn("1 queries", messages[0])
+        self.assertIn("FROM locations", messages[0])
+
+    def test_api_state(self):
+        """Whole screen state in one response"""
+
+        state = json.loads(self.client.get("/api/state").data)
+        assert sorted(state) == ['eatme', 'locations', 'pantry', 'shopping']
+        assert [1, 'Fridge', [['eggs', 2], ['milk', 1]]] in state['pantry']
+        assert [3, 'Shelf'] in state['locations']
+        assert state['shopping'] == []
+
+        state = json.loads(self.client.get("/api/state?parts=locations").data)
+        assert list(state) == ['locations']
+
+    def test_api_batch(self):
+        """Several changes in one request, state comes back with them"""
+
+        ops = [{'op': 'empty', 'ids': [1]},
+               # 4 is user 2's milk
+               {'op': 'refill', 'ids': [3, 4]},
+               {'op': 'edit', 'id': 2, 'name': 'duck eggs', 'exp': '7',
+                'location': '2'},
+               {'op': 'add', 'items': [{'name': 'kiwi', 'location': 3},
+                                       {'name': 'jam', 'location': 3,
+                                        'exp': 30, 'pantry': False,
+                                        'shop': True}]}]
+        result, queries = count_queries(
+            self.client.post, "/api/batch", content_type='application/json',
+            data=json.dumps({'ops': ops, 'parts': ['pantry', 'shopping']}))
+        body = json.loads(result.data)
+
+        assert body['results'] == [1, 1, 1, 2]
+        assert Foodstuff.query.get(4).is_shopping is False
+        pantry = dict((loc_id, items) for loc_id, name, items
+                      in body['state']['pantry'])
+        assert pantry[1] == []
+        assert ['duck eggs', 2] in pantry[2]
+        assert 'kiwi' in [name for name, pantry_id in pantry[3]]
+        assert sorted(row[1] for row in body['state']['shopping']) == [
+               'jam', 'peppercorns']
+        assert Foodstuff.query.get(2).exp == 7
+        # Roughly one per op plus one per part, nothing per item read back
+        assert queries <= 10
+
+    def test_api_batch_errors(self):
+        """Bad ops are refused, with how far the batch got, and the ops
+           before them are undone"""
+
+        ops = [{'op': 'empty', 'ids': [1]},
+               {'op': 'add', 'items': [{'name': 'kiwi', 'location': 3}]},
+               {'op': 'explode'}]
+        result = self.client.post("/api/batch", data=json.dumps({'ops': ops}),
+                                  content_type='application/json')
+        assert result.status_code == 400
+        assert json.loads(result.data)['results'] == [1, 1]
+        assert Foodstuff.query.get(1).is_pantry is True
+        assert Foodstuff.query.filter_by(user_id=1, name='kiwi').count() == 0
+
+        # location 4 is user 2's
+        ops = [{'op': 'edit', 'id': 2, 'location': 4}]
+        result = self.client.post("/api/batch", data=json.dumps({'ops': ops}),
+                                  content_type='application/json')
+        assert result.status_code == 400
+        assert Foodstuff.query.get(2).location_id == 1
 
     def test_store_page(self):
         """Move an item onto shopping list and check that it displays"""
@@ -358,10 +1384,11 @@ class FlaskIntegrationTests(TestCase):
         """Test that refill page renders and redirects"""
 
         result = self.client.get("/eatme", follow_redirects=True)
-        self.assertIn("<p>Your foods, ordered by first to expire</p>", result.data)
+        self.assertIn("<th>Days Until Expiry</th>", result.data)
 
     def test_update_single_foodstuff(self):
-        """Update any field on a single foodstuff item"""
+        """Update any field on a single foodstuff item, as the edit modal
+           does it (a batch edit op), on the eat me page"""
 
         # grab a sample food obj to test edits
         peppercorns = Foodstuff.query.get(3)
@@ -373,12 +1400,15 @@ class FlaskIntegrationTests(TestCase):
         assert peppercorns.exp == None
         assert peppercorns.description == None
 
-        # pretend that we passed these values through form
-        update = {'pantry': "False", 'shop': "True", 'name': 'peppie',
-                  'location': '1', 'exp': '-25', 'description': 'this is my test item!'}
+        # pretend that we passed these values through the modal
+        update = {'op': 'edit', 'id': 3, 'pantry': False, 'shop': True,
+                  'name': 'peppie', 'location': '1', 'exp': '-25',
+                  'description': 'this is my test item!'}
 
-        result = self.client.post("/update/3", data=update,
-                                  follow_redirects=True)
+        result = self.client.post("/api/batch",
+                                  content_type='application/json',
+                                  data=json.dumps({'ops': [update],
+                                                   'parts': ['eatme']}))
         # tests that form values correctly updated item in db
         peppercorns = Foodstuff.query.get(3)
         assert peppercorns.is_pantry == False
@@ -388,10 +1418,763 @@ class FlaskIntegrationTests(TestCase):
         assert peppercorns.location_id == 1
         assert peppercorns.exp == -25
         assert peppercorns.description != None
-        # tests flash message
-        self.assertIn("Your item has been updated", result.data)
-        # tests redirect
-        self.assertIn("<th>Add to Shopping List</th>", result.data)
+        # the eat me page is redrawn from what comes back
+        state = json.loads(result.data)['state']
+        assert list(state) == ['eatme']
+
+class CacheTests(DbTestCase):
+    """Tests for the per-user read cache"""
+
+    def setUp(self):
+        """Runs before each test, fresh cache, fake server and testdb"""
+
+        pantry_cache.configure(maxsize=100)
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'wowsuchsecret'
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 1
+
+        DbTestCase.setUp(self)
+
+    def tearDown(self):
+        """Runs after each test, back to the default cache"""
+
+        pantry_cache.configure()
+        DbTestCase.tearDown(self)
+
+    def test_lru_eviction(self):
+        """Past maxsize, least recently used entries go first"""
+
+        lru = pantry_cache.LocalLRUBackend(maxsize=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        assert lru.get("a") == 1
+        lru.set("c", 3)
+        # b was least recently used
+        assert lru.get("b") is None
+        assert lru.get("a") == 1
+        assert lru.get("c") == 3
+        assert len(lru) == 2
+
+    def test_lru_ttl(self):
+        """Entries with a ttl expire"""
+
+        lru = pantry_cache.LocalLRUBackend()
+        lru.set("a", 1, ttl=-1)
+        assert lru.get("a") is None
+
+    def test_cache_hit(self):
+        """Second read of the pantry doesn't touch the db"""
+
+        pantry, queries = count_queries(pantry_cache.cached_pantry, 1)
+        assert queries == 1
+        again, queries = count_queries(pantry_cache.cached_pantry, 1)
+        assert queries == 0
+        assert again == pantry
+        # plain rows, not ORM objects
+        assert pantry_cache.LocRow(1, 'Fridge') in pantry
+
+    def test_bump_version(self):
+        """Bumping a user's version drops their entries, not anyone else's"""
+
+        pantry_cache.cached_locs(1)
+        pantry_cache.cached_locs(2)
+        pantry_cache.bump_version(1)
+
+        locs, queries = count_queries(pantry_cache.cached_locs, 1)
+        assert queries == 1
+        locs, queries = count_queries(pantry_cache.cached_locs, 2)
+        assert queries == 0
+
+    def test_writes_invalidate(self):
+        """Pages show changes made through the app right away"""
+
+        result = self.client.get("/pantry")
+        self.assertIn("peppercorns", result.data)
+        result = self.client.get("/shop")
+        self.assertNotIn("peppercorns", result.data)
+
+        self.client.post("/update", data={'empty': '3', 'refill': '3'})
+
+        result = self.client.get("/pantry")
+        self.assertNotIn("peppercorns", result.data)
+        result = self.client.get("/shop")
+        self.assertIn("peppercorns", result.data)
+
+        self.client.post("/add_loc", data={'loc': 'Garage'})
+        result = self.client.get("/pantry")
+        self.assertIn("Garage", result.data)
+
+    def test_not_modified(self):
+        """Unchanged pages get a 304 without touching the db, any write
+           gives a new ETag"""
+
+        etags = {}
+        for url in ["/pantry", "/shop", "/eatme", "/history"]:
+            first = self.client.get(url)
+            assert first.status_code == 200, url
+            etag = etags[url] = first.headers['ETag']
+
+            again, queries = count_queries(self.client.get, url,
+                                           headers={'If-None-Match': etag})
+            assert again.status_code == 304, url
+            assert again.data == ""
+            assert queries == 0, url
+
+        self.client.post("/update", data={'empty': '3'})
+        # the redirect flashed nothing, but the pantry is different now
+        changed = self.client.get("/pantry",
+                                  headers={'If-None-Match': etags["/pantry"]})
+        assert changed.status_code == 200
+
+    def test_not_modified_per_user(self):
+        """Another user's ETag doesn't match, query string counts"""
+
+        etag = self.client.get("/history").headers['ETag']
+        result = self.client.get("/history?before=20180101000000000000",
+                                 headers={'If-None-Match': etag})
+        assert result.status_code == 200
+
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 2
+        result = self.client.get("/history", headers={'If-None-Match': etag})
+        assert result.status_code == 200
+
+    def test_flash_not_cached(self):
+        """A page with a pending flash message is always rendered"""
+
+        etag = self.client.get("/pantry").headers['ETag']
+        with self.client.session_transaction() as sess:
+            sess['_flashes'] = [('message', 'Logged in')]
+        result = self.client.get("/pantry", headers={'If-None-Match': etag})
+        assert result.status_code == 200
+        self.assertIn("Logged in", result.data)
+
+    def test_batch_invalidates(self):
+        """Changes through /api/batch show up in /api/state"""
+
+        state = json.loads(self.client.get("/api/state").data)
+        assert state['shopping'] == []
+
+        self.client.post("/api/batch", content_type='application/json',
+                         data=json.dumps({'ops': [{'op': 'refill',
+                                                   'ids': [3]}]}))
+        state = json.loads(self.client.get("/api/state").data)
+        assert [row[1] for row in state['shopping']] == ['peppercorns']
+
+
+class DigestTests(DbTestCase):
+    """Test the expiry digest batch job"""
+
+    def setUp(self):
+        super(DigestTests, self).setUp()
+        self.now = datetime.utcnow()
+        self.checkpoint = "/tmp/digest_{}.checkpoint.json".format(WORKER)
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+        # user 1: milk tomorrow, eggs in a week (outside the window)
+        set_status(1, ['1'], last_purch=self.now - timedelta(hours=4), exp=1)
+        set_status(1, ['2'], last_purch=self.now, exp=6)
+        # user 2: milk and cheese, a couple of hours apart
+        set_status(2, ['4'], last_purch=self.now - timedelta(hours=10), exp=1)
+        set_status(2, ['5'], last_purch=self.now - timedelta(hours=8), exp=1)
+        self.sink = digest.SmtpSink()
+
+    def tearDown(self):
+        self.sink.stop()
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        super(DigestTests, self).tearDown()
+
+    def wait_for(self, count):
+        """The sink gets messages on its own thread"""
+
+        for _ in range(50):
+            if len(self.sink.messages) >= count:
+                break
+            time.sleep(0.05)
+        return self.sink.messages
+
+    def test_digests(self):
+        """One digest per user with expiring items, sent from the pool"""
+
+        stats = digest.run(self.connection, digest.SmtpSender(*self.sink.address),
+                           workers=2, now=self.now, chunk_size=1, batch_size=1)
+        assert (stats["digests"], stats["sent"], stats["items"]) == (2, 2, 3)
+        assert stats["batches"] == 2
+
+        messages = sorted(self.wait_for(2), key=lambda msg: msg["To"])
+        assert [msg["To"] for msg in messages] == ['email@gmail.com',
+                                                   'emailioaddress@gmail.com']
+        assert messages[0]["Subject"] == "2 items in your pantry expiring soon"
+        body = messages[1].get_payload(decode=True)
+        assert "milk (Fridge) - tomorrow" in body
+        assert "eggs" not in body
+
+    def test_max_items(self):
+        """Long lists are cut short, with a count of the rest"""
+
+        stats = digest.run(self.connection, digest.SmtpSender(*self.sink.address),
+                           workers=0, now=self.now)
+        assert stats["sent"] == 2
+
+        rows = digest.expiring_rows(self.connection, self.now)
+        user_2 = list(digest.user_digests(rows, max_items=1))[1]
+        body = digest.render(user_2, self.now).get_payload(decode=True)
+        assert "2 things in your pantry" in body
+        assert "...and 1 more" in body
+
+    def test_checkpoint_resume(self):
+        """A failed send is retried on the next run, users already done
+           aren't mailed again"""
+
+        class FailFor(digest.NullSender):
+            def send(self, msg):
+                if msg["To"] == 'email@gmail.com':
+                    raise smtplib.SMTPRecipientsRefused({msg["To"]: (550, "no")})
+
+        stats = digest.run(self.connection, FailFor(), workers=0, now=self.now,
+                           checkpoint=self.checkpoint)
+        assert (stats["sent"], stats["failed"]) == (1, 1)
+        assert digest.load_checkpoint(self.checkpoint,
+                                      self.now.strftime("%Y-%m-%d")) == (2, set([2]))
+
+        stats = digest.run(self.connection, digest.SmtpSender(*self.sink.address),
+                           workers=0, now=self.now, checkpoint=self.checkpoint)
+        assert (stats["digests"], stats["sent"]) == (1, 1)
+        assert [msg["To"] for msg in self.wait_for(1)] == ['email@gmail.com']
+
+        stats = digest.run(self.connection, digest.NullSender(), workers=0,
+                           now=self.now, checkpoint=self.checkpoint)
+        assert stats["digests"] == 0
+
+        # Another day, everyone again
+        stats = digest.run(self.connection, digest.NullSender(), workers=0,
+                           now=self.now + timedelta(days=1),
+                           checkpoint=self.checkpoint)
+        assert stats["digests"] == 2
+
+
+class BarcodeTests(DbTestCase):
+    """Test the barcode catalog import, lookup and scan to add"""
+
+    def setUp(self):
+        DbTestCase.setUp(self)
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'wowsuchsecret'
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 1
+        pantry_cache.configure()
+        self.dump = "/tmp/products_{}.csv".format(WORKER)
+
+    def tearDown(self):
+        for path in (self.dump, self.dump + ".progress"):
+            if os.path.exists(path):
+                os.remove(path)
+        DbTestCase.tearDown(self)
+
+    def write_dump(self, lines):
+        with open(self.dump, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def import_dump(self, **kwargs):
+        return barcode_import.import_products(self.connection, self.dump,
+                                              verbose=False, **kwargs)
+
+    def catalog(self):
+        return [(b.code, b.name, b.brand, b.food_type, b.shelf_life)
+                for b in Barcode.query.order_by(Barcode.code)]
+
+    def test_import(self):
+        """Codes normalized, bad rows skipped, last of a duplicate wins
+           (in the same chunk or a later one), shelf life guessed"""
+
+        self.write_dump(["code\tproduct_name\tbrands\tcategories\tshelf_life",
+                         "3017620422003\tNutella\tFerrero,Other\tSpreads\t",
+                         "012345678905\tWhole milk\tDairyCo\tDairies,Milks\t",
+                         "notacode\tJunk\t\t\t",
+                         "3017620422003\tNutella 400g\tFerrero\tSpreads\t365",
+                         "3017620422003\tNutella 750g\tFerrero\tSpreads\t300"])
+        stats = self.import_dump(chunk_size=2)
+
+        assert (stats["read"], stats["imported"], stats["skipped"]) == (5, 4, 1)
+        assert self.catalog() == [
+            ('0012345678905', 'Whole milk', 'DairyCo', 'Milks', 7),
+            ('3017620422003', 'Nutella 750g', 'Ferrero', 'Spreads', 300)]
+        # finished, so no progress left behind
+        assert not os.path.exists(self.dump + ".progress")
+
+    def test_import_jsonl(self):
+        """JSON lines dumps with Open Food Facts style category tags"""
+
+        self.dump = "/tmp/products_{}.jsonl".format(WORKER)
+        self.write_dump([json.dumps({"code": "40084107", "product_name": "Gouda",
+                                     "categories_tags": ["en:dairies",
+                                                         "en:cheeses"]})])
+        self.import_dump()
+        assert self.catalog() == [('40084107', 'Gouda', None, 'cheeses', 30)]
+
+    def test_import_resume(self):
+        """An interrupted import carries on after the saved progress"""
+
+        self.write_dump(["code,product_name"] +
+                         ["{},item {}".format(40000000 + i, i) for i in range(6)])
+        barcode_import.save_progress(self.dump, 4)
+
+        stats = self.import_dump(chunk_size=1)
+        assert (stats["resumed_at"], stats["read"]) == (4, 2)
+        assert [row[1] for row in self.catalog()] == ['item 4', 'item 5']
+
+        # the dump changed, progress doesn't count any more
+        barcode_import.save_progress(self.dump, 4)
+        self.write_dump(["code,product_name", "40000000,item 0"])
+        assert self.import_dump()["resumed_at"] == 0
+
+    def test_lookup(self):
+        """Scanned code to product, cached after the first lookup, UPC and
+           EAN forms are the same product"""
+
+        db.session.add(Barcode(code='0012345678905', name='Whole milk',
+                               shelf_life=7))
+        db.session.commit()
+
+        result, queries = count_queries(self.client.get,
+                                        "/api/barcode/012345678905")
+        assert json.loads(result.data)['name'] == 'Whole milk'
+        assert json.loads(result.data)['shelfLife'] == 7
+        result, queries = count_queries(self.client.get,
+                                        "/api/barcode/0012345678905")
+        assert result.status_code == 200
+        assert queries == 0
+
+        assert self.client.get("/api/barcode/4006381333931").status_code == 404
+        assert self.client.get("/api/barcode/nope").status_code == 404
+
+    def test_lookup_miss_expires(self):
+        """An unknown code is remembered for a minute, not a day, so an
+           import shows up soon"""
+
+        assert self.client.get("/api/barcode/4006381333931").status_code == 404
+        expires, row = pantry_cache.backend.entries[
+            "pantry:barcode:4006381333931"]
+        assert row is False
+        assert expires <= time.time() + pantry_cache.BARCODE_MISS_TTL
+
+    def test_scan_to_add(self):
+        """One request adds the scanned product, linked to its barcode,
+           with its shelf life unless an exp is given"""
+
+        milk = Barcode(code='0012345678905', name='Whole milk', shelf_life=7)
+        db.session.add(milk)
+        db.session.commit()
+        milk_id = milk.barcode_id
+
+        ops = [{'op': 'scan', 'code': '012345678905', 'location': 1},
+               {'op': 'scan', 'code': '012345678905', 'location': 2, 'exp': 3}]
+        result = self.client.post("/api/batch", content_type='application/json',
+                                  data=json.dumps({'ops': ops, 'parts': ['pantry']}))
+        assert json.loads(result.data)['results'] == [1, 1]
+
+        added = Foodstuff.query.filter_by(barcode_id=milk_id)\
+                               .order_by(Foodstuff.pantry_id).all()
+        assert [(item.name, item.location_id, item.exp) for item in added] == [
+               ('Whole milk', 1, 7), ('Whole milk', 2, 3)]
+
+        result = self.client.post("/api/batch", content_type='application/json',
+                                  data=json.dumps({'ops': [
+                                      {'op': 'scan', 'code': '4006381333931',
+                                       'location': 1}]}))
+        assert result.status_code == 400
+
+
+class SuggestionTests(DbTestCase):
+    """Test the type-ahead name suggestions"""
+
+    def setUp(self):
+        DbTestCase.setUp(self)
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'wowsuchsecret'
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 1
+        pantry_cache.configure()
+        suggestions.rebuild_popular()
+
+    def test_name_index(self):
+        """Prefix matches by how often they were bought, then later words,
+           then one typo off. Case and spacing don't count."""
+
+        index = suggestions.NameIndex([("Milk", 5), ("milk", 2), ("mint", 9),
+                                       ("almond milk", 1), ("Ice  Cream", 3),
+                                       ("cream cheese", 1), ("mince", 1)])
+        assert len(index) == 6
+        assert index.search("mi") == ["mint", "Milk", "mince", "almond milk"]
+        assert index.search("mi", limit=2) == ["mint", "Milk"]
+        assert index.search("MILK") == ["Milk", "almond milk"]
+        assert index.search("cre") == ["cream cheese", "Ice  Cream"]
+        # one typo: swapped, missing, wrong letter
+        assert index.search("mlik") == ["Milk"]
+        assert index.search("mlk") == ["Milk"]
+        assert index.search("crwam") == ["cream cheese"]
+        assert index.search("xyz") == []
+        assert index.search("  ") == []
+
+    def test_suggest_api(self):
+        """User's own names first, popular ones they haven't had after.
+           After the first keystroke, no queries."""
+
+        result = self.client.get("/api/suggest?q=m")
+        body = json.loads(result.data)
+        assert body['mine'] == ['milk']
+        assert body['popular'] == []
+
+        # user 2's cheese is popular, user 1 hasn't had it
+        result, queries = count_queries(self.client.get, "/api/suggest?q=ch")
+        assert json.loads(result.data) == {'mine': [], 'popular': ['cheese']}
+        assert queries == 0
+
+        # adding an item moves the user's version, the new name shows up
+        self.client.post("/api/batch", content_type='application/json',
+                         data=json.dumps({'ops': [{'op': 'add', 'items': [
+                             {'name': 'Cheddar', 'location': 1}]}]}))
+        body = json.loads(self.client.get("/api/suggest?q=ch").data)
+        assert body == {'mine': ['Cheddar'], 'popular': ['cheese']}
+
+    def test_popular_rebuilt_in_background(self):
+        """An old popular index is rebuilt off the request, once however
+           many requests find it old, and they get the old one meanwhile"""
+
+        calls = []
+        started = threading.Event()
+        finish = threading.Event()
+
+        def slow_popular_names(limit):
+            calls.append(limit)
+            started.set()
+            finish.wait(5)
+            return [("quince", 3)]
+
+        old = suggestions.popular["index"]
+        popular_names = suggestions.popular_names
+        suggestions.popular_names = slow_popular_names
+        suggestions.popular["built_at"] = suggestions.popular["tried_at"] = 0
+        try:
+            with app.app_context():
+                thread = suggestions.rebuild_in_background(app)
+                started.wait(5)
+                assert suggestions.popular_index() is old
+                assert suggestions.rebuild_in_background(app) is None
+            finish.set()
+            thread.join(5)
+        finally:
+            suggestions.popular_names = popular_names
+        assert len(calls) == 1
+        assert suggestions.popular_index().search("qu") == ["quince"]
+
+
+class ReplicaTests(DbTestCase):
+    """Test read replica routing. The "replica" is testdb on an engine of
+       its own: it can't see what a test does in its transaction, like a
+       replica that hasn't caught up yet."""
+
+    def setUp(self):
+        DbTestCase.setUp(self)
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'wowsuchsecret'
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 1
+        pantry_cache.configure(maxsize=0)
+
+        self.config = dict((key, app.config[key]) for key in
+                           ('SQLALCHEMY_BINDS', 'DB_REPLICA_URI'))
+        app.config['SQLALCHEMY_BINDS'] = {'replica': TEST_DB}
+        app.config['DB_REPLICA_URI'] = TEST_DB
+        replicas.reset()
+        self.measure_lag = replicas.measure_lag
+
+        # Only the primary has it
+        db.session.add(Foodstuff(user_id=1, name='replica test jam',
+                                 location_id=1, is_pantry=True))
+        db.session.commit()
+
+    def tearDown(self):
+        replicas.measure_lag = self.measure_lag
+        DbTestCase.tearDown(self)
+        if replicas.has_replica(app):
+            db.get_engine(app, bind='replica').dispose()
+        app.config.update(self.config)
+        replicas.reset()
+
+    def test_reads_from_replica(self):
+        """Read-only pages come from the replica"""
+
+        result = self.client.get('/pantry')
+        assert result.status_code == 200
+        self.assertNotIn('replica test jam', result.data)
+        result = self.client.get('/api/state?parts=pantry')
+        self.assertNotIn('replica test jam', result.data)
+        assert replicas.stats['replica'] == 2
+
+    def test_read_your_writes(self):
+        """After a POST the user reads from the primary for a while"""
+
+        self.client.post('/update', data={})
+        with self.client.session_transaction() as sess:
+            assert replicas.WROTE_AT in sess
+        result = self.client.get('/pantry')
+        self.assertIn('replica test jam', result.data)
+        assert replicas.stats['primary_sticky'] == 1
+
+        with self.client.session_transaction() as sess:
+            sess[replicas.WROTE_AT] -= app.config['DB_REPLICA_STICKY']
+        result = self.client.get('/pantry')
+        self.assertNotIn('replica test jam', result.data)
+
+    def test_lagging_replica(self):
+        """Too far behind, or not answering, means the primary"""
+
+        replicas.measure_lag = lambda engine: 60.0
+        result = self.client.get('/pantry')
+        self.assertIn('replica test jam', result.data)
+        assert replicas.stats['primary_lag'] == 1
+        self.assertIn('pantry_db_replica_lag_seconds 60.0',
+                      self.client.get('/metrics').data)
+
+        def broken(engine):
+            raise Exception("replica down")
+
+        messages = []
+
+        class Collect(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+
+        handler = Collect()
+        replicas.log.addHandler(handler)
+        replicas.reset()
+        replicas.measure_lag = broken
+        try:
+            result = self.client.get('/pantry')
+        finally:
+            replicas.log.removeHandler(handler)
+        self.assertIn('replica test jam', result.data)
+        assert replicas.stats['primary_lag'] == 1
+        self.assertIn('replica down', messages[0])
+
+    def test_measure_lag(self):
+        """A server that isn't a replica counts as caught up, and lag is
+           only asked for every LAG_CHECK_SECONDS"""
+
+        assert self.measure_lag(db.get_engine(app, bind='replica')) == 0
+        calls = []
+        replicas.measure_lag = lambda engine: calls.append(engine) or 0.5
+        assert replicas.replica_lag(app) == 0.5
+        assert replicas.replica_lag(app) == 0.5
+        assert len(calls) == 1
+
+    def test_sticky_over_max_lag(self):
+        """Users could miss their change if sticky isn't longer than lag"""
+
+        with self.assertRaises(ValueError):
+            connect_to_db(flask.Flask("replicatest"), TEST_DB,
+                          replica_uri=TEST_DB, db_replica_sticky=1.0,
+                          db_replica_max_lag=2.0)
+
+    def test_writes_go_to_primary(self):
+        """Inside a replica read, updates and flushes still use the primary"""
+
+        with app.test_request_context():
+            flask.g.db_replica = True
+            replica = db.get_engine(app, bind='replica')
+            assert db.session.get_bind(Foodstuff.__mapper__) is replica
+            assert db.session.get_bind(
+                   Foodstuff.__mapper__,
+                   Foodstuff.__table__.update()) is self.connection
+
+            item = Foodstuff.query.filter_by(user_id=1).first()
+            item.name = 'replica pasta'
+            db.session.flush()
+            flask.g.db_replica = False
+            assert Foodstuff.query.filter_by(name='replica pasta').count() == 1
+            db.session.remove()
+
+    def test_without_replica(self):
+        """No replica configured, nothing changes"""
+
+        app.config['SQLALCHEMY_BINDS'] = {}
+        result = self.client.get('/pantry')
+        self.assertIn('replica test jam', result.data)
+        self.client.post('/update', data={})
+        with self.client.session_transaction() as sess:
+            assert replicas.WROTE_AT not in sess
+        assert sum(replicas.stats.values()) == 0
+
+
+class DeliverySearchTests(TestCase):
+    """Tests for the yelp client, against a local fake yelp"""
+
+    def setUp(self):
+        """Runs before each test, fake yelp server and empty cache"""
+
+        self.yelp = FakeYelp()
+        os.environ["YELP_API_URL"] = self.yelp.url
+        delivery_search.cache = pantry_cache.LocalLRUBackend()
+        delivery_search.breaker = delivery_search.CircuitBreaker()
+        delivery_search.bulkhead = delivery_search.Bulkhead()
+
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'wowsuchsecret'
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 1
+
+    def tearDown(self):
+        """Runs after each test, stops fake yelp"""
+
+        self.yelp.stop()
+        del os.environ["YELP_API_URL"]
+
+    def test_geo_cell(self):
+        """Nearby points land in the same cell"""
+
+        assert delivery_search.geo_cell(37.78888, -122.411493) == (37.79, -122.41)
+        assert (delivery_search.geo_cell(37.78888, -122.411493) ==
+                delivery_search.geo_cell(37.7912, -122.4071))
+
+    def test_search_cached_by_cell(self):
+        """Neighbours share one upstream call, far away makes a new one"""
+
+        first = delivery_search.search(37.78888, -122.411493)
+        assert first[0] == "Noodles at 37.79,-122.41"
+        assert len(first) == 8
+
+        assert delivery_search.search(37.7912, -122.4071) == first
+        assert self.yelp.calls == 1
+
+        delivery_search.search(40.7128, -74.0060)
+        assert self.yelp.calls == 2
+
+    def test_search_timeout(self):
+        """Slow upstream gives up quickly instead of hanging the worker"""
+
+        self.yelp.delay = 0.5
+        timeout, delivery_search.TIMEOUT = delivery_search.TIMEOUT, (1, 0.1)
+        try:
+            self.assertRaises(delivery_search.DeliverySearchError,
+                              delivery_search.search, 37.78, -122.41)
+        finally:
+            delivery_search.TIMEOUT = timeout
+
+    def test_search_upstream_error(self):
+        """Upstream errors aren't cached"""
+
+        self.yelp.status = 500
+        self.assertRaises(delivery_search.DeliverySearchError,
+                          delivery_search.search, 37.78, -122.41)
+        self.yelp.status = 200
+        assert delivery_search.search(37.78, -122.41)
+
+    def test_coalescing(self):
+        """Simultaneous lookups of one cell make a single upstream call"""
+
+        self.yelp.delay = 0.3
+        results = []
+
+        def look():
+            results.append(delivery_search.search(37.78888, -122.411493))
+
+        threads = [threading.Thread(target=look) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert self.yelp.calls == 1
+        assert len(results) == 8
+        assert all(result == results[0] for result in results)
+
+    def test_bulkhead(self):
+        """Past max_concurrent, callers give up after max_wait"""
+
+        bulkhead = delivery_search.Bulkhead(max_concurrent=1, max_wait=0.05)
+        with bulkhead:
+            self.assertRaises(delivery_search.DeliverySearchBusy,
+                              bulkhead.__enter__)
+        # slot is free again
+        with bulkhead:
+            pass
+
+    def test_breaker_opens(self):
+        """After repeated failures yelp isn't called at all, until the
+           breaker lets a trial call through"""
+
+        delivery_search.breaker = delivery_search.CircuitBreaker(
+                                  failure_threshold=2, reset_after=60)
+        self.yelp.status = 500
+        for lat in (1, 2):
+            self.assertRaises(delivery_search.DeliverySearchError,
+                              delivery_search.search, lat, 1)
+        self.assertRaises(delivery_search.CircuitOpen,
+                          delivery_search.search, 3, 1)
+        assert self.yelp.calls == 2
+
+        # time passes, yelp is better
+        delivery_search.breaker.opened_at -= 61
+        self.yelp.status = 200
+        assert delivery_search.search(4, 1)
+        assert delivery_search.breaker.state == "closed"
+
+    def test_malformed_payload(self):
+        """A payload slim() can't read is a failure like any other, and a
+           bad trial call doesn't leave the breaker stuck open"""
+
+        delivery_search.breaker = delivery_search.CircuitBreaker(
+                                  failure_threshold=1, reset_after=60)
+        self.yelp.payload = {"businesses": [
+            {"name": "Odd", "url": "http://example.com/odd", "rating": 3,
+             "categories": None}]}
+        self.assertRaises(delivery_search.DeliverySearchError,
+                          delivery_search.search, 1, 1)
+        assert delivery_search.breaker.state == "open"
+
+        # the half open trial gets the same junk
+        delivery_search.breaker.opened_at -= 61
+        self.assertRaises(delivery_search.DeliverySearchError,
+                          delivery_search.search, 2, 1)
+        assert not delivery_search.breaker.trial_running
+
+        delivery_search.breaker.opened_at -= 61
+        self.yelp.payload = None
+        assert delivery_search.search(3, 1)
+        assert delivery_search.breaker.state == "closed"
+
+    def test_slow_calls_trip_breaker(self):
+        """Answers that take too long count as failures"""
+
+        delivery_search.breaker = delivery_search.CircuitBreaker(
+                                  failure_threshold=1, slow_call=0.05)
+        self.yelp.delay = 0.1
+        assert delivery_search.search(1, 1)
+        self.assertRaises(delivery_search.CircuitOpen,
+                          delivery_search.search, 2, 2)
+
+    def test_callyelp_route(self):
+        """Route gives the page the slimmed list, or an error message"""
+
+        result = json.loads(self.client.post("/callyelp",
+                            data={'lat': '37.78888', 'lon': '-122.411493'}).data)
+        assert result['yelpList'][0] == "Noodles at 37.79,-122.41"
+
+        self.yelp.status = 500
+        result = json.loads(self.client.post("/callyelp",
+                            data={'lat': '10', 'lon': '10'}).data)
+        assert result['yelpList'] == []
+        assert 'error' in result
+
 
 # Run all tests if we run this file
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+"""Run pantry_tests in several processes at once
+
+    python parallel_tests.py [workers]      # default: one per CPU
+
+Tests are dealt out round robin. Each worker gets TEST_WORKER=gw<n>, so it
+uses its own testdb_gw<n> (made on first use) and they don't trip over each
+other. pytest -n <workers> (pytest-xdist) picks the same databases.
+"""
+
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+
+def test_ids(module="pantry_tests"):
+    """Every test in module, as names unittest can run"""
+
+    def flatten(suite):
+        for test in suite:
+            if isinstance(test, unittest.TestSuite):
+                for inner in flatten(test):
+                    yield inner
+            else:
+                yield test
+
+    suite = unittest.defaultTestLoader.loadTestsFromName(module)
+    return [test.id() for test in flatten(suite)]
+
+def run(workers, verbose=True):
+    """Returns (all passed, seconds taken), prints each worker's output"""
+
+    ids = test_ids()
+    shards = [ids[i::workers] for i in range(workers)]
+
+    start = time.time()
+    procs = []
+    for i, shard in enumerate(shards):
+        if not shard:
+            continue
+        env = dict(os.environ, TEST_WORKER="gw{}".format(i))
+        procs.append(subprocess.Popen(
+            [sys.executable, "-m", "unittest"] + shard, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+
+    passed = True
+    for i, proc in enumerate(procs):
+        output = proc.communicate()[0]
+        if verbose:
+            print "===== worker gw{} =====".format(i)
+            print output
+        passed = passed and proc.returncode == 0
+    return passed, time.time() - start
+
+
+if __name__ == "__main__":
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    passed, elapsed = run(workers)
+    print "{} workers, {:.1f} s, {}".format(workers, elapsed,
+                                            "OK" if passed else "FAILED")
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,195 @@
+"""Password hashing and checking, off the request thread
+
+bcrypt is slow on purpose and CPU bound. Once start() has been called, every
+hash/check runs in a dedicated process pool instead of the worker that's
+serving the request. At most max_queue jobs can be waiting or running; past
+that, callers get HashingBusy straight away (backpressure) instead of piling
+up behind a login surge. Without start() (tests, scripts) work is done inline.
+
+The work factor comes from BCRYPT_ROUNDS (default 10). To pick one for a
+target verify time on this machine:
+
+    python passwords.py calibrate 250     # milliseconds
+
+Stored hashes made with a lower cost are redone after the user's next
+successful login (see pantry_functions.rehash_if_needed). Check latency and
+rehash counts per cost are kept in stats.
+"""
+
+from collections import defaultdict
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import bcrypt
+
+ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 10))
+# Seconds to wait for a result before giving up
+WAIT = 10
+
+
+class HashingBusy(Exception):
+    """Too many hashes queued, try again in a moment"""
+
+
+pool = None
+slots = None
+
+# cost: {"checks": n, "check_ms": total ms, "rehashes": n}
+stats = defaultdict(lambda: {"checks": 0, "check_ms": 0.0, "rehashes": 0})
+stats_lock = threading.Lock()
+
+def start(processes=None, max_queue=None):
+    """Start the hashing pool: processes defaults to one per CPU, max_queue
+       (jobs waiting + running) to 4 per process"""
+
+    global pool, slots
+    processes = processes or multiprocessing.cpu_count()
+    if max_queue is None:
+        max_queue = processes * 4
+    pool = multiprocessing.Pool(processes)
+    slots = threading.Semaphore(max_queue)
+
+def stop():
+    """Shut the pool down, back to hashing inline"""
+
+    global pool, slots
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+    pool = slots = None
+
+def run(func, *args):
+    """Run func(*args) in the pool (inline if there's no pool)"""
+
+    if pool is None:
+        return func(*args)
+
+    job_slots = slots
+    if not job_slots.acquire(False):
+        raise HashingBusy("hashing queue is full")
+    # The slot is free once the job is done, not when we stop waiting for
+    # it: a job we gave up on is still queued or running. guarded() never
+    # raises, so the callback always comes.
+    try:
+        job = pool.apply_async(guarded, (func, args),
+                               callback=lambda outcome: job_slots.release())
+    except Exception:
+        job_slots.release()
+        raise
+    try:
+        ok, value = job.get(WAIT)
+    except multiprocessing.TimeoutError:
+        raise HashingBusy("hashing took too long")
+    if not ok:
+        raise value
+    return value
+
+###############################################################################
+"""Work done in the pool, has to be top level so it can be pickled"""
+
+def guarded(func, args):
+    """(True, func(*args)), or (False, exception) if it raised"""
+
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, e
+
+def bcrypt_hash(pword, rounds):
+    return bcrypt.hashpw(pword, bcrypt.gensalt(rounds))
+
+def bcrypt_check(pword, hashed):
+    return bcrypt.checkpw(pword, hashed)
+
+###############################################################################
+
+def hash_password(pword):
+    """Takes a string, returns bcrypt hash string"""
+
+    return run(bcrypt_hash, pword.encode('utf8'), ROUNDS)
+
+def check_password(pword, hashed):
+    """Takes password attempt and stored hash, returns bool"""
+
+    hashed = hashed.encode('utf8')
+    start = time.time()
+    valid = run(bcrypt_check, pword.encode('utf8'), hashed)
+
+    with stats_lock:
+        cost_stats = stats[cost_of(hashed)]
+        cost_stats["checks"] += 1
+        cost_stats["check_ms"] += (time.time() - start) * 1000
+    return valid
+
+def cost_of(hashed):
+    """Work factor a bcrypt hash was made with, 10 for $2b$10$..."""
+
+    return int(hashed.split("$")[2])
+
+def needs_rehash(hashed):
+    """True if hash was made with fewer than the current ROUNDS. Stronger
+       ones are left alone, e.g. after ROUNDS is turned down for a while."""
+
+    return cost_of(hashed) < ROUNDS
+
+def count_rehash(cost):
+    """A stored hash was redone at cost"""
+
+    with stats_lock:
+        stats[cost]["rehashes"] += 1
+
+def report():
+    """Lines of check latency and rehash count per cost level"""
+
+    lines = ["{:>5} {:>8} {:>13} {:>9}".format("cost", "checks",
+                                                 "avg check ms", "rehashes")]
+    with stats_lock:
+        for cost in sorted(stats):
+            cost_stats = stats[cost]
+            avg = cost_stats["check_ms"] / (cost_stats["checks"] or 1)
+            lines.append("{:>5} {:>8} {:>13.1f} {:>9}".format(
+                         cost, cost_stats["checks"], avg,
+                         cost_stats["rehashes"]))
+    return lines
+
+###############################################################################
+"""Calibration"""
+
+def time_rounds(rounds, samples=3):
+    """Median milliseconds to check a password hashed at rounds"""
+
+    hashed = bcrypt_hash(b"calibrate", rounds)
+    times = []
+    for _ in range(samples):
+        start = time.time()
+        bcrypt_check(b"calibrate", hashed)
+        times.append((time.time() - start) * 1000)
+    return sorted(times)[len(times) // 2]
+
+def calibrate(target_ms, min_rounds=4, max_rounds=16, samples=3):
+    """Returns (rounds, timings): the highest rounds whose check fits in
+       target_ms (at least min_rounds), and {rounds: ms} for what was tried.
+       Each extra round doubles the time, so stop once we're over."""
+
+    timings = {}
+    best = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        timings[rounds] = time_rounds(rounds, samples)
+        if timings[rounds] > target_ms:
+            break
+        best = rounds
+    return best, timings
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "calibrate":
+        print "usage: python passwords.py calibrate <target ms>"
+        sys.exit(1)
+
+    rounds, timings = calibrate(float(sys.argv[2]))
+    for tried in sorted(timings):
+        print "{:>3} rounds: {:>8.1f} ms".format(tried, timings[tried])
+    print "Set BCRYPT_ROUNDS={}".format(rounds)
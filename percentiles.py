@@ -0,0 +1,19 @@
+"""Summaries of timings, shared by benchmarks.py and loadtest.py
+
+Plain Python on purpose: the load test drives a server from outside and
+shouldn't have to import the app (and the ORM, and the hashing pool) for
+them.
+"""
+
+
+def percentile(values, pct):
+    """pct-th percentile of a list of numbers (nearest rank)"""
+
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def median(values):
+    """Middle value of a list of numbers"""
+
+    return percentile(values, 50)
@@ -0,0 +1,150 @@
+"""Read replica routing
+
+connect_to_db(app, uri, replica_uri=...) (or PANTRY_DB_REPLICA_URI) adds a
+streaming replica of the database. Views and pantry_functions readers wrapped
+in @read_only then run their queries on it instead of the primary, unless:
+
+- the request itself is a POST (it's writing, and reads back what it wrote)
+- the user changed something in the last DB_REPLICA_STICKY seconds, so
+  they always see their own change. The time of their last write is in
+  their session cookie, so this holds whichever worker they land on next.
+- the replica is more than DB_REPLICA_MAX_LAG seconds behind. Lag is asked
+  for at most every LAG_CHECK_SECONDS per process; a replica we can't reach
+  counts as infinitely far behind.
+
+Whichever way a request goes, flushes and updates go to the primary.
+
+Two local servers to try it on (the primary needs wal_level = replica):
+
+    pg_basebackup -h localhost -D /tmp/replica -R
+    pg_ctl -D /tmp/replica -o "-p 5433" start
+    PANTRY_DB_REPLICA_URI=postgresql://localhost:5433/pantry python server.py
+"""
+
+from functools import wraps
+import logging
+import threading
+import time
+
+from flask import (g, request, session, current_app, has_app_context,
+                   has_request_context)
+from sqlalchemy import text
+
+from tablesetup import db
+
+LAG_CHECK_SECONDS = 1.0
+# Session key with the time.time() of the user's last write
+WROTE_AT = "db_wrote_at"
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# A server that isn't a replica is 0. A replica that isn't streaming from
+# the primary (connection lost, primary down) has replayed all it received
+# but may be missing any amount, so it's infinitely far behind. Otherwise
+# caught up (everything received is replayed, however long ago the last
+# write was) is 0, or it's the time since the last replayed transaction.
+LAG_SQL = """SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                         WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver
+                                          WHERE status = 'streaming')
+                         THEN 'Infinity'::float8
+                         WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                         THEN 0
+                         ELSE extract(epoch FROM now() -
+                                      pg_last_xact_replay_timestamp())
+                    END"""
+
+log = logging.getLogger("pantry.replicas")
+
+# Where @read_only requests went and why, for /metrics
+stats = {"replica": 0, "primary_write": 0, "primary_sticky": 0,
+         "primary_lag": 0}
+# Last lag measured, until checked_at + LAG_CHECK_SECONDS
+lag_state = {"lag": float("inf"), "checked_at": 0}
+lock = threading.Lock()
+
+
+def has_replica(app):
+    return "replica" in (app.config.get("SQLALCHEMY_BINDS") or {})
+
+def measure_lag(engine):
+    """Seconds the replica at engine is behind the primary"""
+
+    return float(engine.execute(text(LAG_SQL)).scalar() or 0)
+
+def replica_lag(app):
+    """Replica's lag, measured at most every LAG_CHECK_SECONDS"""
+
+    now = time.time()
+    with lock:
+        if now - lag_state["checked_at"] < LAG_CHECK_SECONDS:
+            return lag_state["lag"]
+        # Other threads go on with the last value while this one asks
+        lag_state["checked_at"] = now
+
+    try:
+        lag = measure_lag(db.get_engine(app, bind="replica"))
+    except Exception as e:
+        log.warning("replica lag check failed, using the primary: %s", e)
+        lag = float("inf")
+    with lock:
+        lag_state["lag"] = lag
+    return lag
+
+def choose():
+    """"replica" or why not: "primary_write", "primary_sticky" or
+       "primary_lag". None if there's no replica."""
+
+    app = current_app
+    if not has_replica(app):
+        return None
+    if has_request_context():
+        if request.method not in READ_METHODS:
+            return "primary_write"
+        wrote_at = session.get(WROTE_AT)
+        if (wrote_at is not None and
+                time.time() - wrote_at < app.config["DB_REPLICA_STICKY"]):
+            return "primary_sticky"
+    if replica_lag(app) > app.config["DB_REPLICA_MAX_LAG"]:
+        return "primary_lag"
+    return "replica"
+
+def read_only(f):
+    """Decorator for views and helpers that only read: their queries go to
+       the replica if choose() says so. Decided once per request, helpers
+       called from a @read_only view go along with it."""
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # Outside the app (scripts) there's only the primary
+        if not has_app_context() or "db_replica" in g:
+            return f(*args, **kwargs)
+
+        target = choose()
+        if target is not None:
+            with lock:
+                stats[target] += 1
+        g.db_replica = target == "replica"
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.pop("db_replica", None)
+    return decorated_function
+
+def remember_write(response):
+    """After a request that may have written, send this user's reads to the
+       primary for the next DB_REPLICA_STICKY seconds"""
+
+    if request.method not in READ_METHODS and has_replica(current_app):
+        session[WROTE_AT] = time.time()
+    return response
+
+def reset():
+    """Forget counts and the last lag measured"""
+
+    with lock:
+        for key in stats:
+            stats[key] = 0
+        lag_state["lag"] = float("inf")
+        lag_state["checked_at"] = 0
+
+def init_app(app):
+    app.after_request(remember_write)
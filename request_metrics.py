@@ -0,0 +1,347 @@
+"""Per-request SQL counts, DB time and latency, served on /metrics
+
+init_app(app) hooks SQLAlchemy's cursor events and Flask's request
+callbacks. For every request it counts the SQL statements sent and the time
+spent in them, then adds that to per-route totals along with the request's
+latency. GET /metrics returns everything in Prometheus text format,
+password hashing stats included.
+
+Requests slower than SLOW_REQUEST_MS (app.config, or the PANTRY_SLOW_MS
+environment variable, default 500) are logged to the "pantry.slow" logger
+with the statements they ran, e.g. to spot an N+1:
+
+    SLOW GET /pantry 812.4 ms, 57 queries, 640.1 ms in db, 2.0 ms pool wait
+      0.9 ms  SELECT locations.location_id ...
+
+The connection pool's counters (tablesetup.pool_stats) are there too. Slow
+requests with db time close to their latency are db bound. If the time goes
+to pantry_db_pool_wait_seconds_total instead, with
+pantry_db_pool_in_use_max at pool size + overflow, or any pool timeouts,
+the workers are starved for connections and the pool is too small for
+their threads.
+
+How long this process took to start is there as pantry_startup_seconds:
+import and create_app (wsgi.py), warmup, and first_request, from the start
+(for a gunicorn worker, its fork from the master) to the end of the first
+request served.
+
+With a read replica, pantry_db_reads_total counts where @read_only requests
+went: target="replica", or to the primary because the request was a write,
+the user had just written (sticky) or the replica was lagging.
+
+/metrics isn't public. With METRICS_TOKEN (app.config, or the
+PANTRY_METRICS_TOKEN environment variable) it wants
+"Authorization: Bearer <token>". Without one it only answers requests made
+straight to this process from the same machine: from 127.0.0.1/::1 and
+without an X-Forwarded-For header, which a reverse proxy in front adds
+(nginx: proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for).
+Anyone else gets a 404.
+"""
+
+from collections import defaultdict
+import hmac
+import logging
+import os
+import threading
+import time
+
+from flask import (g, request, has_request_context, Response, current_app,
+                   abort)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import passwords
+import replicas
+import tablesetup
+
+SLOW_REQUEST_MS = int(os.environ.get("PANTRY_SLOW_MS", 500))
+METRICS_TOKEN = os.environ.get("PANTRY_METRICS_TOKEN")
+LOOPBACK = ("127.0.0.1", "::1")
+# Statements kept per request for the slow log, past this they're counted only
+MAX_STATEMENTS = 100
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+log = logging.getLogger("pantry.slow")
+
+
+class Histogram(object):
+    """Prometheus style histogram, one set of buckets per label value"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # label: [count in each bucket..., count, sum]
+        self.series = {}
+
+    def observe(self, label, value):
+        series = self.series.get(label)
+        if series is None:
+            series = self.series[label] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def lines(self, name, label_name):
+        """Text format lines, buckets are cumulative"""
+
+        lines = []
+        for label in sorted(self.series):
+            series = self.series[label]
+            for bound, count in zip(self.buckets, series):
+                lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(
+                             name, label_name, label, bound, count))
+            lines.append('{}_bucket{{{}="{}",le="+Inf"}} {}'.format(
+                         name, label_name, label, series[-2]))
+            lines.append('{}_count{{{}="{}"}} {}'.format(name, label_name,
+                                                        label, series[-2]))
+            lines.append('{}_sum{{{}="{}"}} {}'.format(name, label_name,
+                                                      label, series[-1]))
+        return lines
+
+
+lock = threading.Lock()
+latency = Histogram(LATENCY_BUCKETS)
+queries = Histogram(QUERY_BUCKETS)
+# (route, method, status): count
+responses = defaultdict(int)
+# route: seconds spent in the db
+db_seconds = defaultdict(float)
+
+# Seconds per startup step in this process, and when it started
+startup = {}
+started_at = None
+
+###############################################################################
+"""SQLAlchemy hooks, on every engine"""
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault("query_start", []).append(time.time())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.time() - conn.info["query_start"].pop()
+    # Background work (rehashes, batch jobs) isn't part of any request
+    if not has_request_context() or "sql_count" not in g:
+        return
+    g.sql_count += 1
+    g.sql_seconds += elapsed
+    if len(g.sql_statements) < MAX_STATEMENTS:
+        g.sql_statements.append((elapsed, statement))
+
+###############################################################################
+"""Flask hooks"""
+
+def route_label():
+    """The url rule, not the path, so /editpantryitem?pantry_id=3 and =4
+       are the same route. Unmatched paths all share one label."""
+
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+def start_request():
+    g.request_start = time.time()
+    g.sql_count = 0
+    g.sql_seconds = 0.0
+    g.sql_statements = []
+    g.pool_wait = 0.0
+
+def finish_request(response):
+    record(response.status_code)
+    return response
+
+def finish_failed_request(exc):
+    """after_request is skipped when a view raises, count it as a 500"""
+
+    if exc is not None:
+        record(500)
+
+def record(status):
+    if "request_start" not in g or g.get("request_recorded"):
+        return
+    g.request_recorded = True
+
+    now = time.time()
+    elapsed = now - g.request_start
+    route = route_label()
+    with lock:
+        latency.observe(route, elapsed)
+        queries.observe(route, g.sql_count)
+        responses[(route, request.method, status)] += 1
+        db_seconds[route] += g.sql_seconds
+        if "first_request" not in startup and started_at is not None:
+            startup["first_request"] = now - started_at
+
+    slow_ms = g.get("slow_ms", SLOW_REQUEST_MS)
+    if elapsed * 1000 >= slow_ms:
+        log_slow(route, elapsed)
+
+def log_slow(route, elapsed):
+    lines = ["SLOW {} {} {:.1f} ms, {} queries, {:.1f} ms in db, "
+             "{:.1f} ms pool wait".format(request.method, route,
+                                          elapsed * 1000, g.sql_count,
+                                          g.sql_seconds * 1000,
+                                          g.pool_wait * 1000)]
+    for seconds, statement in g.sql_statements:
+        lines.append("  {:.1f} ms  {}".format(seconds * 1000,
+                                              " ".join(statement.split())))
+    if g.sql_count > len(g.sql_statements):
+        lines.append("  ... {} more".format(g.sql_count -
+                                             len(g.sql_statements)))
+    log.warning("\n".join(lines))
+
+###############################################################################
+"""/metrics"""
+
+def render():
+    """Everything in Prometheus text format"""
+
+    lines = ["# TYPE pantry_request_seconds histogram"]
+    with lock:
+        lines.extend(latency.lines("pantry_request_seconds", "route"))
+        lines.append("# TYPE pantry_request_queries histogram")
+        lines.extend(queries.lines("pantry_request_queries", "route"))
+        lines.append("# TYPE pantry_responses_total counter")
+        for (route, method, status), count in sorted(responses.items()):
+            lines.append('pantry_responses_total{{route="{}",method="{}",'
+                         'status="{}"}} {}'.format(route, method, status,
+                                                   count))
+        lines.append("# TYPE pantry_db_seconds_total counter")
+        for route, seconds in sorted(db_seconds.items()):
+            lines.append('pantry_db_seconds_total{{route="{}"}} {}'.format(
+                         route, seconds))
+
+    lines.append("# TYPE pantry_password_checks_total counter")
+    with passwords.stats_lock:
+        password_stats = sorted(passwords.stats.items())
+    for cost, cost_stats in password_stats:
+        lines.append('pantry_password_checks_total{{cost="{}"}} {}'.format(
+                     cost, cost_stats["checks"]))
+    lines.append("# TYPE pantry_password_check_seconds_total counter")
+    for cost, cost_stats in password_stats:
+        lines.append('pantry_password_check_seconds_total{{cost="{}"}} {}'
+                     .format(cost, cost_stats["check_ms"] / 1000))
+    lines.append("# TYPE pantry_password_rehashes_total counter")
+    for cost, cost_stats in password_stats:
+        lines.append('pantry_password_rehashes_total{{cost="{}"}} {}'.format(
+                     cost, cost_stats["rehashes"]))
+
+    lines.append("# TYPE pantry_startup_seconds gauge")
+    with lock:
+        for step, seconds in sorted(startup.items()):
+            lines.append('pantry_startup_seconds{{step="{}"}} {}'.format(
+                         step, seconds))
+
+    lines.extend(pool_lines())
+    lines.extend(replica_lines())
+    return "\n".join(lines) + "\n"
+
+def pool_lines():
+    """Connection pool counters, and the pool's settings as gauges"""
+
+    with tablesetup.pool_stats_lock:
+        stats = dict(tablesetup.pool_stats)
+
+    lines = []
+    for name, kind, key in [
+            ("pantry_db_pool_checkouts_total", "counter", "checkouts"),
+            ("pantry_db_pool_wait_seconds_total", "counter", "wait_seconds"),
+            ("pantry_db_pool_wait_seconds_max", "gauge", "max_wait_seconds"),
+            ("pantry_db_pool_timeouts_total", "counter", "timeouts"),
+            ("pantry_db_pool_hold_seconds_total", "counter", "hold_seconds"),
+            ("pantry_db_pool_in_use", "gauge", "in_use"),
+            ("pantry_db_pool_in_use_max", "gauge", "max_in_use")]:
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.append("{} {}".format(name, stats[key]))
+
+    pool = tablesetup.db.engine.pool
+    if isinstance(pool, tablesetup.PantryPool):
+        lines.append("# TYPE pantry_db_pool_size gauge")
+        lines.append("pantry_db_pool_size {}".format(pool.size()))
+        lines.append("# TYPE pantry_db_pool_max_overflow gauge")
+        lines.append("pantry_db_pool_max_overflow {}".format(pool._max_overflow))
+    return lines
+
+def replica_lines():
+    """Where reads went, and the replica's last measured lag"""
+
+    with replicas.lock:
+        stats = sorted(replicas.stats.items())
+        lag = replicas.lag_state["lag"]
+
+    lines = ["# TYPE pantry_db_reads_total counter"]
+    for target, count in stats:
+        lines.append('pantry_db_reads_total{{target="{}"}} {}'.format(target,
+                                                                     count))
+    if lag != float("inf"):
+        lines.append("# TYPE pantry_db_replica_lag_seconds gauge")
+        lines.append("pantry_db_replica_lag_seconds {}".format(lag))
+    return lines
+
+def may_see_metrics():
+    """Token if there is one, otherwise only a local, unproxied request"""
+
+    token = current_app.config["METRICS_TOKEN"]
+    if token:
+        given = request.headers.get("Authorization", "")
+        return hmac.compare_digest(given.encode("utf8"),
+                                   "Bearer {}".format(token).encode("utf8"))
+    return (request.remote_addr in LOOPBACK and
+            "X-Forwarded-For" not in request.headers)
+
+def metrics_view():
+    if not may_see_metrics():
+        abort(404)
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+def reset():
+    """Forget everything recorded so far"""
+
+    with lock:
+        latency.series.clear()
+        queries.series.clear()
+        responses.clear()
+        db_seconds.clear()
+    tablesetup.reset_pool_stats()
+    replicas.reset()
+
+def startup_began(when):
+    """Process started at time.time() when, first_request counts from here.
+       The earliest call wins."""
+
+    global started_at
+    if started_at is None:
+        started_at = when
+
+def forked():
+    """In a worker just forked from a master that had already started:
+       first_request counts from now, not from the master's start"""
+
+    global started_at
+    with lock:
+        started_at = time.time()
+        startup.pop("first_request", None)
+
+def startup_step(step, seconds):
+    with lock:
+        startup[step] = seconds
+
+def init_app(app):
+    """Start recording app's requests, add /metrics"""
+
+    app.config.setdefault("SLOW_REQUEST_MS", SLOW_REQUEST_MS)
+    app.config.setdefault("METRICS_TOKEN", METRICS_TOKEN)
+
+    @app.before_request
+    def before():
+        start_request()
+        g.slow_ms = app.config["SLOW_REQUEST_MS"]
+
+    app.after_request(finish_request)
+    app.teardown_request(finish_failed_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
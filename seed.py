@@ -1,69 +1,63 @@
 """Utility file to seed fake data while building app"""
 
 import datetime
-from sqlalchemy import func
 
-from tablesetup import User, Foodstuff, Location, Barcode, connect_to_db, db
-from server import app
-import bcrypt
+from tablesetup import User, Foodstuff, Location, db
+from server import create_app
 from pantry_functions import hash_it
+from migrations import upgrade
+from bulk_load import insert_rows
 
 
-def load_users(user_file):
-    """Load users from u.fake_users into database."""
+def read_rows(data_file):
+    """Yields the |-separated fields of each line"""
 
-    for row in open(user_file):
-        row = row.rstrip()
-        username, pword, fname, lname, email = row.split("|")
-        
-        time = datetime.datetime.now()
-        hashed_pword = hash_it(pword)
+    for row in open(data_file):
+        yield row.rstrip().split("|")
 
-        user = User(username=username, pword=hashed_pword, fname=fname, lname=lname,
-                    date_created=time, email=email)
+def load_users(user_file, hashes=None):
+    """Load users from u.fake_users into database. hashes is an optional
+       {password: bcrypt hash} to use instead of hashing again."""
 
-        # We need to add to the session or it won't ever be stored
-        db.session.add(user)
+    time = datetime.datetime.now()
+    # Hash each distinct password once, it's the slow part
+    hashes = dict(hashes or {})
 
-    # Once we're done, we should commit our work
+    def rows():
+        for username, pword, fname, lname, email in read_rows(user_file):
+            if pword not in hashes:
+                hashes[pword] = hash_it(pword)
+            yield username, hashes[pword], fname, lname, time, email
+
+    insert_rows(db.session, User.__table__,
+                ["username", "pword", "fname", "lname", "date_created", "email"],
+                rows())
     db.session.commit()
 
 def load_locations(loc_file):
     """Load locations from u.fake_locations into database."""
 
-    for row in open(loc_file):
-        row = row.rstrip()
-        user_id, name = row.split("|")
-
-        user_id = int(user_id)
-
-        loc = Location(location_name=name, user_id=user_id)
-
-        db.session.add(loc)
-
+    rows = ((int(user_id), name) for user_id, name in read_rows(loc_file))
+    insert_rows(db.session, Location.__table__, ["user_id", "location_name"],
+                rows)
     db.session.commit()
 
 def load_items(food_file):
     """Load items from u.fake_foods into database."""
 
-    for row in open(food_file):
-        row = row.rstrip()
-        user, name, loc = row.split("|")
-        user = int(user)
-        loc = int(loc)
-        now = datetime.datetime.now()
-
-        item = Foodstuff(user_id=user, name=name, location_id=loc,
-                         last_purch=now, first_add=now)
-
-        db.session.add(item)
-
+    now = datetime.datetime.now()
+    rows = ((int(user), name, int(loc), now, now)
+            for user, name, loc in read_rows(food_file))
+    insert_rows(db.session, Foodstuff.__table__,
+                ["user_id", "name", "location_id", "last_purch", "first_add"],
+                rows)
     db.session.commit()
 
 if __name__ == "__main__":
     # Run this file to create all tables in db and seed with fake_data
-    connect_to_db(app)
-    db.create_all()
+    app = create_app()
+    # Tables and indexes come from the migrations, same as a live db
+    upgrade(db.engine)
 
     user_file = "fake_data/u.fake_users"
     loc_file = "fake_data/u.fake_locations"
@@ -71,3 +65,4 @@ if __name__ == "__main__":
     load_users(user_file)
     load_locations(loc_file)
     load_items(food_file)
+    # For a big dataset instead: python bulk_load.py --help
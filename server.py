@@ -1,47 +1,86 @@
-"""local server for Remote Pantry"""
+"""local server for Remote Pantry
+
+create_app() builds the app, every route is on the pantry blueprint:
+
+    python server.py                        # development server
+    gunicorn -c gunicorn_conf.py wsgi:app   # production, see wsgi.py
+"""
 
 from collections import OrderedDict
 from datetime import datetime, timedelta
 
-import bcrypt
-from flask import Flask, render_template, redirect, request, flash, session, g, jsonify
+from flask import (Flask, Blueprint, render_template, redirect, request, flash,
+                   session, g, jsonify, make_response, current_app)
 from functools import wraps
-from flask_debugtoolbar import DebugToolbarExtension
 from jinja2 import StrictUndefined
+import logging
 import os
-import requests
-import json
+import time
 
+from passwords import HashingBusy
+import passwords
 from pantry_functions import (login_required, get_user_by_uname, is_pword,
                               hash_it, basic_locs, get_locs, eatme_generator,
                               get_shop_lst, refilled, out_of_stock, to_refill,
                               make_pantry, make_new_user, better_than_boolean,
                               history_generator, add_to_pan, remove_from_shop,
-                              get_tz)
-from tablesetup import User, Foodstuff, Location, Barcode, connect_to_db, db
-
-
-app = Flask(__name__)
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-
-# Required to use Flask sessions and the debug toolbar
-app.secret_key = "secretSECRETsecret"
-# Using an undefined variable in Jinja2 raises an error
-app.jinja_env.undefined = StrictUndefined
-
-@app.route('/')
+                              get_tz, to_ids, current_user, set_current_user,
+                              rehash_if_needed, set_status, edit_values,
+                              add_foodstuffs)
+from tablesetup import (User, Foodstuff, Location, Barcode, PantryPool,
+                        connect_to_db, db)
+from pantry_cache import (cached_pantry, cached_shop_lst, cached_eatme,
+                          cached_locs, cached_barcode, bump_version, page_etag,
+                          EATME_TTL)
+import pantry_cache
+import delivery_search
+import request_metrics
+import replicas
+from replicas import read_only
+from suggestions import suggest
+import suggestions
+
+# Fine for development, wsgi.py won't start without PANTRY_SECRET_KEY
+DEV_SECRET_KEY = "secretSECRETsecret"
+
+pantry = Blueprint("pantry", __name__)
+
+def conditional(period=None):
+    """Decorator for pages built only from the user's own data: answers 304
+       Not Modified if the browser's copy has the current ETag, before the
+       view does any work. period: the page also changes every period
+       seconds (eat me's days left). Goes under @login_required."""
+
+    def decorator(view):
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            # Pending flash messages are part of the page, render it
+            if session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            etag = page_etag(session['user_id'], request.full_path, period)
+            if etag in request.if_none_match:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            # Browser may keep it, but has to check with us every time
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated
+    return decorator
+
+@pantry.route('/')
+@read_only
 def log_in_form_display():
     """Homepage, log in or register, shows user info if logged in"""
 
-    try:
-        current_user = session["user_id"]
-        current_user_obj = user = User.query.filter_by(user_id=current_user).first()
-    except KeyError:
-        current_user_obj = 0
+    # 0 tells the template nobody is logged in
+    current_user_obj = current_user() or 0
 
     return render_template("homepage.html", user=current_user_obj)
 
-@app.route('/login_handle', methods=["POST"])
+@pantry.route('/login_handle', methods=["POST"])
 def log_in_handle():
     """Log user into profile"""
 
@@ -56,18 +95,26 @@ def log_in_handle():
         return redirect("/")
 
     # Transform and check if pword matches
-    valid_password = is_pword(user, pword_input)
+    try:
+        valid_password = is_pword(user, pword_input)
+    except HashingBusy:
+        flash("Lots of people are logging in right now, please try again.",
+              'danger')
+        return redirect("/")
 
     # Log in or give incorrect pword flash
     if valid_password:
         session["user_id"] = user.user_id
+        set_current_user(user)
+        # Old work factor? Upgrade it in the background
+        rehash_if_needed(user, pword_input)
         flash("Logged in")
         return redirect('/pantry')
     else:
         flash("Incorrect password", 'danger')
         return redirect("/")
 
-@app.route('/logout')
+@pantry.route('/logout')
 @login_required
 def logout():
     """Log out of site"""
@@ -76,7 +123,7 @@ def logout():
     flash("Logged out")
     return redirect("/")
 
-@app.route('/register_handle', methods=["POST"])
+@pantry.route('/register_handle', methods=["POST"])
 def newuser_form_handle():
     """Add new user to db"""
 
@@ -88,20 +135,24 @@ def newuser_form_handle():
     email = request.form.get("email")
     time_zone = int(request.form.get("time_zone"))
 
-    # Transform and auto-create
-    hashed_pword = hash_it(password)
-
-    # Check if username has already been registered
+    # Check if username has already been registered, before paying for a hash
     tricky_user = get_user_by_uname(username)
 
     if not tricky_user:
         # If username is not in system, allow registration
-        make_new_user(username, hashed_pword, fname, lname, email, time_zone)
+        try:
+            hashed_pword = hash_it(password)
+        except HashingBusy:
+            flash("Lots of people are signing up right now, please try again.",
+                  'danger')
+            return redirect('/')
+        user = make_new_user(username, hashed_pword, fname, lname, email,
+                             time_zone)
         flash("Successfully registered")
 
         # Set up session
-        user = User.query.filter_by(username=username).first()
         session["user_id"] = user.user_id
+        set_current_user(user)
 
         # Initialize 4 basic locations for a new user
         basic_locs(user.user_id)
@@ -111,7 +162,7 @@ def newuser_form_handle():
         flash("There is already an account linked to this username.", 'danger')
         return redirect('/')
 
-# @app.route('/add')
+# @pantry.route('/add')
 # @login_required
 # def foodstuff_form_display():
 #     """Display add form"""
@@ -123,7 +174,7 @@ def newuser_form_handle():
 
 #     return render_template("add.html", user_locs=user_locs)
 
-@app.route('/add_item', methods=["POST"])
+@pantry.route('/add_item', methods=["POST"])
 @login_required
 def add_foodstuff():
     """Add a new foodstuff"""
@@ -150,11 +201,12 @@ def add_foodstuff():
 
     db.session.add(new_item)
     db.session.commit()
+    bump_version(current_user)
 
     flash("Successfully added")
     return redirect('/pantry')
 
-@app.route('/add_loc', methods=["POST"])
+@pantry.route('/add_loc', methods=["POST"])
 @login_required
 def add_location():
     """Add a new location"""
@@ -173,13 +225,14 @@ def add_location():
         new_loc = Location(user_id=current_user, location_name=loc)
         db.session.add(new_loc)
         db.session.commit()
+        bump_version(current_user)
         flash("Successfully added")
         return redirect('/pantry')
     else:
         flash("Whoops! That location already exists in your pantry!", 'danger')
         return redirect('/pantry')
 
-@app.route('/updatelocationformhandle', methods=["POST"])
+@pantry.route('/updatelocationformhandle', methods=["POST"])
 @login_required
 def update_location():
     """Change location_name"""
@@ -192,21 +245,25 @@ def update_location():
     # Update location's name
     to_update.location_name = new_name
     db.session.commit()
+    bump_version(session["user_id"])
 
     return jsonify({"locId": location_id, "newName": new_name})
 
-@app.route('/pantry')
+@pantry.route('/pantry')
 @login_required
+@conditional()
+@read_only
 def pantry_display():
     """Display pantry from database"""
 
     current_user = session['user_id']
-    pantry = make_pantry(current_user)
-    user_locs = get_locs(current_user)
+    pantry = cached_pantry(current_user)
+    # make_pantry already has every location as a key, no need to query again
+    user_locs = list(pantry)
 
     return render_template("pantry.html", pantry=pantry, user_locs=user_locs)
 
-@app.route('/update', methods=["POST"])
+@pantry.route('/update', methods=["POST"])
 @login_required
 def update_foodstuff():
     """Update foodstuff item is_pantry and/or is_shopping in database"""
@@ -215,13 +272,19 @@ def update_foodstuff():
     empties = request.form.getlist("empty")
     refills = request.form.getlist("refill")
 
-    out_of_stock(empties)
-    to_refill(refills)
+    current_user = session["user_id"]
+    updated = out_of_stock(current_user, empties) + to_refill(current_user, refills)
+    bump_version(current_user)
+
+    # Ids that aren't this user's (or no longer exist) don't get updated
+    if updated < len(to_ids(empties)) + len(to_ids(refills)):
+        flash("Some items could not be updated.", 'danger')
 
     return redirect('/pantry')
 
-@app.route('/editpantryitem')
+@pantry.route('/editpantryitem')
 @login_required
+@read_only
 def edit_item():
     """Display every field about a pantry item, with option to update any field"""
 
@@ -230,7 +293,7 @@ def edit_item():
     # Grab from database
     item = Foodstuff.query.get(pantry_id)
     current_user = session['user_id']
-    user_locs = get_locs(current_user)
+    user_locs = cached_locs(current_user)
 
     # Need to put user_locs into not-object form for jsonify
     loc_lst = [] # This will be a list of lists, inner list will be [id, name]
@@ -256,111 +319,22 @@ def edit_item():
                     "exp": item.exp, "description": item.description,
                     "barcodeId": item.barcode_id})
 
-@app.route('/updatepantryitem', methods=["POST"])
-@login_required
-def update_single_foodstuff():
-    """Update any field on a single foodstuff item"""
-
-    # Grab from form
-    pantry_id = request.form.get("pantry_id")
-    is_shopping = better_than_boolean(request.form.get("shop"))
-    is_pantry = request.form.get("pantry")
-    name = request.form.get("name")
-    last_purch = request.form.get("last_purch")
-    location = request.form.get("location")
-    exp = request.form.get("exp")
-    description = request.form.get("description")
-
-    #Transform and auto-create
-    current_food_obj = Foodstuff.query.get(pantry_id)
-
-    # Whatever fields a user has filled out will be updated
-    # If no fields were filled, the item will not be changed
-    change_counter = 0
-    loc_change = False
-    pantry_change = False
-    exp_change = False
-    name_change = False
-    purch_change = False
-
-    if name:
-        print "flag name"
-        name = name.encode("utf8")
-        current_food_obj.name = name
-        change_counter += 1
-        name_change = name
-
-    if location:
-        location = int(location)
-        if current_food_obj.location_id != location:
-            current_food_obj.location_id = location
-            change_counter += 1
-            loc_change = True
-
-    if exp:
-        print "flag exp"
-        exp = int(exp)
-        current_food_obj.exp = exp
-        change_counter += 1
-        exp_change = True
-
-    if description:
-        print "flag description"
-        description = description.encode("utf8")
-        current_food_obj.description = description
-        change_counter += 1
-
-    if last_purch:
-        print "flag purch"
-        last_purch = datetime.strptime(last_purch, "%Y-%m-%d")
-        # Have to add hours and minutes or date display isn't accurate
-        proper_last_purch = last_purch.replace(hour=12, minute=00)
-        """Getting timestamp on foodstuff was a problem. For now, just hardcoding 
-           to noon since it will accurately represent the day, which is the only 
-           thing I show to the user (and use to calc eat_me)."""
-        current_food_obj.last_purch = proper_last_purch
-        change_counter += 1
-        purch_change = True
-
-    if is_shopping:
-        print "flag shopping"
-        if current_food_obj.is_shopping != is_shopping:
-            current_food_obj.is_shopping = is_shopping
-            change_counter += 1
-
-    if is_pantry:
-        print "flag pan"
-        is_pantry = better_than_boolean(is_pantry)
-        if current_food_obj.is_pantry != is_pantry:
-            current_food_obj.is_pantry = is_pantry
-            change_counter += 1
-            pantry_change = True
-
-    print "change_counter", change_counter
-    if change_counter != 0:
-        db.session.add(current_food_obj)
-        db.session.commit()
-        flash("Your item has been updated")
-
-    return jsonify({"locChange": loc_change, "nameChange": name_change,
-                    "pantryId": pantry_id, "pantryChange": pantry_change,
-                    "expChange": exp_change, "purchChange": purch_change})
-
-
-@app.route('/shop')
+@pantry.route('/shop')
 @login_required
+@conditional()
+@read_only
 def store_form_display():
     """Display shopping list form"""
 
     # Grab all user's items with is_shopping status
     current_user = session["user_id"]
-    shopping_list = get_shop_lst(current_user)
-    user_locs = get_locs(current_user)
+    shopping_list = cached_shop_lst(current_user)
+    user_locs = cached_locs(current_user)
 
 
     return render_template("store.html", shopping_list=shopping_list, user_locs=user_locs)
 
-@app.route('/restock', methods=["POST"])
+@pantry.route('/restock', methods=["POST"])
 @login_required
 def restock_foodstuff():
     """Update foodstuff item"""
@@ -371,24 +345,34 @@ def restock_foodstuff():
     pan_id = request.form.getlist("hidden_id")
     removals = request.form.getlist("delete")
     
-    refilled(refills, exp, pan_id)
-    remove_from_shop(removals)
+    current_user = session["user_id"]
+    updated = (refilled(current_user, refills, exp, pan_id) +
+               remove_from_shop(current_user, removals))
+    bump_version(current_user)
+
+    if updated < len(to_ids(refills)) + len(to_ids(removals)):
+        flash("Some items could not be updated.", 'danger')
 
     return redirect('/shop')
 
-@app.route('/eatme')
+@pantry.route('/eatme')
 @login_required
+@conditional(EATME_TTL)
+@read_only
 def eatme_display():
     """Display eatme"""
 
     # Grab all user's items with an exp
     current_user = session['user_id']
-    eat_me = eatme_generator(current_user)
-    user_locs = get_locs(current_user)
+    # Optional ?days=N cutoff and ?limit=N
+    within_days = request.args.get("days", type=int)
+    limit = request.args.get("limit", type=int)
+    eat_me = cached_eatme(current_user, within_days, limit)
+    user_locs = cached_locs(current_user)
 
     return render_template("eatme.html", eat_me=eat_me, user_locs=user_locs)
 
-@app.route('/map')
+@pantry.route('/map')
 @login_required
 def map_display():
     """Display google map, displays type 'supermarket' within 1000m, open now"""
@@ -399,19 +383,201 @@ def map_display():
 
     return render_template("map.html")
 
-@app.route('/history')
+@pantry.route('/history')
 @login_required
+@conditional()
+@read_only
 def history_display():
     """Display history page, user's empty items ordered by date"""
 
-    # Grab all user's items marked pantry false
+    # Grab a page of user's items marked pantry false, ?before= is the cursor
+    # from the previous page
     current_user = session['user_id']
-    history = history_generator(current_user)
+    history, next_cursor = history_generator(current_user,
+                                             request.args.get("before"))
+
+    return render_template("history.html", history=history,
+                           next_cursor=next_cursor)
+
+@pantry.route('/api/history')
+@login_required
+@read_only
+def history_api():
+    """One page of history as JSON, pass "next" back as ?before= for more"""
 
+    current_user = session['user_id']
+    history, next_cursor = history_generator(current_user,
+                                             request.args.get("before"))
+
+    items = [{"pantryId": pantry_id, "itemName": name, "lastPurch": pretty}
+             for pantry_id, name, pretty in history]
+    return jsonify({"items": items, "next": next_cursor})
+
+###############################################################################
+"""JSON API: a whole screen in one response, many changes in one request"""
+
+STATE_PARTS = ("pantry", "shopping", "eatme", "locations")
+# Most ops one /api/batch request may carry
+MAX_BATCH = 100
+
+def screen_state(user_id, parts=STATE_PARTS):
+    """Compact, list based state for the pages, from the read cache:
+       pantry: [[location_id, location_name, [[name, pantry_id], ...]], ...]
+       shopping: [[pantry_id, name, exp, location_id], ...]
+       eatme: [[pantry_id, name, location_name, days_left], ...]
+       locations: [[location_id, location_name], ...]"""
+
+    state = {}
+    if "pantry" in parts:
+        state["pantry"] = [[loc.location_id, loc.location_name, items]
+                           for loc, items in cached_pantry(user_id).items()]
+    if "shopping" in parts:
+        state["shopping"] = [list(row) for row in cached_shop_lst(user_id)]
+    if "eatme" in parts:
+        state["eatme"] = cached_eatme(user_id)
+    if "locations" in parts:
+        state["locations"] = [list(row) for row in cached_locs(user_id)]
+    return state
+
+def requested_parts(parts):
+    """Comma separated (query string) or list (JSON) of STATE_PARTS, all of
+       them if not given"""
+
+    if not parts:
+        return STATE_PARTS
+    if isinstance(parts, basestring):
+        parts = parts.split(",")
+    return [part for part in parts if part in STATE_PARTS]
+
+@pantry.route('/api/state')
+@login_required
+@read_only
+def state_api():
+    """Everything the pantry, shopping and eat me pages show, as JSON.
+       ?parts=pantry,locations for less."""
 
-    return render_template("history.html", history=history)
+    current_user = session['user_id']
+    return jsonify(screen_state(current_user,
+                                requested_parts(request.args.get("parts"))))
 
-@app.route('/history_update', methods=["POST"])
+@pantry.route('/api/barcode/<code>')
+@login_required
+def barcode_api(code):
+    """Scanned code to product, {"barcodeId", "code", "name", "brand",
+       "shelfLife"}, 404 if it's not in the catalog. From the read cache,
+       the db only sees the first scan of a code."""
+
+    barcode = cached_barcode(code)
+    if barcode is None:
+        return jsonify({"error": "unknown barcode"}), 404
+    return jsonify({"barcodeId": barcode.barcode_id, "code": barcode.code,
+                    "name": barcode.name, "brand": barcode.brand,
+                    "shelfLife": barcode.shelf_life})
+
+# Most suggestions /api/suggest gives back per list
+MAX_SUGGESTIONS = 20
+
+@pantry.route('/api/suggest')
+@login_required
+def suggest_api():
+    """Type-ahead for item names, ?q=mil&limit=8 gives
+       {"mine": names the user has had, "popular": other common names}.
+       Served from in-memory indexes (suggestions.py), no query per keystroke."""
+
+    limit = min(request.args.get("limit", 10, type=int), MAX_SUGGESTIONS)
+    return jsonify(suggest(session['user_id'], request.args.get("q", ""),
+                           limit))
+
+def apply_op(user_id, op, user_loc_ids):
+    """Carry out one /api/batch op, returns how many items it changed.
+       Raises ValueError if the op doesn't make sense. Doesn't commit,
+       batch_api commits (or rolls back) the whole batch at once."""
+
+    kind = op.get("op")
+    if kind in ("empty", "refill", "unshop", "restore"):
+        ids = op.get("ids", [])
+        return {"empty": out_of_stock, "refill": to_refill,
+                "unshop": remove_from_shop, "restore": add_to_pan}[kind](
+                user_id, ids, commit=False)
+
+    if kind == "restock":
+        items = op.get("items", [])
+        ids = [item["id"] for item in items]
+        exps = [item.get("exp") for item in items]
+        return refilled(user_id, ids, exps, ids, commit=False)
+
+    if kind == "edit":
+        values = edit_values(op)
+        location_id = values.get("location_id")
+        if location_id is not None and location_id not in user_loc_ids:
+            raise ValueError("not one of your locations")
+        if not values:
+            return 0
+        return set_status(user_id, [op["id"]], False, **values)
+
+    if kind == "add":
+        items = op.get("items", [])
+        if any(int(item["location"]) not in user_loc_ids for item in items):
+            raise ValueError("not one of your locations")
+        return len(add_foodstuffs(user_id, items, commit=False))
+
+    if kind == "scan":
+        barcode = cached_barcode(op["code"])
+        if barcode is None:
+            raise ValueError("unknown barcode {}".format(op["code"]))
+        if int(op["location"]) not in user_loc_ids:
+            raise ValueError("not one of your locations")
+        exp = op.get("exp")
+        item = {"name": barcode.name, "location": op["location"],
+                "exp": barcode.shelf_life if exp in (None, "") else exp,
+                "pantry": op.get("pantry", True), "shop": op.get("shop", False),
+                "barcode_id": barcode.barcode_id}
+        return len(add_foodstuffs(user_id, [item], commit=False))
+
+    raise ValueError("unknown op {!r}".format(kind))
+
+@pantry.route('/api/batch', methods=["POST"])
+@login_required
+def batch_api():
+    """Several changes in one request, e.g.
+       {"ops": [{"op": "empty", "ids": [3, 4]},
+                {"op": "edit", "id": 5, "exp": 7, "location": 2},
+                {"op": "add", "items": [{"name": "kiwi", "location": 1}]},
+                {"op": "scan", "code": "3017620422003", "location": 1}],
+        "parts": ["pantry"]}
+       Ops run in order, in one transaction: one bad op and none of them
+       happen. Returns {"results": [items changed per op], "state":
+       screen_state of parts} so the page can redraw in place."""
+
+    current_user = session['user_id']
+    body = request.get_json(silent=True) or {}
+    ops = body.get("ops", [])
+    if not isinstance(ops, list) or len(ops) > MAX_BATCH:
+        return jsonify({"error": "ops must be a list of at most {}".format(
+                                 MAX_BATCH)}), 400
+
+    user_loc_ids = set(loc.location_id for loc in cached_locs(current_user))
+    results = []
+    try:
+        for op in ops:
+            results.append(apply_op(current_user, op, user_loc_ids))
+    except (ValueError, KeyError, TypeError) as e:
+        # Ops before the bad one go too, nothing changed
+        db.session.rollback()
+        return jsonify({"error": "op {}: {}".format(len(results), e),
+                        "results": results}), 400
+    except Exception:
+        db.session.rollback()
+        raise
+
+    db.session.commit()
+    if any(results):
+        bump_version(current_user)
+    return jsonify({"results": results,
+                    "state": screen_state(current_user,
+                                          requested_parts(body.get("parts")))})
+
+@pantry.route('/history_update', methods=["POST"])
 @login_required
 def history_update():
     """Update foodstuff item from history list"""
@@ -420,18 +586,22 @@ def history_update():
     empties = request.form.getlist("empty")
     refills = request.form.getlist("refill")
 
-    add_to_pan(empties)
-    to_refill(refills)
+    current_user = session["user_id"]
+    updated = add_to_pan(current_user, empties) + to_refill(current_user, refills)
+    bump_version(current_user)
+
+    if updated < len(to_ids(empties)) + len(to_ids(refills)):
+        flash("Some items could not be updated.", 'danger')
 
     return redirect('/history')
 
-@app.route('/map_refresh')
+@pantry.route('/map_refresh')
 @login_required
 def reload_map():
     """Allows user to re-call googlimoops api"""
     return redirect('/map')
 
-@app.route('/yelp')
+@pantry.route('/yelp')
 @login_required
 def yelp_search():
     """Display list of restaurants nearby for takeout"""
@@ -442,13 +612,13 @@ def yelp_search():
 
     return render_template("yelp.html")
 
-@app.route('/list_refresh')
+@pantry.route('/list_refresh')
 @login_required
 def reload_list():
     """Allows user to re-call yelp api"""
     return redirect('/yelp')
 
-@app.route('/callyelp', methods=["POST"])
+@pantry.route('/callyelp', methods=["POST"])
 @login_required
 def call_yelp():
     """takes userLoc from frontend, uses it to make request to Yelp API"""
@@ -459,33 +629,113 @@ def call_yelp():
     lat = float(lat)
     lon = float(lon)
 
-    # call yelp API using requests
-    api_key = os.environ['YELP_KEY']
-    payload = {'latitude': lat, 'longitude': lon}
-    headers = {'Authorization': 'Bearer %s' % api_key}
-    url = "https://api.yelp.com/v3/transactions/delivery/search"
-    req = requests.get(url, params=payload, headers=headers)
-
-    # convert response to dictionary, create new structure to pass to frontend
-    req_dict = json.loads(req.text)
-    pass_lst = []
-    for resto in req_dict['businesses']:
-        pass_lst.append(resto['name'])
-        pass_lst.append(resto['url'])
-        pass_lst.append(resto['rating'])
-        pass_lst.append(resto['categories'][0]['title'])
+    # Pooled, time-limited call to yelp, shared by everyone in the same cell
+    try:
+        yelp_list = delivery_search.search(lat, lon)
+    except delivery_search.DeliverySearchError:
+        # Degraded answer, page shows the message instead of a list
+        return jsonify({'yelpList': [], 'degraded': True,
+                        'error': "Take-out search is unavailable, try again soon."})
+
+    return jsonify({'yelpList': yelp_list})
+
+###############################################################################
+"""App factory"""
+
+def create_app(config=None):
+    """Builds the app. config: dict of settings on top of the defaults,
+       which come from the PANTRY_* environment variables where there is
+       one. Nothing connects to the db until the first request (or
+       warmup())."""
+
+    start = time.time()
+    request_metrics.startup_began(start)
+
+    app = Flask(__name__)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=os.environ.get("PANTRY_DB_URI",
+                                               "postgresql:///pantry"),
+        # Required to use Flask sessions and the debug toolbar
+        SECRET_KEY=os.environ.get("PANTRY_SECRET_KEY", DEV_SECRET_KEY),
+        # Per-user read cache, redis://... shares it between workers,
+        # otherwise each process keeps its own LRU
+        PANTRY_CACHE_URL=os.environ.get("PANTRY_CACHE_URL"),
+        # Processes serving the app, gunicorn_conf.py sets it
+        PANTRY_WORKERS=int(os.environ.get("PANTRY_WORKERS", 1)),
+        DEBUG_TOOLBAR=False,
+        DEBUG_TB_INTERCEPT_REDIRECTS=False)
+    app.config.update(config or {})
+
+    # Using an undefined variable in Jinja2 raises an error
+    app.jinja_env.undefined = StrictUndefined
+
+    pantry_cache.configure(app.config["PANTRY_CACHE_URL"])
+    if app.config["PANTRY_WORKERS"] > 1 and not pantry_cache.is_shared():
+        # Each worker would have its own versions, and serve stale pages
+        # after another worker's write
+        raise RuntimeError("{} workers need a shared cache, set "
+                           "PANTRY_CACHE_URL=redis://...".format(
+                           app.config["PANTRY_WORKERS"]))
+    # Query counts, DB time and latency per route on /metrics, slow requests
+    # are logged with their SQL (SLOW_REQUEST_MS, default PANTRY_SLOW_MS or 500)
+    request_metrics.init_app(app)
+    # Reads from the replica if there is one (DB_REPLICA_URI), a user's
+    # writes keep them on the primary for a few seconds
+    replicas.init_app(app)
+    app.register_blueprint(pantry)
+    connect_to_db(app, app.config["SQLALCHEMY_DATABASE_URI"])
+
+    if app.config["DEBUG_TOOLBAR"]:
+        # Only imported when it's wanted, it's a good part of import time
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    request_metrics.startup_step("create_app", time.time() - start)
+    return app
+
+def warmup(app, threads=None):
+    """Get a worker ready before it's sent requests: open its pool's
+       connections (the replica's too, no more than threads, which is as
+       many as it can use at once), compile every template and build the
+       popular names, so the first users don't wait for any of it. Returns
+       seconds taken."""
+
+    start = time.time()
+    engines = [db.get_engine(app)]
+    if replicas.has_replica(app):
+        engines.append(db.get_engine(app, bind="replica"))
+    for engine in engines:
+        size = 1
+        if isinstance(engine.pool, PantryPool):
+            size = engine.pool.size()
+            if threads is not None:
+                size = min(size, threads)
+        connections = [engine.connect() for i in range(size)]
+        for connection in connections:
+            connection.close()
+
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+    with app.app_context():
+        suggestions.rebuild_popular()
+
+    seconds = time.time() - start
+    request_metrics.startup_step("warmup", seconds)
+    return seconds
 
-    return jsonify({'yelpList': pass_lst})
 
 if __name__ == "__main__":
-    # We have to set debug=True here, since it has to be True at the point
-    # that we invoke the DebugToolbarExtension
+    # Set DEBUG_TOOLBAR to use the DebugToolbar, it has to be on when the
+    # app is built
+    app = create_app({"DEBUG_TOOLBAR": "PANTRY_DEBUG_TOOLBAR" in os.environ})
     # app.debug = True
 
-    connect_to_db(app)
-
-    # Use the DebugToolbar
-    #DebugToolbarExtension(app)
+    # Slow requests are logged as warnings
+    logging.basicConfig()
+    # bcrypt runs in its own processes, start them before serving
+    passwords.start()
+    warmup(app)
 
     app.run()
     # app.run(port=5000, host='0.0.0.0')
@@ -12,15 +12,15 @@ function addDisplay(evt) {
 
 $(".addModalButt").on('click', addDisplay);
 
-// listener and functions to handle ADD form submission - update db and reload
+// listener and functions to handle ADD form submission - update db and redraw
 function addFoodstuff(result) {
 
     // Manually clear form input box
-    $("#add_name").val("");
+    $("input[name=add_name]").val("");
     $("#add_exp").val("");
 
-    // Reload page because too many things to manually change
-    location.reload(true);
+    // Batch API sends the pantry back, no need to reload
+    redrawPantry(result.state.pantry);
 }
 
 function getFoodstuff(evt) {
@@ -30,19 +30,43 @@ function getFoodstuff(evt) {
     loc = $('input[name=add_loc]:checked').val();
     exp = $("#add_exp").val();
 
-    let formInput = {
-        "pantry": "True",
-        "shop": "False",
+    let item = {
+        "pantry": true,
+        "shop": false,
         "name": name,
         "location": loc,
         "exp": exp,
     }
-    console.log(formInput);
-    $.post("/add_item", formInput, addFoodstuff)
+    postBatch([{"op": "add", "items": [item]}], ["pantry"], addFoodstuff)
 }
 
 $("#addSubmit").on('click', getFoodstuff);
 
+// Type-ahead for the name boxes: the user's own names first, then popular
+// ones, in the datalist the inputs point at
+var suggestTimer;
+
+function showSuggestions(result) {
+    var list = $("#nameSuggestions").empty();
+    $.each(result.mine.concat(result.popular), function(i, name) {
+        list.append($("<option>", {"value": name}));
+    });
+}
+
+function suggestNames(evt) {
+    var query = $(this).val();
+    clearTimeout(suggestTimer);
+    if (!query) {
+        return;
+    }
+    // Wait for a pause in the typing, not one request per key
+    suggestTimer = setTimeout(function() {
+        $.get("/api/suggest", {"q": query, "limit": 8}, showSuggestions);
+    }, 100);
+}
+
+$("input[name=add_name], input[name=shop_name]").on('input', suggestNames);
+
 // Listener and function to display ADD form in modal on SHOPPING
 // Not required, there are no fields with placeholders!
 
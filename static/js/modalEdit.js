@@ -99,18 +99,34 @@ function foodEditDisplay(evt) {
     $.get("/editpantryitem", formInput, foodEditPrefills)
 }
 
-$(".editFoodLink").on('click', foodEditDisplay);
+// Delegated, rows get redrawn after an update
+$(document).on('click', '.editFoodLink', foodEditDisplay);
+
+// The edit modal is on the pantry and the eat me pages, redraw whichever
+// this is
+function onEatmePage() {
+    return $("#eatmeTable").length > 0;
+}
 
 // listener and functions to handle FOOD form submission - update db and change view
 function updatePantryPageFood(result) {
-    
-    // Return to this later, change so jQuery reveals a flash message
-    // Also necessitates re-working all flash handling for this route
-    // For now, just reload page
-    location.reload(true);
+
+    // Batch API sends the page's state back, redraw it instead of reloading
+    if (result.state.eatme) {
+        redrawEatme(result.state.eatme);
+    }
+    else {
+        redrawPantry(result.state.pantry);
+    }
+}
+
+// Radio buttons give "True"/"False" (or nothing), the API wants booleans
+function radioBool(value) {
+    return value === undefined ? undefined : value == "True";
 }
 
 function foodUpdate(evt) {
+    evt.preventDefault();
 
     pantryId = $(this).data("pantryid");
     // get all fields from form, put in formInput
@@ -122,18 +138,20 @@ function foodUpdate(evt) {
     exp = $("#exp").val();
     description = $("#descript").val();
 
-    let formInput = {
-        "pantry_id": pantryId,
+    let edit = {
+        "op": "edit",
+        "id": pantryId,
         "name": name,
-        "pantry": pantry,
-        "shop": shopping,
+        "pantry": radioBool(pantry),
+        "shop": radioBool(shopping),
         "last_purch": purch,
         "location": loc,
         "exp": exp,
         "description": description
     }
 
-    $.post("/updatepantryitem", formInput, updatePantryPageFood)
+    postBatch([edit], [onEatmePage() ? "eatme" : "pantry"],
+              updatePantryPageFood)
 }
 
 $("#foodSubmit").on('click', foodUpdate);
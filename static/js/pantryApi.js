@@ -0,0 +1,105 @@
+"use strict";
+
+// One request for any number of changes, comes back with fresh state to redraw
+// ops: [{op: "empty", ids: [3]}, {op: "edit", id: 5, exp: 7}, ...]
+// parts: which bits of state to send back, e.g. ["pantry"]
+function postBatch(ops, parts, callback) {
+    $.ajax({
+        url: "/api/batch",
+        type: "POST",
+        contentType: "application/json",
+        data: JSON.stringify({"ops": ops, "parts": parts}),
+        success: callback,
+        error: function() {
+            // Something didn't go through, show what the server has
+            location.reload(true);
+        }
+    });
+}
+
+function itemRow(name, pantryId) {
+    let link = $("<a>", {
+        "href": "#foodEditModal",
+        "id": "foodLink-" + pantryId,
+        "class": "editFoodLink",
+        "data-toggle": "modal",
+        "data-target": "#foodEditModal",
+        "data-itemid": pantryId,
+        "data-itemname": name
+    }).text(name);
+
+    let row = $("<tr>").append($("<td>").append(link));
+    $.each(["empty", "refill"], function(i, field) {
+        row.append($("<td>").append($("<input>", {
+            "type": "checkbox",
+            "name": field,
+            "data-toggle": "toggle",
+            "data-on": field == "empty" ? "Empty" : "Refill",
+            "data-off": " ",
+            "data-size": "mini",
+            "value": pantryId
+        })));
+    });
+    return row;
+}
+
+// pantry: [[locationId, locationName, [[name, pantryId], ...]], ...]
+function redrawPantry(pantry) {
+    $.each(pantry, function(i, loc) {
+        let locId = loc[0], items = loc[2];
+        let table = $("#loctable-" + locId);
+        if (table.length == 0) {
+            // A location this page doesn't have a panel for yet
+            location.reload(true);
+            return false;
+        }
+
+        table.find("tr:gt(0)").remove();
+        $.each(items, function(j, item) {
+            table.append(itemRow(item[0], item[1]));
+        });
+        table.find("input[data-toggle=toggle]").bootstrapToggle();
+        $("#locbadge-" + locId).text(items.length);
+    });
+}
+
+// eatme: [[pantryId, name, locationName, daysLeft], ...], soonest first
+function redrawEatme(eatme) {
+    var table = $("#eatmeTable");
+
+    table.find("tr:gt(0)").remove();
+    $.each(eatme, function(i, item) {
+        var link = $("<a>", {
+            "href": "#foodEditModal",
+            "id": "foodLink-" + item[0],
+            "class": "editFoodLink",
+            "data-toggle": "modal",
+            "data-target": "#foodEditModal",
+            "data-itemid": item[0],
+            "data-itemname": item[1]
+        }).text(item[1]);
+        table.append($("<tr>").append(
+            $("<td>").append(link),
+            $("<td>", {"class": item[3] > -1 ? "positive" : "negative"})
+                .text(item[3]),
+            $("<td>").text(item[2] || "")));
+    });
+}
+
+// Pantry page Update button: empties and refills without a page load
+function pantryFormSubmit(evt) {
+    evt.preventDefault();
+
+    let checked = function(field) {
+        return $("#pantryForm input[name=" + field + "]:checked").map(function() {
+            return $(this).val();
+        }).get();
+    };
+
+    postBatch([{"op": "empty", "ids": checked("empty")},
+               {"op": "refill", "ids": checked("refill")}],
+              ["pantry"],
+              function(result) { redrawPantry(result.state.pantry); });
+}
+
+$("#pantryForm").on('submit', pantryFormSubmit);
@@ -0,0 +1,248 @@
+"""Type-ahead name suggestions for the add forms
+
+Each user's names (everything they've ever had, with how often) are built
+into a NameIndex once per cache version and kept in pantry_cache, so a
+keystroke is a couple of binary searches in memory, not a query.
+
+The most popular names across all users are one NameIndex per process, not
+in the cache where it could be evicted. warmup() builds it before a worker
+takes requests; after that, a request that finds it older than POPULAR_TTL
+starts a rebuild in a background thread (one at a time) and goes on with
+the old one, so no request ever waits on the big GROUP BY.
+
+A query matches a name if it starts the name ("mil" -> "milk"), starts any
+word in it ("cre" -> "ice cream"), or, failing enough of those, is one typo
+away from the start of the name ("mlik" -> "milk"). Typos are found by
+looking up every one-edit variant of the query, so the cost doesn't grow
+with the number of names.
+"""
+
+from bisect import bisect_left
+import heapq
+import logging
+import threading
+import time
+
+from flask import current_app
+
+import pantry_cache
+from pantry_functions import name_counts, popular_names
+
+# Names kept in the shared popular list
+POPULAR_SIZE = 2000
+POPULAR_TTL = 60 * 60
+# Seconds before trying again after a rebuild failed
+POPULAR_RETRY = 60
+# Typo matching only kicks in for queries at least this long
+FUZZY_MIN = 3
+# Queries this short are answered from lists kept for every such prefix
+SHORT = 2
+# Most names search() gives back
+MAX_LIMIT = 20
+
+
+log = logging.getLogger("pantry.suggestions")
+
+
+def normalize(name):
+    if isinstance(name, str):
+        name = name.decode("utf8", "replace")
+    return u" ".join(name.lower().split())
+
+
+class NameIndex(object):
+    """Names sorted for prefix lookups. Plain lists and tuples, so it's
+       compact and pickles for a shared cache backend."""
+
+    def __init__(self, counts):
+        # Same name spelled differently counts once, most used spelling shown
+        best = {}
+        for name, count in counts:
+            key = normalize(name)
+            if not key:
+                continue
+            total, shown, shown_count = best.get(key, (0, name, 0))
+            if count > shown_count:
+                shown, shown_count = name, count
+            best[key] = (total + count, shown, shown_count)
+
+        self.keys = sorted(best)
+        self.names = [best[key][1] for key in self.keys]
+        self.counts = [best[key][0] for key in self.keys]
+
+        # Every later word in a name, pointing back at the name
+        words = []
+        for i, key in enumerate(self.keys):
+            start = key.find(" ")
+            while start != -1:
+                words.append((key[start + 1:], i))
+                start = key.find(" ", start + 1)
+        words.sort()
+        self.word_keys = [word for word, i in words]
+        self.word_ids = [i for word, i in words]
+
+        # Short prefixes match lots of names, keep their best ones ready
+        self.top = self.top_by_prefix(self.keys, xrange(len(self.keys)))
+        self.word_top = self.top_by_prefix(self.word_keys, self.word_ids)
+        self.alphabet = sorted(set("".join(self.keys)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def top_by_prefix(self, keys, ids):
+        """{prefix: best MAX_LIMIT ids} for every prefix up to SHORT long"""
+
+        groups = {}
+        for key, i in zip(keys, ids):
+            for end in range(1, min(len(key), SHORT) + 1):
+                groups.setdefault(key[:end], set()).add(i)
+        return dict((prefix, heapq.nlargest(MAX_LIMIT, group,
+                                            key=lambda i: self.counts[i]))
+                    for prefix, group in groups.items())
+
+    def name_ids(self, prefix):
+        """ids of the names starting with prefix"""
+
+        return xrange(*prefix_range(self.keys, prefix))
+
+    def word_match_ids(self, prefix):
+        """ids of the names with a later word starting with prefix"""
+
+        start, end = prefix_range(self.word_keys, prefix)
+        return self.word_ids[start:end]
+
+    def search(self, query, limit=10):
+        """Best limit names for query, most used first within prefix
+           matches, then word matches, then typo matches"""
+
+        query = normalize(query)
+        limit = min(limit, MAX_LIMIT)
+        if not query:
+            return []
+
+        found = []
+        seen = set()
+
+        def add(ids):
+            ids = set(ids) - seen
+            for i in heapq.nlargest(limit - len(found), ids,
+                                    key=lambda i: self.counts[i]):
+                seen.add(i)
+                found.append(i)
+
+        if len(query) <= SHORT:
+            add(self.top.get(query, []))
+            if len(found) < limit:
+                add(self.word_top.get(query, []))
+        else:
+            add(self.name_ids(query))
+            if len(found) < limit:
+                add(self.word_match_ids(query))
+        if len(found) < limit and len(query) >= FUZZY_MIN:
+            add(self.typo_matches(query))
+        return [self.names[i] for i in found]
+
+    def typo_matches(self, query):
+        """ids of names starting with query give or take one typo (a
+           letter missing, extra, wrong or swapped with the next)"""
+
+        ids = set()
+        for variant in one_edit(query, self.alphabet):
+            if len(variant) >= FUZZY_MIN:
+                ids.update(self.name_ids(variant))
+        return ids
+
+
+def prefix_range(keys, prefix):
+    """(start, end) of the sorted keys starting with prefix"""
+
+    return (bisect_left(keys, prefix),
+            bisect_left(keys, prefix + u"\uffff"))
+
+def one_edit(word, alphabet):
+    """Every string one delete, insert, replace or swap away from word"""
+
+    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    variants = set()
+    for left, right in splits:
+        if right:
+            variants.add(left + right[1:])
+            for char in alphabet:
+                variants.add(left + char + right[1:])
+        if len(right) > 1:
+            variants.add(left + right[1] + right[0] + right[2:])
+        for char in alphabet:
+            variants.add(left + char + right)
+    variants.discard(word)
+    return variants
+
+###############################################################################
+"""Cached indexes"""
+
+# This process's popular index, when it was built and last tried
+popular = {"index": NameIndex([]), "built_at": 0, "tried_at": 0}
+popular_lock = threading.Lock()
+
+
+def user_index(user_id):
+    """NameIndex of the user's names, rebuilt after any change to their
+       foodstuffs (the cache version moves)"""
+
+    def compute():
+        return NameIndex(name_counts(user_id))
+
+    return pantry_cache.cached(user_id, "names", compute)
+
+def rebuild_popular():
+    """Build the popular index now, in this thread"""
+
+    with popular_lock:
+        popular["tried_at"] = time.time()
+        index = NameIndex(popular_names(POPULAR_SIZE))
+        popular["index"] = index
+        popular["built_at"] = time.time()
+
+def rebuild_in_background(app):
+    """Start rebuilding the popular index in a thread, unless one already
+       is. Returns the thread, or None."""
+
+    # Whoever gets the lock rebuilds, the rest don't wait for it
+    if not popular_lock.acquire(False):
+        return None
+    popular["tried_at"] = time.time()
+
+    def rebuild():
+        try:
+            with app.app_context():
+                index = NameIndex(popular_names(POPULAR_SIZE))
+            popular["index"] = index
+            popular["built_at"] = time.time()
+        except Exception:
+            log.exception("popular names rebuild failed")
+        finally:
+            popular_lock.release()
+
+    thread = threading.Thread(target=rebuild, name="popular-names")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def popular_index():
+    """NameIndex of names across all users, counted by how many have them.
+       Never waits for a rebuild, empty until the first one is done."""
+
+    now = time.time()
+    if (now - popular["built_at"] > POPULAR_TTL and
+            now - popular["tried_at"] > POPULAR_RETRY):
+        rebuild_in_background(current_app._get_current_object())
+    return popular["index"]
+
+def suggest(user_id, query, limit=10):
+    """Returns {"mine": user's own names, "popular": other users' names
+       they haven't had}, each at most limit long"""
+
+    mine = user_index(user_id).search(query, limit)
+    have = set(normalize(name) for name in mine)
+    popular = [name for name in popular_index().search(query, limit + len(mine))
+               if normalize(name) not in have]
+    return {"mine": mine, "popular": popular[:limit]}
@@ -1,10 +1,179 @@
 """Models and database functions for Remote Pantry"""
 
-from flask_sqlalchemy import SQLAlchemy
-import bcrypt
-from datetime import datetime
+from flask import g, has_request_context, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, exc, orm
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import QueuePool, NullPool
+from sqlalchemy.sql.expression import FunctionElement, UpdateBase
+from datetime import datetime, timedelta
+import os
+import threading
+import time
+
+# Connection pool settings: app.config key, PANTRY_ environment variable,
+# default. connect_to_db() arguments (pool_size=...) beat both.
+#
+# Sizing: every worker process has its own pool, so a deploy can open up to
+# processes * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections, and that has to
+# stay under the server's max_connections. A threaded worker needs about as
+# many connections as requests it's in the db for at once, which is far
+# fewer than its threads; python loadtest.py --workers N measures it and
+# prints a suggestion. If the sum doesn't fit, put pgbouncer in front
+# (transaction pooling) and set DB_PGBOUNCER: each worker then opens
+# connections only for as long as it needs them and pgbouncer shares a few
+# real ones between all of them.
+POOL_SETTINGS = [
+    ("DB_POOL_SIZE", "PANTRY_DB_POOL_SIZE", 5),
+    ("DB_MAX_OVERFLOW", "PANTRY_DB_MAX_OVERFLOW", 10),
+    # Seconds to wait for a free connection before giving up with an error
+    ("DB_POOL_TIMEOUT", "PANTRY_DB_POOL_TIMEOUT", 10),
+    # Reopen connections older than this many seconds (server/firewall
+    # idle timeouts)
+    ("DB_POOL_RECYCLE", "PANTRY_DB_POOL_RECYCLE", 1800),
+    # Check connections with SELECT 1 on checkout, a restarted db costs a
+    # retry instead of a 500
+    ("DB_PRE_PING", "PANTRY_DB_PRE_PING", True),
+    # Behind pgbouncer in transaction mode: no pool of our own
+    ("DB_PGBOUNCER", "PANTRY_DB_PGBOUNCER", False),
+]
+
+# Read replica, see replicas.py. connect_to_db(app, uri, replica_uri=...)
+# beats DB_REPLICA_URI.
+REPLICA_SETTINGS = [
+    ("DB_REPLICA_URI", "PANTRY_DB_REPLICA_URI", None),
+    # Replica further behind than this many seconds isn't used
+    ("DB_REPLICA_MAX_LAG", "PANTRY_DB_REPLICA_MAX_LAG", 2.0),
+    # Seconds a user reads from the primary after changing something. Has
+    # to be more than DB_REPLICA_MAX_LAG, or they could miss their change.
+    ("DB_REPLICA_STICKY", "PANTRY_DB_REPLICA_STICKY", 5.0),
+]
+
+# Checkouts from every PantryPool in this process, for /metrics
+pool_stats = {"checkouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0,
+              "timeouts": 0, "in_use": 0, "max_in_use": 0,
+              "hold_seconds": 0.0}
+pool_stats_lock = threading.Lock()
+
+
+class PantryPool(QueuePool):
+    """QueuePool that times how long checkouts wait and connections are
+       held (into pool_stats and the request's g.pool_wait), and pings
+       connections on checkout if pre_ping"""
+
+    def __init__(self, creator, pre_ping=True, **kw):
+        QueuePool.__init__(self, creator, **kw)
+        self.pre_ping = pre_ping
+        # recreate() (engine.dispose()) hands the new pool the old one's
+        # listeners in _dispatch, adding them again would count twice
+        if not kw.get("_dispatch"):
+            event.listen(self, "checkout", self.on_checkout)
+            event.listen(self, "checkin", self.on_checkin)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.pre_ping = self.pre_ping
+        return pool
+
+    def _do_get(self):
+        """Waiting for a free connection (or opening a new one)"""
+
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            with pool_stats_lock:
+                pool_stats["timeouts"] += 1
+            raise
+        finally:
+            waited = time.time() - start
+            with pool_stats_lock:
+                pool_stats["wait_seconds"] += waited
+                pool_stats["max_wait_seconds"] = max(
+                    pool_stats["max_wait_seconds"], waited)
+            if has_request_context() and "pool_wait" in g:
+                g.pool_wait += waited
+
+    def on_checkout(self, dbapi_connection, connection_record,
+                    connection_proxy):
+        if self.pre_ping:
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+            except Exception:
+                # The pool throws this connection away and tries another
+                raise exc.DisconnectionError()
+            finally:
+                cursor.close()
+
+        connection_record.info["checked_out_at"] = time.time()
+        with pool_stats_lock:
+            pool_stats["checkouts"] += 1
+            pool_stats["in_use"] += 1
+            pool_stats["max_in_use"] = max(pool_stats["max_in_use"],
+                                           pool_stats["in_use"])
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is None:
+            return
+        with pool_stats_lock:
+            pool_stats["in_use"] -= 1
+            pool_stats["hold_seconds"] += time.time() - checked_out_at
+
+
+def reset_pool_stats():
+    """Start counting from now (in_use is left alone, it's a gauge)"""
+
+    with pool_stats_lock:
+        for key in pool_stats:
+            if key != "in_use":
+                pool_stats[key] = 0
+        pool_stats["max_in_use"] = pool_stats["in_use"]
+
+
+class PantrySession(SignallingSession):
+    """Session that sends queries to the read replica while the request has
+       g.db_replica set (replicas.read_only decides). Flushes, updates and
+       deletes always go to the primary."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing and not isinstance(clause, UpdateBase) and
+                has_app_context() and g.get("db_replica")):
+            return db.get_engine(self.app, bind="replica")
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class PantrySQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with the POOL_SETTINGS from app.config and
+       PantrySession"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=PantrySession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername.startswith("sqlite"):
+            # Flask-SQLAlchemy already picks the right pool for SQLite
+            return
+
+        if app.config["DB_PGBOUNCER"]:
+            # pgbouncer does the pooling, one of our own would keep its
+            # server connections tied up. psycopg2 doesn't use server side
+            # prepared statements, so nothing else to turn off.
+            options["poolclass"] = NullPool
+            return
+
+        options["poolclass"] = PantryPool
+        options["pre_ping"] = app.config["DB_PRE_PING"]
+        options["pool_size"] = app.config["DB_POOL_SIZE"]
+        options["max_overflow"] = app.config["DB_MAX_OVERFLOW"]
+        options["pool_timeout"] = app.config["DB_POOL_TIMEOUT"]
+        options["pool_recycle"] = app.config["DB_POOL_RECYCLE"]
+
+
 # Connection to PosgreSQL database
-db = SQLAlchemy()
+db = PantrySQLAlchemy()
 
 ###############################################################################
 """Model classes, for object-oriented relational db"""
@@ -43,6 +212,9 @@ class Foodstuff(db.Model):
     first_add = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     location_id = db.Column(db.Integer, db.ForeignKey('locations.location_id'))
     exp = db.Column(db.Integer, nullable=True)
+    # last_purch + exp + 1 days, stored so "expiring soon" can use an index.
+    # Kept in step by set_expires_at (ORM) and set_status (bulk UPDATEs)
+    expires_at = db.Column(db.DateTime, nullable=True)
     description = db.Column(db.String(300), nullable=True)
     barcode_id = db.Column(db.Integer, db.ForeignKey('barcodes.barcode_id'),
                            nullable=True)
@@ -51,6 +223,28 @@ class Foodstuff(db.Model):
     location = db.relationship('Location', backref=db.backref("locations"))
     barcode = db.relationship('Barcode', backref=db.backref("barcodes"))
 
+    # Access paths for the hot filters, keep in sync with migrations.py
+    __table_args__ = (
+        # make_pantry: user's in-pantry items by location, sorted by name
+        db.Index('ix_foodstuffs_pantry', user_id, is_pantry, location_id, name),
+        # get_shop_lst: only the few rows on the shopping list
+        db.Index('ix_foodstuffs_shopping', user_id, location_id,
+                 postgresql_where=db.text('is_shopping'),
+                 sqlite_where=db.text('is_shopping')),
+        # eatme_generator: user's in-pantry items by expiry
+        db.Index('ix_foodstuffs_user_expires', user_id, expires_at,
+                 postgresql_where=db.text('is_pantry AND expires_at IS NOT NULL'),
+                 sqlite_where=db.text('is_pantry AND expires_at IS NOT NULL')),
+        # expiring_within: everyone's items expiring in a time range
+        db.Index('ix_foodstuffs_expires', expires_at,
+                 postgresql_where=db.text('is_pantry AND expires_at IS NOT NULL'),
+                 sqlite_where=db.text('is_pantry AND expires_at IS NOT NULL')),
+        # history_generator: items in neither pantry nor shopping, newest first
+        db.Index('ix_foodstuffs_history', user_id, last_purch, pantry_id,
+                 postgresql_where=db.text('NOT is_pantry AND NOT is_shopping'),
+                 sqlite_where=db.text('NOT is_pantry AND NOT is_shopping')),
+    )
+
     def __repr__(self):
         """display food objects nicely, for debugging"""
         return "<Food id={} name={}>".format(self.pantry_id, self.name)
@@ -66,42 +260,159 @@ class Location(db.Model):
 
     user = db.relationship('User', backref=db.backref("locations"))
 
+    # get_locs and the duplicate name check in add_location
+    __table_args__ = (
+        db.Index('ix_locations_user_name', user_id, location_name),
+    )
+
     def __repr__(self):
         """display locations nicely, for debugging"""
         return "<Location id={} name={}>".format(self.location_id,
                                                  self.location_name)
 
 class Barcode(db.Model):
-    """Barcode table for pantry site"""
+    """Product catalog entry, filled by barcode_import.py"""
 
     __tablename__ = "barcodes"
 
     barcode_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     food_type = db.Column(db.String(50), nullable=True)
+    # EAN-13/EAN-8 digits, see pantry_functions.normalize_code
+    code = db.Column(db.String(14), nullable=True)
+    name = db.Column(db.String(200), nullable=True)
+    brand = db.Column(db.String(100), nullable=True)
+    # Days it keeps, the default exp for a scanned item
+    shelf_life = db.Column(db.Integer, nullable=True)
+
+    # Scan lookups, and the import's upsert on code
+    __table_args__ = (
+        db.Index('ix_barcodes_code', code, unique=True),
+    )
 
     def __repr__(self):
-        """display locations nicely, for debugging"""
-        return "<barcode id={}>".format(self.barcode_id)
+        """display barcodes nicely, for debugging"""
+        return "<Barcode id={} code={} name={}>".format(self.barcode_id,
+                                                       self.code, self.name)
+
+###############################################################################
+"""Expiry"""
+
+def expiry(last_purch, exp):
+    """When an item bought at last_purch with exp days expires (the day after
+       its last good day), None if it has no exp"""
+
+    if exp is None or exp == "" or last_purch is None:
+        return None
+    return last_purch + timedelta(days=int(exp) + 1)
+
+class expires_after(FunctionElement):
+    """SQL version of expiry(), for UPDATEs that set last_purch or exp
+       without loading the rows: expires_after(last_purch, exp)"""
+
+    type = db.DateTime()
+    name = "expires_after"
+
+@compiles(expires_after, "postgresql")
+def compile_expires_after_pg(element, compiler, **kw):
+    last_purch, exp = list(element.clauses)
+    return "{} + ({} + 1) * interval '1 day'".format(
+           compiler.process(last_purch, **kw), compiler.process(exp, **kw))
+
+@compiles(expires_after, "sqlite")
+def compile_expires_after_sqlite(element, compiler, **kw):
+    last_purch, exp = list(element.clauses)
+    return "datetime({}, '+' || ({} + 1) || ' days')".format(
+           compiler.process(last_purch, **kw), compiler.process(exp, **kw))
+
+@event.listens_for(Foodstuff, "before_insert")
+@event.listens_for(Foodstuff, "before_update")
+def set_expires_at(mapper, connection, target):
+    """Every ORM add or edit of a foodstuff recomputes expires_at"""
+
+    if target.last_purch is None:
+        # Column default, but we need it now to work out the expiry
+        target.last_purch = datetime.utcnow()
+    target.expires_at = expiry(target.last_purch, target.exp)
 
 ###############################################################################
 """Helper functions"""
 
-def connect_to_db(app, db_uri="postgresql:///pantry"):
-    """Connect the database to Flask"""
+def setting_from_env(variable, default):
+    """Environment variable as the same type as default"""
+
+    value = os.environ.get(variable)
+    if value is None:
+        return default
+    if default is None:
+        return value
+    if isinstance(default, bool):
+        return value.lower() in ("1", "true", "yes", "on")
+    return type(default)(value)
+
+def connect_to_db(app, db_uri="postgresql:///pantry", replica_uri=None, **pool):
+    """Connect the database to Flask. Pool and replica settings can be given
+       as lowercase POOL_SETTINGS/REPLICA_SETTINGS names, e.g.
+       connect_to_db(app, uri, db_pool_size=20, db_pgbouncer=True)"""
 
     # Configure to use PostgreSQL database
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SQLALCHEMY_ECHO'] = False
+    if replica_uri is not None:
+        pool["db_replica_uri"] = replica_uri
+    for key, variable, default in POOL_SETTINGS + REPLICA_SETTINGS:
+        app.config.setdefault(key, setting_from_env(variable, default))
+        if key.lower() in pool:
+            app.config[key] = pool.pop(key.lower())
+    if pool:
+        raise TypeError("unknown pool settings: {}".format(", ".join(pool)))
+    if (app.config["DB_REPLICA_URI"] and
+            app.config["DB_REPLICA_STICKY"] <= app.config["DB_REPLICA_MAX_LAG"]):
+        raise ValueError("DB_REPLICA_STICKY has to be more than "
+                         "DB_REPLICA_MAX_LAG, or users can miss their own "
+                         "changes")
+
+    # Replica is a Flask-SQLAlchemy bind no model belongs to, only
+    # PantrySession ever picks it
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds.pop("replica", None)
+    if app.config["DB_REPLICA_URI"]:
+        binds["replica"] = app.config["DB_REPLICA_URI"]
+    app.config['SQLALCHEMY_BINDS'] = binds
     db.app = app
     db.init_app(app)
 
+def check_max_connections(app, processes):
+    """Raises RuntimeError if processes copies of app's pool could open
+       more connections than the primary's max_connections. Asks on a
+       connection of its own that's closed again, so the master can call it
+       before forking."""
+
+    if app.config["DB_PGBOUNCER"] or not app.config[
+            "SQLALCHEMY_DATABASE_URI"].startswith("postgres"):
+        return
+    most = processes * (app.config["DB_POOL_SIZE"] +
+                        app.config["DB_MAX_OVERFLOW"])
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"],
+                           poolclass=NullPool)
+    try:
+        allowed = int(engine.scalar("SHOW max_connections"))
+    finally:
+        engine.dispose()
+    if most > allowed:
+        raise RuntimeError(
+            "{} processes with DB_POOL_SIZE {} and DB_MAX_OVERFLOW {} can "
+            "open {} connections, the db allows {}: use fewer workers, a "
+            "smaller pool or pgbouncer (DB_PGBOUNCER)".format(
+                processes, app.config["DB_POOL_SIZE"],
+                app.config["DB_MAX_OVERFLOW"], most, allowed))
+
 
 if __name__ == "__main__":
     # As a convenience, if we run this module interactively, it will leave
     # you in a state of being able to work with the database directly.
 
-    from server import app
+    from server import create_app
 
-    connect_to_db(app)
+    app = create_app()
     print "Connected to DB."
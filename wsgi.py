@@ -0,0 +1,27 @@
+"""WSGI entry point for production
+
+    export PANTRY_SECRET_KEY=... PANTRY_CACHE_URL=redis://...
+    gunicorn -c gunicorn_conf.py wsgi:app
+
+Settings come from the environment (PANTRY_DB_URI, PANTRY_CACHE_URL, the
+PANTRY_DB_* pool and replica settings in tablesetup), workers and threads
+from gunicorn_conf.py. Importing this builds the app but opens no
+connections, so it's safe to import before forking; each worker warms up on
+its own afterwards.
+"""
+
+import time
+STARTED = time.time()
+
+import os
+
+from server import create_app
+import request_metrics
+
+if "PANTRY_SECRET_KEY" not in os.environ:
+    raise RuntimeError("PANTRY_SECRET_KEY isn't set, sessions would be "
+                       "signed with the development key")
+
+request_metrics.startup_began(STARTED)
+request_metrics.startup_step("import", time.time() - STARTED)
+app = create_app()